@@ -0,0 +1,155 @@
+'''
+Per-granule cache of unfiltered ATL08 segments, so that changing the filters doesn't mean re-reading the h5 granules.
+Each granule is cached as one Parquet file of all of the schema columns of its product version, before any filtering
+(float fill values are already NaN, each column has its schema dtype). The file name has the granule name (with its
+product version and revision) and a hash of ATL08_SCHEMA, so a change of the schema starts a new cache file.
+A cache file is only used if the mtime and size of its source h5 haven't changed. The cache is kept under a size
+limit by removing the least recently used files (a cache hit updates the mtime of its file).
+'''
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import ExtractUtils
+
+CACHE_EXT = '.parquet'
+
+def get_schema_hash():
+    '''
+    Return a short hash of ATL08_SCHEMA
+    '''
+    return(hashlib.md5(json.dumps(ExtractUtils.ATL08_SCHEMA, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:12])
+
+def get_cache_fn(cache_dir, granule_fname):
+    '''
+    Return the cache file of a granule, eg <cache_dir>/ATL08_20181226222354_13640102_005_01_<schema hash>.parquet
+    '''
+    Name = os.path.basename(granule_fname).split('.')[0]
+    return(os.path.join(cache_dir, Name + '_' + get_schema_hash() + CACHE_EXT))
+
+def get_cache_cols(atl08_version):
+    '''
+    Return the schema columns cached for a product version (all of those it has)
+    '''
+    schema_version = ExtractUtils.get_schema_version(atl08_version)
+    return([col for col, dict_col in ExtractUtils.ATL08_SCHEMA.items() if schema_version in dict_col['versions']])
+
+def get_source_info(h5_fn):
+    '''
+    Return the mtime and size of a source h5, to validate its cache file
+    '''
+    st = os.stat(h5_fn)
+    return({'mtime': st.st_mtime, 'size': st.st_size})
+
+def write_cache(cache_fn, h5_fn, dict_granule, dict_cols):
+    '''
+    Write the granule info and the unfiltered columns (see ExtractUtils.read_atl08_columns) of a granule to its cache file
+        2-D columns (the (n, 5) 20m fields) are fixed size lists; gt is dictionary encoded
+    The file is written under a temp name and then renamed, so parallel workers never see a partial cache file
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    dict_arrays = {}
+    for col, arr in dict_cols.items():
+        if isinstance(arr, pd.Categorical):
+            dict_arrays[col] = pa.DictionaryArray.from_arrays(pa.array(arr.codes), pa.array(list(arr.categories), type=pa.binary()))
+        elif arr.ndim == 2:
+            dict_arrays[col] = pa.FixedSizeListArray.from_arrays(pa.array(arr.ravel()), arr.shape[1])
+        else:
+            dict_arrays[col] = pa.array(arr)
+
+    dict_meta = {
+        'source'  : os.path.abspath(h5_fn),
+        'granule' : {key: val.decode('utf-8') if isinstance(val, bytes) else int(val) for key, val in dict_granule.items()},
+        **get_source_info(h5_fn)
+    }
+    table = pa.table(dict_arrays).replace_schema_metadata({'atl08_cache': json.dumps(dict_meta)})
+
+    os.makedirs(os.path.dirname(os.path.abspath(cache_fn)), exist_ok=True)
+    tmp_fn = f"{cache_fn}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp_fn, compression='zstd')
+    os.replace(tmp_fn, cache_fn)
+
+def read_cache(cache_fn, h5_fn, read_cols):
+    '''
+    Read the granule info and the read_cols (plus gt) of a granule from its cache file
+    Returns (dict_granule, dict_cols) as from the h5, or None if there is no cache file or it is out of date
+    (an out of date cache file, whose source h5 mtime or size changed, is removed)
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not os.path.isfile(cache_fn):
+        return None
+
+    try:
+        dict_meta = json.loads(pq.read_schema(cache_fn).metadata[b'atl08_cache'])
+    except Exception as e:
+        print(f"\tCan't read cache file, ignoring it: {cache_fn} ({e})")
+        return None
+
+    dict_source = get_source_info(h5_fn)
+    if dict_meta['mtime'] != dict_source['mtime'] or dict_meta['size'] != dict_source['size']:
+        print(f"\tSource h5 changed since it was cached, removing: {cache_fn}")
+        try:
+            os.remove(cache_fn)
+        except OSError:
+            pass
+        return None
+
+    table = pq.read_table(cache_fn, columns=list(read_cols) + ['gt'])
+
+    dict_cols = {}
+    for col in table.column_names:
+        arr = table.column(col).combine_chunks()
+        if col == 'gt':
+            dict_cols[col] = pd.Categorical.from_codes(arr.indices.to_numpy(zero_copy_only=False).astype('int8'), categories=arr.dictionary.to_pylist())
+        elif pa.types.is_fixed_size_list(arr.type):
+            dict_cols[col] = np.array(arr.flatten().to_numpy(zero_copy_only=False)).reshape(-1, arr.type.list_size)
+        else:
+            dict_cols[col] = np.array(arr.to_numpy(zero_copy_only=False))
+
+    # gt last, as from the h5
+    dict_cols['gt'] = dict_cols.pop('gt')
+
+    dict_granule = {key: val.encode('utf-8') if isinstance(val, str) else val for key, val in dict_meta['granule'].items()}
+
+    # A cache hit makes the file the most recently used
+    os.utime(cache_fn)
+
+    return(dict_granule, dict_cols)
+
+def evict_cache(cache_dir, max_gb):
+    '''
+    Remove the least recently used cache files until the cache is no bigger than max_gb (the newest file is always kept)
+    '''
+    list_files = []
+    for fn in os.listdir(cache_dir):
+        if fn.endswith(CACHE_EXT):
+            try:
+                st = os.stat(os.path.join(cache_dir, fn))
+            except OSError:
+                continue # removed by another worker
+            list_files.append((st.st_mtime, st.st_size, os.path.join(cache_dir, fn)))
+
+    list_files.sort()
+    total_bytes = sum([size for mtime, size, fn in list_files])
+    max_bytes = max_gb * 1024**3
+
+    n_removed = 0
+    for mtime, size, fn in list_files[:-1]:
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+        total_bytes -= size
+        n_removed += 1
+
+    if n_removed > 0:
+        print(f"\tRemoved {n_removed} least recently used cache files; cache size: {round(total_bytes / 1024**3, 3)} GB")
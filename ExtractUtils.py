@@ -0,0 +1,415 @@
+'''
+Reader utilities for ATL08 h5 granules, shared by the extract_*atl08*.py scripts.
+Datasets are read as native numpy arrays (keeping the HDF5 dtype) and beams are joined with a single concatenate.
+'''
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import ProfileUtils
+
+# Set the names of the 6 lasers
+LINES = ['gt1r', 'gt1l', 'gt2r', 'gt2l', 'gt3r', 'gt3l']
+
+# ATL08 product versions described by the schema; newer versions are read with the latest layout
+ATL08_VERSIONS = [3, 4, 5]
+
+FILL_FLOAT32 = np.finfo('float32').max
+
+# Filter pushdown: the surviving rows of a beam are read as one slice per contiguous run when there are up to
+# RUNS_MAX_SLICES runs (eg, a bbox), else with a fancy (point) selection when there are up to FANCY_MAX_ROWS rows,
+# else with one hyperslab over their span
+RUNS_MAX_SLICES = 16
+FANCY_MAX_ROWS = 1000
+
+# ATL08 land_segments schema
+# Maps each output column to its dataset path under /gtxx/land_segments/, its HDF5 dtype,
+# its fill value and the product versions it exists in.
+# Columns taken from a 2-D dataset carry 'index': {version: column of the dataset}
+# canopy_h_metrics is (n, 9) [25,50,60,70,75,80,85,90,95] before v005 and (n, 18) [10,15,...,95] from v005
+RH_V003 = [25, 50, 60, 70, 75, 80, 85, 90, 95]
+RH_V005 = list(range(10, 100, 5))
+
+ATL08_SCHEMA = {
+    'lon'        : {'path': 'longitude',                    'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'lat'        : {'path': 'latitude',                     'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'segid_beg'  : {'path': 'segment_id_beg',               'dtype': 'int32',   'fill': 2147483647,   'versions': [3, 4, 5]},
+    'segid_end'  : {'path': 'segment_id_end',               'dtype': 'int32',   'fill': 2147483647,   'versions': [3, 4, 5]},
+
+    # Canopy fields
+    'h_max_can'  : {'path': 'canopy/h_max_canopy',          'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'h_can'      : {'path': 'canopy/h_canopy',              'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'h_can_quad' : {'path': 'canopy/h_canopy_quad',         'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'h_can_unc'  : {'path': 'canopy/h_canopy_uncertainty',  'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'n_ca_ph'    : {'path': 'canopy/n_ca_photons',          'dtype': 'int32',   'fill': 2147483647,   'versions': [3, 4, 5]},
+    'n_toc_ph'   : {'path': 'canopy/n_toc_photons',         'dtype': 'int32',   'fill': 2147483647,   'versions': [3, 4, 5]},
+    'can_open'   : {'path': 'canopy/canopy_openness',       'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'can_rh_conf': {'path': 'canopy/canopy_rh_conf',        'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+    'tcc_flg'    : {'path': 'canopy/landsat_flag',          'dtype': 'int8',    'fill': 127,          'versions': [3, 4]},
+    'tcc_prc'    : {'path': 'canopy/landsat_perc',          'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4]},
+    'seg_cover'  : {'path': 'canopy/segment_cover',         'dtype': 'int16',   'fill': 32767,        'versions': [5]},
+
+    # Uncertainty fields
+    'cloud_flg'  : {'path': 'cloud_flag_atm',               'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+    'msw_flg'    : {'path': 'msw_flag',                     'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+    'n_seg_ph'   : {'path': 'n_seg_ph',                     'dtype': 'int32',   'fill': 2147483647,   'versions': [3, 4, 5]},
+    'night_flg'  : {'path': 'night_flag',                   'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+    'seg_landcov': {'path': 'segment_landcover',            'dtype': 'uint8',   'fill': 255,          'versions': [3, 4, 5]},
+    'seg_snow'   : {'path': 'segment_snowcover',            'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+    'seg_water'  : {'path': 'segment_watermask',            'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+    'sig_vert'   : {'path': 'sigma_atlas_land',             'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'sig_acr'    : {'path': 'sigma_across',                 'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'sig_along'  : {'path': 'sigma_along',                  'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'sig_h'      : {'path': 'sigma_h',                      'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'sig_topo'   : {'path': 'sigma_topo',                   'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+
+    # Terrain fields
+    'n_te_ph'    : {'path': 'terrain/n_te_photons',         'dtype': 'int32',   'fill': 2147483647,   'versions': [3, 4, 5]},
+    'h_te_best'  : {'path': 'terrain/h_te_best_fit',        'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'h_te_unc'   : {'path': 'terrain/h_te_uncertainty',     'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'ter_slp'    : {'path': 'terrain/terrain_slope',        'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'snr'        : {'path': 'snr',                          'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'sol_az'     : {'path': 'solar_azimuth',                'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'sol_el'     : {'path': 'solar_elevation',              'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+
+    'asr'        : {'path': 'asr',                          'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'h_dif_ref'  : {'path': 'h_dif_ref',                    'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [3, 4, 5]},
+    'ter_flg'    : {'path': 'terrain_flg',                  'dtype': 'int32',   'fill': 2147483647,   'versions': [3, 4, 5]},
+    'ph_rem_flg' : {'path': 'ph_removal_flag',              'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+    'dem_rem_flg': {'path': 'dem_removal_flag',             'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+    'seg_wmask'  : {'path': 'segment_watermask',            'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+    'lyr_flg'    : {'path': 'layer_flag',                   'dtype': 'int8',    'fill': 127,          'versions': [3, 4, 5]},
+
+    # 20m segment fields (n, 5)
+    'lon_20m'    : {'path': 'longitude_20m',                'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [5]},
+    'lat_20m'    : {'path': 'latitude_20m',                 'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [5]},
+    'h_can_20m'  : {'path': 'canopy/h_canopy_20m',          'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [5]},
+    'h_te_best_20m': {'path': 'terrain/h_te_best_fit_20m',  'dtype': 'float32', 'fill': FILL_FLOAT32, 'versions': [5]},
+}
+
+# RH metrics are columns of canopy_h_metrics
+for rh in sorted(set(RH_V003 + RH_V005)):
+    dict_index = {}
+    if rh in RH_V003:
+        dict_index.update({3: RH_V003.index(rh), 4: RH_V003.index(rh)})
+    if rh in RH_V005:
+        dict_index[5] = RH_V005.index(rh)
+    ATL08_SCHEMA['rh' + str(rh)] = {'path': 'canopy/canopy_h_metrics', 'dtype': 'float32', 'fill': FILL_FLOAT32,
+                                    'versions': sorted(dict_index), 'index': dict_index}
+
+# Granule level columns, broadcast to every segment (no beam dataset is read for these)
+GRANULE_COLS = ['dt', 'orb_orient', 'orb_num', 'rgt']
+
+# Columns derived downstream (eg, FilterUtils.prep_filter_atl08_qual) and the extracted columns they need
+DERIVED_COLS = {
+    'y'           : ['dt'],
+    'm'           : ['dt'],
+    'd'           : ['dt'],
+    'doy'         : ['dt'],
+    'beam_type'   : ['gt', 'orb_orient'],
+    'granule_name': []
+}
+
+# Columns built by the reader or the extractor rather than read from a dataset
+BUILT_COLS = ['gt', 'fid', 'id_20m']
+
+# Compact dtypes of the granule level and built columns (the dtypes of the rest are in ATL08_SCHEMA)
+COL_DTYPES = {
+    'orb_orient': 'int8',
+    'orb_num'   : 'int32',
+    'rgt'       : 'int16',
+    'fid'       : 'int32',
+    'id_20m'    : 'int8'
+}
+
+# Columns with few distinct values are pandas categoricals: a small int code per row plus the values once
+#   gt: the 6 beams, as byte strings (b'gt1r') like the h5 ; dt (byte string of /ancillary_data/granule_end_utc)
+#   and granule_name: one value per granule ; beam_type and the --set_flag_names labels
+CATEGORICAL_COLS = ['gt', 'dt', 'granule_name', 'beam_type']
+
+# Output formats of the extractors and their file extensions
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+def read_granule_info(f):
+    '''
+    Return the granule level acq date and orbit info of an open ATL08 h5 as a dict of scalars
+    '''
+    dict_granule = {
+                    'dt'        : f['/ancillary_data/granule_end_utc/'][0],
+                    'orb_orient': f['/orbit_info/sc_orient/'][0],
+                    'orb_num'   : f['/orbit_info/orbit_number/'][0],
+                    'rgt'       : f['/orbit_info/rgt/'][0]
+    }
+    return(dict_granule)
+
+def get_strong_beams(orb_orient, lines=LINES):
+    '''
+    Return the strong beams of a granule from its spacecraft orientation (/orbit_info/sc_orient)
+        0: backward, the left beams are strong; 1: forward, the right beams are strong; 2: transition, none
+    '''
+    if orb_orient == 0:
+        return [line for line in lines if line.endswith('l')]
+    elif orb_orient == 1:
+        return [line for line in lines if line.endswith('r')]
+    return []
+
+def get_index_runs(idx):
+    '''
+    Return the (start, stop) slices of the contiguous runs of row indices in idx (sorted, unique)
+    '''
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    starts = idx[np.r_[0, breaks]]
+    stops  = idx[np.r_[breaks - 1, len(idx) - 1]] + 1
+    return(list(zip(starts, stops)))
+
+def read_rows(ds, idx):
+    '''
+    Read the rows idx (sorted, unique) of an h5 dataset
+    A few contiguous runs are read as hyperslab slices; a few scattered rows with a fancy (point) selection;
+    otherwise one hyperslab over the span of idx is read and subset in memory
+    '''
+    if len(idx) == 0:
+        return ds[0:0]
+    runs = get_index_runs(idx)
+    if len(runs) <= RUNS_MAX_SLICES:
+        return np.concatenate([ds[start:stop] for start, stop in runs])
+    if len(idx) <= FANCY_MAX_ROWS:
+        return ds[idx]
+    return ds[idx[0]:idx[-1] + 1][idx - idx[0]]
+
+def get_fill_value(ds):
+    '''
+    Return the _FillValue attribute of an h5 dataset, or None if it has none
+    '''
+    fill = ds.attrs.get('_FillValue')
+    return None if fill is None else np.asarray(fill).flat[0]
+
+def read_dataset(ds, idx=None, fill=None):
+    '''
+    Read an h5 dataset, or only its rows idx (see read_rows)
+    With a fill value, the fill of a float dataset is set to NaN in place
+    '''
+    arr = ds[...] if idx is None else read_rows(ds, idx)
+    if fill is not None and arr.dtype.kind == 'f':
+        arr[arr == fill] = np.nan
+    return arr
+
+def read_beams(f, dict_paths, lines=LINES, check_path='land_segments/latitude', list_masks=[], mask_fill=False, profile=None):
+    '''
+    Read beam level datasets of an open ATL08 h5 as numpy arrays and join the beams along track
+        dict_paths: {output column name: dataset path relative to the /gtxx/ group}
+        check_path: a beam is skipped when this dataset is not in the file (a line/laser may have no members - MW 3/31)
+        list_masks: filter pushdown; a list of (mask_paths, mask_func) applied in order. For each, the mask_paths datasets
+                    are read for the rows still kept and mask_func({path: array}) returns a boolean mask of those rows.
+                    The other datasets are then read only for the rows that pass, and a beam with no rows left is skipped.
+        mask_fill: set the _FillValue of float datasets to NaN as they are read (int flag datasets keep their fill values)
+        profile: times the join of the beams as the phase read/join_beams (see ProfileUtils)
+    Returns a dict of arrays with a 'gt' (ground track) categorical added, or None if no beam had data
+    '''
+    dict_beams = {col: [] for col in dict_paths}
+    list_gt = []
+
+    # Fill value of each path, read from the first beam that has it
+    dict_fill = {}
+    def get_dataset(line, path):
+        ds = f['/' + line + '/' + path.strip('/')]
+        if mask_fill and path not in dict_fill:
+            dict_fill[path] = get_fill_value(ds)
+        return ds, dict_fill.get(path)
+
+    for line in lines:
+
+        if '/' + line + '/' + check_path.strip('/') not in f:
+            continue # No info for laser/line, skip it and move on to next line
+
+        # Some fields share a dataset (eg, seg_water and seg_wmask); read each path once per beam
+        # Arrays in dict_read always hold the rows idx (all rows when idx is None)
+        dict_read = {}
+        idx = None
+        for mask_paths, mask_func in list_masks:
+            for path in mask_paths:
+                if path not in dict_read:
+                    ds, fill = get_dataset(line, path)
+                    dict_read[path] = read_dataset(ds, idx, fill)
+            keep = mask_func(dict_read)
+            idx = np.flatnonzero(keep) if idx is None else idx[keep]
+            dict_read = {path: arr[keep] for path, arr in dict_read.items()}
+            if len(idx) == 0:
+                break
+        if idx is not None and len(idx) == 0:
+            continue # No rows of this beam pass the filters
+
+        for col, path in dict_paths.items():
+            if path not in dict_read:
+                ds, fill = get_dataset(line, path)
+                dict_read[path] = read_dataset(ds, idx, fill)
+            dict_beams[col].append(dict_read[path])
+
+        # Get ground track (as its code in LINES)
+        n_rows = len(f['/' + line + '/' + check_path.strip('/')]) if idx is None else len(idx)
+        list_gt.append(np.full(n_rows, LINES.index(line), dtype='int8'))
+
+    if len(list_gt) == 0:
+        return None # No usable points in h5 file, can't process
+
+    with ProfileUtils.phase(profile, 'read/join_beams'):
+        dict_beams = {col: np.concatenate(list_arr) for col, list_arr in dict_beams.items()}
+        dict_beams['gt'] = pd.Categorical.from_codes(np.concatenate(list_gt), categories=[line.encode() for line in LINES])
+
+    return(dict_beams)
+
+def get_atl08_version(granule_fname):
+    '''
+    Get the product version from an ATL08 granule name, eg ATL08_20181226222354_13640102_005_01.h5 -> 5
+    '''
+    return(int(granule_fname.split('_')[-2]))
+
+def parse_granule_name(granule_fname):
+    '''
+    Parse an ATL08 granule name, eg ATL08_20181226222354_13640102_005_01.h5
+        ATL08_[yyyymmdd][hhmmss]_[ttttccss]_[vvv]_[rr]: acq start date and time, reference ground track (RGT),
+        cycle, granule region (1-14 around the orbit), product version and revision
+    Returns a dict
+    '''
+    parts = os.path.basename(granule_fname).split('.')[0].split('_')
+    return({
+            'dt'      : datetime.strptime(parts[1], '%Y%m%d%H%M%S'),
+            'rgt'     : int(parts[2][0:4]),
+            'cycle'   : int(parts[2][4:6]),
+            'region'  : int(parts[2][6:8]),
+            'version' : int(parts[3]),
+            'revision': int(parts[4])
+    })
+
+def get_schema_version(atl08_version):
+    '''
+    Return the schema version used to read a product version
+    '''
+    return(min(atl08_version, max(ATL08_VERSIONS)))
+
+def expand_cols(cols):
+    '''
+    Expand derived columns into the extracted columns they need; keeps order and drops duplicates
+    '''
+    out_cols = []
+    for col in cols:
+        for c in DERIVED_COLS.get(col, [col]):
+            if c not in out_cols:
+                out_cols.append(c)
+    return(out_cols)
+
+def get_read_cols(cols, atl08_version):
+    '''
+    From a list of wanted output (and filter) columns, return the schema columns that need to be read for this product version
+    Derived columns are expanded into the columns they need; columns not in this product version are dropped
+    '''
+    schema_version = get_schema_version(atl08_version)
+
+    read_cols = []
+    for c in expand_cols(cols):
+        if c in GRANULE_COLS or c in BUILT_COLS:
+            continue
+        if c not in ATL08_SCHEMA:
+            print(f"\tColumn not in ATL08 schema, skipping: {c}")
+        elif schema_version not in ATL08_SCHEMA[c]['versions']:
+            print(f"\tColumn not in ATL08 v{atl08_version:03d}, skipping: {c}")
+        else:
+            read_cols.append(c)
+    return(read_cols)
+
+def get_col_array(arr, col, schema_version):
+    '''
+    Return a column from the array of its dataset (picks the column of a 2-D dataset, eg an RH metric of canopy_h_metrics)
+    '''
+    if 'index' in ATL08_SCHEMA[col]:
+        return arr[:, ATL08_SCHEMA[col]['index'][schema_version]]
+    return arr
+
+def read_atl08_columns(f, read_cols, atl08_version, lines=LINES, list_masks=[], profile=None):
+    '''
+    Read schema columns of an open ATL08 h5 for all beams; each dataset is read only once
+    The fill values of float columns are NaN
+        list_masks: filter pushdown (see read_beams); a list of (mask_cols, mask_func), where mask_func takes a dict of the mask_cols arrays
+        profile: times the join of the beams and the cast to the schema dtypes as phases of the read (see ProfileUtils)
+    Returns a dict of arrays (plus 'gt') in the order of read_cols, or None if no beam had data
+    '''
+    schema_version = get_schema_version(atl08_version)
+
+    get_path = lambda col: 'land_segments/' + ATL08_SCHEMA[col]['path']
+
+    dict_paths = {}
+    for col in read_cols:
+        dict_paths[get_path(col)] = get_path(col)
+
+    # Wrap each mask_func so that it gets columns rather than dataset paths
+    list_masks_paths = []
+    for mask_cols, mask_func in list_masks:
+        mask_func_paths = lambda dict_read, mask_cols=mask_cols, mask_func=mask_func: mask_func({col: get_col_array(dict_read[get_path(col)], col, schema_version) for col in mask_cols})
+        list_masks_paths.append((list(dict.fromkeys([get_path(col) for col in mask_cols])), mask_func_paths))
+
+    dict_beams = read_beams(f, dict_paths, lines=lines, list_masks=list_masks_paths, mask_fill=True, profile=profile)
+    if dict_beams is None:
+        return None
+
+    # Hold each column in its schema dtype (a no-op when the h5 dataset already has it)
+    dict_cols = {}
+    with ProfileUtils.phase(profile, 'read/astype'):
+        for col in read_cols:
+            dict_cols[col] = get_col_array(dict_beams[get_path(col)], col, schema_version).astype(ATL08_SCHEMA[col]['dtype'], copy=False)
+    dict_cols['gt'] = dict_beams['gt']
+
+    return(dict_cols)
+
+def full_categorical(n, value):
+    '''
+    Return a categorical of n rows of one value (eg, the acq date or name of a granule)
+    '''
+    return(pd.Categorical.from_codes(np.zeros(n, dtype='int8'), categories=[value]))
+
+def map_flag_names(arr, dict_names):
+    '''
+    Map flag values to their names as a categorical; values not in dict_names are NaN (like pd.Series.map)
+    '''
+    codes = pd.Index(list(dict_names)).get_indexer(arr)
+    return(pd.Categorical.from_codes(codes, categories=list(dict_names.values())))
+
+def replace_float_values(df, val, new_val):
+    '''
+    Replace a value (eg, a nodata sentinel; or np.nan) with a new value in the float columns of a df, keeping their dtypes
+    The sentinels of the int flag columns (eg, 127) are left alone, and no column is widened to float64 / object
+    '''
+    for col in df.columns:
+        if df[col].dtype.kind != 'f':
+            continue
+        arr = df[col].to_numpy()
+        mask = np.isnan(arr) if np.isnan(val) else (arr == val)
+        if mask.any():
+            df[col] = np.where(mask, arr.dtype.type(new_val), arr)
+    return(df)
+
+def write_atl08_df(out, out_fn, output_format='csv'):
+    '''
+    Write a df of extracted ATL08 segments
+        csv: text, as always
+        parquet, feather: typed columns with zstd compression; categoricals are dictionary encoded;
+                          byte strings (eg, the gt and dt categories) are written as strings
+    '''
+    if output_format == 'csv':
+        out.to_csv(out_fn, index=False, encoding="utf-8-sig")
+        return
+
+    out = out.reset_index(drop=True)
+    for col in out.columns:
+        if isinstance(out[col].dtype, pd.CategoricalDtype):
+            categories = out[col].cat.categories
+            if len(categories) > 0 and isinstance(categories[0], bytes):
+                out[col] = out[col].cat.rename_categories([c.decode('utf-8') for c in categories])
+        elif out[col].dtype == object and len(out) > 0 and isinstance(out[col].iloc[0], bytes):
+            out[col] = out[col].str.decode('utf-8')
+
+    if output_format == 'parquet':
+        out.to_parquet(out_fn, index=False, compression='zstd')
+    elif output_format == 'feather':
+        out.to_feather(out_fn, compression='zstd')
@@ -1,11 +1,14 @@
 #import pdal
 import json
 import os
+import operator
+import functools
 
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 
-from pyproj import CRS, Transformer
+# geopandas and pyproj are imported where they are used, so that importing FilterUtils
+# for the quality filters (eg, in every extract_filter_atl08*.py worker) stays cheap
 
 import sys
 #sys.path.append('/projects/code/icesat2_boreal/notebooks/3.Gridded_product_development')
@@ -37,54 +40,90 @@ def get_granules_list(granules):
         output_list.append(url)
     return output_list
 
+def get_category_strings(col):
+    '''
+    Return a column as a categorical and its categories as plain strings (b'gt1r', "b'gt1r'" and 'gt1r' all give 'gt1r')
+    '''
+    col = col.astype('category')
+    categories = pd.Index([c.decode('utf-8') if isinstance(c, bytes) else str(c) for c in col.cat.categories]).str.strip("b\'\"")
+    return(col, categories)
+
+def get_beam_type(atl08):
+    '''
+    Return the beam type (Strong/Weak) of each obs as a categorical, from orbit orientation and ground track
+        sc_orient 1 (forward): the right beams are strong; 0 (backward): the left beams are strong; otherwise NaN
+    The side of each beam (right: 1, left: 0) is worked out once per category of gt, so a beam is strong where side == orb_orient
+    '''
+    gt, gt_categories = get_category_strings(atl08['gt'])
+    side = np.where(gt_categories.str.contains('r'), 1, np.where(gt_categories.str.contains('l'), 0, -1)).astype('int8')
+    side = np.append(side, np.int8(-1))[gt.cat.codes.to_numpy()]
+
+    orb_orient = atl08['orb_orient'].to_numpy()
+    valid = (side >= 0) & ((orb_orient == 0) | (orb_orient == 1))
+
+    # Codes of the categories: 0 Strong, 1 Weak, -1 NaN
+    return(pd.Categorical.from_codes(np.where(valid, side != orb_orient, -1).astype('int8'), categories=['Strong', 'Weak']))
+
+# Dtypes of the acq date parts
+DT_PART_DTYPES = {'y': 'int16', 'm': 'int8', 'd': 'int8', 'doy': 'int16'}
+
+def get_dt_parts(atl08):
+    '''
+    Return a dict of the year, month, day and day of year of the acq date (dt) of each obs, as small ints
+    (as floats, with NaN for obs with no dt)
+    '''
+    dt, dt_categories = get_category_strings(atl08['dt'])
+    codes = dt.cat.codes.to_numpy()
+    dts = pd.to_datetime(dt_categories)
+
+    dict_parts = {'y': dts.year, 'm': dts.month, 'd': dts.day, 'doy': dts.dayofyear}
+    if (codes >= 0).all():
+        return({part: np.asarray(vals, dtype=DT_PART_DTYPES[part])[codes] for part, vals in dict_parts.items()})
+    return({part: pd.api.extensions.take(np.asarray(vals), codes, allow_fill=True) for part, vals in dict_parts.items()})
+
+def get_prep_cols(atl08, cols=None):
+    '''
+    Return a dict of the derived columns (PREP_COLS, or those of cols) that a df has the gt, orb_orient and dt columns for:
+    the beam type and the acq date parts. Each is worked out once per category of gt and dt rather than per row
+    Used by prep_filter_atl08_qual, and by the extractor so that the prep of its outputs has nothing left to do
+    '''
+    cols = PREP_COLS if cols is None else cols
+    dict_prep = {}
+    if 'beam_type' in cols and 'gt' in atl08 and 'orb_orient' in atl08:
+        dict_prep['beam_type'] = get_beam_type(atl08)
+    if any([part in cols for part in DT_PART_DTYPES]) and 'dt' in atl08:
+        dict_prep.update({part: arr for part, arr in get_dt_parts(atl08).items() if part in cols})
+    return(dict_prep)
+
+# Columns added by prep_filter_atl08_qual
+PREP_COLS = ['beam_type', 'y', 'm', 'd', 'doy']
+
 def prep_filter_atl08_qual(atl08):
     '''
     Run this data prep on a df built from all CSVs from a DPS of extract_atl08.py for v003 of ATL08
+    Derived columns the df already has (eg, added by the extractor) are kept as they are
     '''
     
     print("\nPre-filter data cleaning...")
     print(f'Pandas version: {pd.__version__}')
 
-    # This always worked when running on MAAP: pandas 1.2.2
-    # This doesnt work with pandas 1.3.3 or pandas 1.2.2 on ADAPT
-    # if this fails, add back in this: '.str.decode('utf-8')'
-    # like:
-    # atl08.loc[( (atl08.orb_orient == 1 ) & (atl08['gt'].str.decode('utf-8').str.contains('r')) ), "beam_type"] = 'Strong'
-    try:
-        atl08.loc[( (atl08.orb_orient == 1 ) & (atl08['gt'].str.contains('r')) ), "beam_type"] = 'Strong' 
-        atl08.loc[( (atl08.orb_orient == 1 ) & (atl08['gt'].str.contains('l')) ), "beam_type"] = 'Weak'
-        atl08.loc[( (atl08.orb_orient == 0 ) & (atl08['gt'].str.contains('r')) ), "beam_type"] = 'Weak'
-        atl08.loc[( (atl08.orb_orient == 0 ) & (atl08['gt'].str.contains('l')) ), "beam_type"] = 'Strong'
-    except:
-        atl08.loc[( (atl08.orb_orient == 1 ) & (atl08['gt'].str.decode('utf-8').str.contains('r')) ), "beam_type"] = 'Strong' 
-        atl08.loc[( (atl08.orb_orient == 1 ) & (atl08['gt'].str.decode('utf-8').str.contains('l')) ), "beam_type"] = 'Weak'
-        atl08.loc[( (atl08.orb_orient == 0 ) & (atl08['gt'].str.decode('utf-8').str.contains('r')) ), "beam_type"] = 'Weak'
-        atl08.loc[( (atl08.orb_orient == 0 ) & (atl08['gt'].str.decode('utf-8').str.contains('l')) ), "beam_type"] = 'Strong'        
-    print(f"\tGet beam type from orbit orientation and ground track: {atl08.beam_type.unique()}")
-
-    cols_float = ['lat', 'lon', 'h_can', 'h_te_best', 'ter_slp']
+    # Beam type and acq date parts are worked out once per category of gt and dt (6 beams; 1 date per granule)
+    # rather than with string ops on every row. gt and dt may be categoricals (from the extractor), byte strings,
+    # or strings like "b'gt1r'" (from a CSV)
+    for col, arr in get_prep_cols(atl08, [col for col in PREP_COLS if col not in atl08.columns]).items():
+        atl08[col] = arr
+    if 'beam_type' in atl08.columns:
+        print(f"\tGet beam type from orbit orientation and ground track: {atl08.beam_type.unique()}")
+
+    # Only cast the columns that are there (extraction may have projected some away)
+    cols_float = [c for c in ['lat', 'lon', 'h_can', 'h_te_best', 'ter_slp'] if c in atl08.columns]
     print("\tCast some columns to:")
     print(f"\t\ttype float: {cols_float}")
     atl08[cols_float] = atl08[cols_float].apply(pd.to_numeric, errors='coerce')
 
-    cols_int = ['n_ca_ph', 'n_seg_ph', 'n_toc_ph']
+    cols_int = [c for c in ['n_ca_ph', 'n_seg_ph', 'n_toc_ph'] if c in atl08.columns]
     print(f"\t\ttype integer: {cols_int}")
     atl08[cols_int] = atl08[cols_int].apply(pd.to_numeric, downcast='signed', errors='coerce')
-    
-    # If there is a fail here, try the other version:
-    # atl08['y'] = pd.to_datetime(atl08['dt'].str.decode('utf-8').str.strip("b\'\"")).dt.year
-    # atl08['y'] = pd.to_datetime(atl08['dt'].str.strip("b\'\"")).dt.year
-    try:
-        atl08['y'] = pd.to_datetime(atl08['dt'].str.strip("b\'\"")).dt.year    
-        atl08['m'] = pd.to_datetime(atl08['dt'].str.strip("b\'\"")).dt.month
-        atl08['d'] = pd.to_datetime(atl08['dt'].str.strip("b\'\"")).dt.day
-        atl08['doy'] = pd.to_datetime(atl08['dt'].str.strip("b\'\"")).dt.dayofyear
-    except:
-        #print('Attempt to decode datetime string of utf-8...')
-        atl08['y'] = pd.to_datetime(atl08['dt'].str.decode('utf-8').str.strip("b\'\"")).dt.year
-        atl08['m'] = pd.to_datetime(atl08['dt'].str.decode('utf-8').str.strip("b\'\"")).dt.month
-        atl08['d'] = pd.to_datetime(atl08['dt'].str.decode('utf-8').str.strip("b\'\"")).dt.day
-        atl08['doy'] = pd.to_datetime(atl08['dt'].str.decode('utf-8').str.strip("b\'\"")).dt.dayofyear
         
     if False:
         # Static quality filter flags for ABoVE AGB
@@ -162,6 +201,7 @@ def filter_atl08_bounds_tile_ept(in_ept_fn, in_tile_fn, in_tile_num, in_tile_lay
 
     xmin, xmax = geom_4326[0:2]
     ymin, ymax = geom_4326[2:]
+    from pyproj import Transformer
     transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
     xmin, ymax = transformer.transform(xmin, ymax)
     xmax, ymin = transformer.transform(xmax, ymin)
@@ -192,6 +232,7 @@ def filter_atl08_bounds_tile_ept(in_ept_fn, in_tile_fn, in_tile_num, in_tile_lay
 
 def filter_atl08_bounds_clip(atl08_df, in_tile_geom_4326):
 
+    import geopandas as gpd
     atl08_gdf = gpd.GeoDataFrame(atl08_df, geometry=gpd.points_from_xy(atl08_df.lon, atl08_df.lat), crs='epsg:4326')
     atl08_gdf = gpd.clip(atl08_gdf, in_tile_geom_4326)
     print(f"Bounds clipped {atl08_df.shape[0]} obs. down to {atl08_gdf.shape[0]} obs.")
@@ -235,65 +276,364 @@ def filter_atl08_bounds(atl08_df=None, in_bounds=None, in_ept_fn=None, in_tile_f
     
     if return_pdf:
         if out_fn is not None:
+            import geopandas as gpd
             atl08_df = gpd.read(out_fn)
         return(atl08_df)
     else:
         print(out_fn)
         return(out_fn)
 
-def filter_atl08_qual(input_fn=None, subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh85','rh90','rh95','h_can','h_max_can'], filt_cols =['h_can','h_dif_ref','m','msw_flg','beam_type','seg_snow'], thresh_h_can=None, thresh_h_dif=None, month_min=None, month_max=None, SUBSET_COLS=True, DO_PREP=True):
+# Filter specs
+# A filter spec is a dict (eg, from a JSON file) of the predicates an obs has to pass to remain. All of them are and'ed,
+# in this order (each key is optional):
+#   "eq"        : {col: value}                  obs EQUAL to the value (eg, {"msw_flg": 0, "beam_type": "Strong", "seg_snow": 1})
+#   "lc_thresh" : {"col": "h_can", "lc_col": "seg_landcov", "lc_class_values": [...], "thresh": [...]}
+#                                               obs LESS than the threshold of their land cover class
+#   "lt"        : {col: value}                  obs LESS than the value (eg, {"h_can_unc": 5, "sig_topo": 2.5})
+#   "range"     : {col: [min, max]}             obs within min-max, inclusive (eg, {"m": [6, 9]} for a month window)
+#   "bbox"      : [[minlon, maxlon, minlat, maxlat], ...]    obs inside any of the bboxes, inclusive
+# A spec is compiled once (compile_filter_spec) into a mask function that works on a df, on the per-beam arrays of the
+# extractor's filter pushdown, or on a pyarrow table; and into a pyarrow expression to push it down to Parquet row groups
+FILTER_SPEC_KEYS = ['eq', 'lc_thresh', 'lt', 'range', 'bbox']
+
+# Copernicus land cover classes (seg_landcov, from v005)
+LIST_LC_CLASS_VALUES = [0, 111, 113, 112, 114, 115, 116, 121, 123, 122, 124, 125, 126, 20, 30, 90, 100, 60, 40, 50, 70, 80, 200]
+
+def get_filter_spec(dict_misc_thresh={}, list_lc_h_can_thresh=None, thresh_h_can=100, month_min=None, month_max=None, list_lc_class_values=LIST_LC_CLASS_VALUES):
     '''
-    Quality filtering Function
+    Return the filter spec of the quality filters of filter_atl08_qual (v1) to filter_atl08_qual_v4:
+        clear skies + strong beam + snow free land,
+        h_can less than the threshold of each land cover class (or than thresh_h_can, with no land cover thresholds),
+        obs less than the misc thresholds, and months month_min-month_max
+    '''
+    filter_spec = {'eq': {'msw_flg': 0, 'beam_type': 'Strong', 'seg_snow': 1}}
+    if list_lc_h_can_thresh is None:
+        filter_spec['lt'] = {'h_can': thresh_h_can}
+    else:
+        filter_spec['lc_thresh'] = {'col': 'h_can', 'lc_col': 'seg_landcov', 'lc_class_values': list(list_lc_class_values), 'thresh': list(list_lc_h_can_thresh)}
+        filter_spec['lt'] = {}
+    filter_spec['lt'].update(dict_misc_thresh)
+    filter_spec['range'] = {'m': [month_min, month_max]}
+    return(filter_spec)
+
+# The v1-v4 quality filters with the thresholds they were used with for boreal (months 6-9).
+# v4 is v3 with its misc thresholds as a dict, so their presets are the same; domains change them with their own spec
+FILTER_SPEC_PRESETS = {
+    'v1': get_filter_spec({'h_dif_ref': 25}, thresh_h_can=100, month_min=6, month_max=9),
+    'v2': get_filter_spec({'sig_topo': 2.5, 'h_dif_ref': 25}, thresh_h_can=100, month_min=6, month_max=9),
+    'v3': get_filter_spec({'h_can_unc': 5, 'seg_cover': 32767, 'sol_el': 5, 'sig_topo': 2.5, 'h_dif_ref': 25},
+                          list_lc_h_can_thresh=[0, 60, 60, 60, 60, 60, 60, 50, 50, 50, 50, 50, 50, 20, 10, 10, 5, 5, 0, 0, 0, 0, 0], month_min=6, month_max=9),
+}
+FILTER_SPEC_PRESETS['v4'] = FILTER_SPEC_PRESETS['v3']
+
+def check_filter_spec(filter_spec):
+    '''
+    Check a filter spec; raises a ValueError saying what is wrong with it
+    '''
+    if not isinstance(filter_spec, dict):
+        raise ValueError("A filter spec needs to be a dict")
+    bad_keys = [key for key in filter_spec if key not in FILTER_SPEC_KEYS]
+    if len(bad_keys) > 0:
+        raise ValueError(f"Filter spec keys not known: {bad_keys} (known: {FILTER_SPEC_KEYS})")
+
+    for key in ['eq', 'lt']:
+        for col, val in filter_spec.get(key, {}).items():
+            if val is None:
+                raise ValueError(f"Must supply a value for {col} ({key})")
+    for col, val in filter_spec.get('range', {}).items():
+        if not isinstance(val, (list, tuple)) or len(val) != 2 or None in val:
+            raise ValueError(f"Must supply a [min, max] for {col} (range)")
+
+    lc = filter_spec.get('lc_thresh')
+    if lc is not None:
+        if any([key not in lc for key in ['col', 'lc_col', 'lc_class_values', 'thresh']]):
+            raise ValueError("A land cover threshold (lc_thresh) needs: col, lc_col, lc_class_values and thresh")
+        if len(lc['lc_class_values']) != len(lc['thresh']):
+            raise ValueError(f"Must supply a threshold for each of the {len(lc['lc_class_values'])} land cover classes (lc_thresh)")
+
+    for bbox in filter_spec.get('bbox', []):
+        if not isinstance(bbox, (list, tuple)) or len(bbox) != 4 or None in bbox:
+            raise ValueError("A bbox needs to be [minlon, maxlon, minlat, maxlat]")
+
+    return(filter_spec)
+
+def read_filter_spec(filter_spec):
+    '''
+    Return a checked copy of a filter spec given as a dict, a preset name (see FILTER_SPEC_PRESETS), a JSON file or a JSON string
+    A single bbox may be given as [minlon, maxlon, minlat, maxlat]
+    '''
+    if isinstance(filter_spec, str):
+        if filter_spec in FILTER_SPEC_PRESETS:
+            filter_spec = FILTER_SPEC_PRESETS[filter_spec]
+        elif os.path.isfile(filter_spec):
+            with open(filter_spec) as f:
+                filter_spec = json.load(f)
+        else:
+            try:
+                filter_spec = json.loads(filter_spec)
+            except ValueError:
+                raise ValueError(f"Not a filter spec preset {list(FILTER_SPEC_PRESETS)}, JSON file or JSON string: {filter_spec}")
+
+    filter_spec = json.loads(json.dumps(filter_spec)) if isinstance(filter_spec, dict) else filter_spec
+    if isinstance(filter_spec, dict) and len(filter_spec.get('bbox', [])) > 0 and not isinstance(filter_spec['bbox'][0], (list, tuple)):
+        filter_spec['bbox'] = [filter_spec['bbox']]
+
+    return(check_filter_spec(filter_spec))
+
+def get_filter_spec_cols(filter_spec):
+    '''
+    Return the columns the predicates of a filter spec use
+    '''
+    cols = list(filter_spec.get('eq', {}))
+    if 'lc_thresh' in filter_spec:
+        cols += [filter_spec['lc_thresh']['col'], filter_spec['lc_thresh']['lc_col']]
+    cols += list(filter_spec.get('lt', {})) + list(filter_spec.get('range', {}))
+    if len(filter_spec.get('bbox', [])) > 0:
+        cols += ['lon', 'lat']
+    return(list(dict.fromkeys(cols)))
+
+def get_filter_col(data, col):
+    '''
+    Return a column of a df, a dict of numpy arrays or a pyarrow table, for comparisons
+    (a categorical stays a Series, so that == compares with its categories rather than each row)
+    '''
+    arr = data[col]
+    if isinstance(arr, pd.Series):
+        return arr if isinstance(arr.dtype, pd.CategoricalDtype) else arr.to_numpy()
+    return np.asarray(arr)
+
+def compile_filter_spec(filter_spec, cols=None):
+    '''
+    Compile a filter spec into one mask function, mask_func(data, verbose=False, funnel=None), that ands each of its predicates
+    into one boolean numpy array (the data is never copied or indexed until the mask is done)
+        data: a df, a dict of numpy arrays (eg, a beam of the extractor's filter pushdown) or a pyarrow table
+        cols: only compile the predicates on these columns (the others are left to a later filter)
+        verbose: print the number of obs left after each predicate
+        funnel: a list to append the number of obs left after each predicate to, as {'stage': label, 'n': count}
+    Returns (mask_func, mask_cols), where mask_cols are the columns mask_func reads
+    '''
+    # (label, columns, predicate)
+    list_preds = []
+    for col, val in filter_spec.get('eq', {}).items():
+        list_preds.append((f"{col}={val}", [col], lambda data, col=col, val=val: get_filter_col(data, col) == val))
+
+    lc = filter_spec.get('lc_thresh')
+    if lc is not None:
+        list_preds.append((f"land-cover specific {lc['col']} thresholds", [lc['col'], lc['lc_col']],
+                           lambda data: get_filter_col(data, lc['col']) < get_lc_h_can_thresh(get_filter_col(data, lc['lc_col']), lc['lc_class_values'], lc['thresh'])))
+
+    for col, val in filter_spec.get('lt', {}).items():
+        list_preds.append((f"{col} < {val}", [col], lambda data, col=col, val=val: get_filter_col(data, col) < val))
+
+    for col, (val_min, val_max) in filter_spec.get('range', {}).items():
+        list_preds.append((f"{col} {val_min}-{val_max}", [col], lambda data, col=col, val_min=val_min, val_max=val_max: 
+                                                                     (get_filter_col(data, col) >= val_min) & (get_filter_col(data, col) <= val_max)))
+
+    list_bbox = filter_spec.get('bbox', [])
+    if len(list_bbox) > 0:
+        def in_bbox(data):
+            lon, lat = get_filter_col(data, 'lon'), get_filter_col(data, 'lat')
+            mask = np.zeros(len(lon), dtype=bool)
+            for minlon, maxlon, minlat, maxlat in list_bbox:
+                mask |= (lon >= minlon) & (lon <= maxlon) & (lat >= minlat) & (lat <= maxlat)
+            return mask
+        list_preds.append((f"bbox {list_bbox}", ['lon', 'lat'], in_bbox))
+
+    if cols is not None:
+        list_preds = [pred for pred in list_preds if all([c in cols for c in pred[1]])]
+    mask_cols = list(dict.fromkeys([c for label, pred_cols, pred in list_preds for c in pred_cols]))
+
+    def mask_func(data, verbose=False, funnel=None):
+        n_rows = len(next(iter(data.values()))) if isinstance(data, dict) else len(data)
+        mask = np.ones(n_rows, dtype=bool)
+        for label, pred_cols, pred in list_preds:
+            mask &= np.asarray(pred(data), dtype=bool)
+            if verbose or funnel is not None:
+                n = int(np.count_nonzero(mask))
+                if funnel is not None:
+                    funnel.append({'stage': label, 'n': n})
+                if verbose:
+                    if label.startswith('land-cover'):
+                        print(f"\tLand cover threshold dictionary: \n{dict(zip(lc['lc_class_values'], lc['thresh']))}")
+                    print(f"\tAfter {label}: \t\t{n} observations in the dataframe.")
+        return mask
+
+    return(mask_func, mask_cols)
+
+def get_filter_spec_expression(filter_spec, schema):
+    '''
+    Return a pyarrow expression of the predicates of a filter spec on the columns of a Parquet schema, for pd.read_parquet(filters=)
+    Row groups that the column statistics show can't pass are skipped, and the rest are filtered as they are read
+    Predicates on columns not in the file (eg, beam_type and m, derived by prep_filter_atl08_qual) or of another type are left out
+    Returns None if no predicate can be pushed down
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    def comparable(col, val):
+        if col not in schema.names:
+            return False
+        col_type = schema.field(col).type
+        if pa.types.is_dictionary(col_type):
+            col_type = col_type.value_type
+        if isinstance(val, str):
+            return pa.types.is_string(col_type) or pa.types.is_large_string(col_type)
+        return pa.types.is_integer(col_type) or pa.types.is_floating(col_type)
+
+    list_expr = []
+    for col, val in filter_spec.get('eq', {}).items():
+        if comparable(col, val):
+            list_expr.append(pc.field(col) == val)
+
+    lc = filter_spec.get('lc_thresh')
+    if lc is not None and comparable(lc['col'], 0) and comparable(lc['lc_col'], 0):
+        list_expr.append(functools.reduce(operator.or_, [(pc.field(lc['lc_col']) == lc_val) & (pc.field(lc['col']) < thresh)
+                                                          for lc_val, thresh in dict(zip(lc['lc_class_values'], lc['thresh'])).items()]))
+
+    for col, val in filter_spec.get('lt', {}).items():
+        if comparable(col, val):
+            list_expr.append(pc.field(col) < val)
+
+    for col, (val_min, val_max) in filter_spec.get('range', {}).items():
+        if comparable(col, val_min):
+            list_expr.append((pc.field(col) >= val_min) & (pc.field(col) <= val_max))
+
+    list_bbox = filter_spec.get('bbox', [])
+    if len(list_bbox) > 0 and comparable('lon', 0) and comparable('lat', 0):
+        list_expr.append(functools.reduce(operator.or_, [(pc.field('lon') >= minlon) & (pc.field('lon') <= maxlon) & 
+                                                          (pc.field('lat') >= minlat) & (pc.field('lat') <= maxlat)
+                                                          for minlon, maxlon, minlat, maxlat in list_bbox]))
+
+    if len(list_expr) == 0:
+        return None
+    return(functools.reduce(operator.and_, list_expr))
+
+def read_atl08_input(input_fn, filter_spec=None, filt_cols=[]):
+    '''
+    Return a df of ATL08 obs from a CSV, PARQUET, FEATHER or GEOJSON (or a df, as is)
+    Raises a ValueError for another kind of file
+    A Parquet file with all of the filt_cols (other than the derived ones) is read with the filter spec pushed down
+    '''
+    if isinstance(input_fn, pd.DataFrame):
+        return(input_fn)
+
+    if input_fn.endswith('geojson'):
+        import geopandas as gpd
+        atl08_df = gpd.read(input_fn)
+    elif input_fn.endswith('csv'):
+        atl08_df = pd.read_csv(input_fn)
+    elif input_fn.endswith('parquet'):
+        filters = None
+        if filter_spec is not None:
+            import pyarrow.parquet as pq
+            schema = pq.read_schema(input_fn)
+            # With a filter column missing the df is returned unfiltered, so nothing is pushed down
+            if all([col in schema.names or col in PREP_COLS for col in filt_cols]):
+                filters = get_filter_spec_expression(filter_spec, schema)
+        if filters is not None:
+            print(f"\tParquet filter pushdown on: {[col for col in get_filter_spec_cols(filter_spec) if col in schema.names]}")
+        atl08_df = pd.read_parquet(input_fn, filters=filters)
+    elif input_fn.endswith('feather'):
+        atl08_df = pd.read_feather(input_fn)
+    else:
+        raise ValueError(f"Input filename must be a CSV, PARQUET, FEATHER, GEOJSON, or pd.DataFrame: {input_fn}")
+    return(atl08_df)
+
+def filter_atl08_spec(input_fn=None, filter_spec='v4', 
+                      subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh85','rh90','rh95','h_can','h_max_can','sol_el','seg_landcov'], 
+                      filt_cols=None, SUBSET_COLS=True, DO_PREP=True, funnel=None):
+    '''
+    Quality filtering with a filter spec: a dict, a preset name (v1-v4) or a JSON file or string (see read_filter_spec)
+    The spec is compiled into one row mask, and the df is indexed once (keeping its row order)
+        filt_cols: columns needed besides those of the spec; with any of them missing, no filtering is done
+        funnel: a dict to fill with the filter funnel: the obs in (n_input), the obs left after each stage of the spec (stages)
+                and the obs out (n_output); with filter columns missing, their names (filt_cols_missing). See sum_filter_funnels
+    Raises a ValueError for a bad filter spec, subset cols or input
     Returns a data frame
-    Note: beams 1 & 5 strong (better radiometric perf, sensitive), then beam 3 [NOT IMPLEMENTED]
     '''
-    # TODO: filt col names: make sure you have these in the EPT db
     print("\nFiltering by quality")
-    
+
+    # Raised rather than exiting, so a batch worker records the granule's error and goes on
+    filter_spec = read_filter_spec(filter_spec)
     if not subset_cols_list:
-        print("filter_atl08: Must supply a list of strings matching ATL08 column names returned from the input EPT")
-        os._exit(1) 
-    elif thresh_h_can is None:
-        print("filter_atl08: Must supply a threshold for h_can")
-        os._exit(1)    
-    elif thresh_h_dif is None:
-        print("filter_atl08: Must supply a threshold for h_dif_ref")
-        os._exit(1)
-    elif month_min is None or month_max is None:
-        print("filter_atl08: Must supply a month_min and month_max")
-        os._exit(1)  
-        
-    if input_fn is not None:
-        if not isinstance(input_fn, pd.DataFrame):
-            if input_fn.endswith('geojson'):
-                atl08_df = gpd.read(input_fn)
-            elif input_fn.endswith('csv'):
-                atl08_df = pd.read_csv(input_fn)
-            else:
-                print("Input filename must be a CSV, GEOJSON, or pd.DataFrame")
-                os._exit(1)
-        else:
-            atl08_df = input_fn
-            
+        raise ValueError("filter_atl08_spec: Must supply a list of strings matching ATL08 column that will be used to return a subset")
+
+    filt_cols = list(dict.fromkeys(get_filter_spec_cols(filter_spec) + ([] if filt_cols is None else filt_cols)))
+    atl08_df = read_atl08_input(input_fn, filter_spec, filt_cols)
+
     if DO_PREP:
         # Run the prep to get fields needed (v003)
         atl08_df_prepd = prep_filter_atl08_qual(atl08_df)
     else:
         atl08_df_prepd = atl08_df
-    
-    
+
     # Check that you have the cols that are required for the filter
     filt_cols_not_in_df = [col for col in filt_cols if col not in atl08_df_prepd.columns] 
     if len(filt_cols_not_in_df) > 0:
         print("\tThese filter columns not found in input df: {}".format(filt_cols_not_in_df))
         print("\tNo quality filtering done. Returning original df.")
+        if funnel is not None:
+            funnel.update({'n_input': len(atl08_df), 'filt_cols_missing': filt_cols_not_in_df, 'n_output': len(atl08_df)})
         return(atl08_df)
-    
+
     atl08_df = None
-    
+
     # Filtering
     #
-    
+    print(f"\tBefore quality filtering: \t\t{atl08_df_prepd.shape[0]} observations in the input dataframe.")
+
+    # Each stage's count comes from the running mask; no df is made for a stage
+    list_stages = []
+    mask_func, mask_cols = compile_filter_spec(filter_spec)
+    mask = mask_func(atl08_df_prepd, verbose=True, funnel=list_stages)
+    print(f"\tAfter all quality filtering: \t\t{np.count_nonzero(mask)} observations in the output dataframe.")
+    if funnel is not None:
+        funnel.update({'n_input': len(atl08_df_prepd), 'n_output': int(np.count_nonzero(mask))})
+        funnel['stages'] = funnel.get('stages', []) + list_stages
+
+    print("\tReturning a pandas data frame.")
+    if SUBSET_COLS:
+        subset_cols_list = ['lon','lat'] + subset_cols_list
+        atl08_df_filt = atl08_df_prepd.loc[mask, subset_cols_list]
+        print("\tFiltered obs. for columns: {}".format(subset_cols_list))
+        print(f"\tData frame shape: {atl08_df_filt.shape} ")
+        return(atl08_df_filt)
+    else:
+        print("\tFiltered obs. for all columns")
+        return(atl08_df_prepd[mask])
+
+def sum_filter_funnels(list_funnels, keys=['domain', 'segment_length']):
+    '''
+    Sum the filter funnels (see filter_atl08_spec) of many granules, eg of a batch, for each combination of the keys and stages
+    The obs counts and the count of each stage are summed, so funnels of one filter spec add up (a granule the quality filter
+    was skipped for, eg for a missing column, has other stages and is summed apart)
+    Returns a list of funnels, each with the number of granules (n_granules) summed into it
+    '''
+    dict_sums = {}
+    for funnel in list_funnels:
+        key = json.dumps([funnel.get(k) for k in keys] + [[stage['stage'] for stage in funnel.get('stages', [])]])
+        if key not in dict_sums:
+            dict_sums[key] = {**{k: funnel.get(k) for k in keys}, 'n_granules': 0, 'stages': {}}
+        dict_sum = dict_sums[key]
+        dict_sum['n_granules'] += funnel.get('n_granules', 1) # sums of batches add up too
+        for k, val in funnel.items():
+            if k.startswith('n_') and k != 'n_granules' and isinstance(val, (int, float)):
+                dict_sum[k] = dict_sum.get(k, 0) + val
+        for stage in funnel.get('stages', []):
+            dict_sum['stages'][stage['stage']] = dict_sum['stages'].get(stage['stage'], 0) + stage['n']
+
+    list_sums = []
+    for dict_sum in dict_sums.values():
+        dict_sum['stages'] = [{'stage': stage, 'n': n} for stage, n in dict_sum['stages'].items()]
+        list_sums.append(dict_sum)
+    return(list_sums)
+
+def filter_atl08_qual(input_fn=None, subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh85','rh90','rh95','h_can','h_max_can'], filt_cols =['h_can','h_dif_ref','m','msw_flg','beam_type','seg_snow'], thresh_h_can=None, thresh_h_dif=None, month_min=None, month_max=None, SUBSET_COLS=True, DO_PREP=True):
+    '''
+    Quality filtering Function
+    Returns a data frame
+    Note: beams 1 & 5 strong (better radiometric perf, sensitive), then beam 3 [NOT IMPLEMENTED]
+    '''
     # Filter list (keep):
     #   h_ref_diff < thresh_h_dif
     #   h_can < thresh_h_can
@@ -303,42 +643,9 @@ def filter_atl08_qual(input_fn=None, subset_cols_list=['rh25','rh50','rh60','rh7
     #   strong beam
     #   summer (june - mid sept)
     #   seg_snow == 'snow free land'
-        
-    #print("\nFiltering for quality:\n\tfor clear skies + strong beam + snow free land,\n\th_can < {},\n\televation diff from ref < {},\n\tmonths {}-{}".format(thresh_h_can, thresh_h_dif, month_min, month_max))
-    print(f"\tBefore quality filtering: \t\t{atl08_df_prepd.shape[0]} observations in the input dataframe.")
-    
-    # Static quality filter flags for ABoVE AGB
-    filt_params_static = [
-                             ['msw_flg',0],
-                             ['beam_type', 'Strong'],
-                             ['seg_snow' , 1] #'snow free land'
-                        ]
-
-    atl08_df_filt = atl08_df_prepd
-    for flag, val in filt_params_static:
-        atl08_df_filt = atl08_df_filt[atl08_df_filt[flag] == val]
-        print(f"\tAfter {flag}={val}:\t\t{atl08_df_filt.shape[0]} observations in the dataframe.")
-    
-    atl08_df_filt =  atl08_df_filt[
-                                (atl08_df_filt.h_can < thresh_h_can) &
-                                (atl08_df_filt.h_dif_ref < thresh_h_dif) &
-                                (atl08_df_filt.m >= month_min ) & 
-                                (atl08_df_filt.m <= month_max) 
-                    ]    
-    
-    print(f"\tAfter all quality filtering: \t\t{atl08_df_filt.shape[0]} observations in the output dataframe.")
-    
-    atl08_df_prepd = None
-    
-    print("\tReturning a pandas data frame.")
-    if SUBSET_COLS:
-        subset_cols_list = ['lon','lat'] + subset_cols_list
-        print("\tFiltered obs. for columns: {}".format(subset_cols_list))
-        print(f"\tData frame shape: {atl08_df_filt[subset_cols_list].shape} ")
-        return(atl08_df_filt[subset_cols_list])
-    else:
-        print("\tFiltered obs. for all columns")
-        return(atl08_df_filt)
+    filter_spec = get_filter_spec({'h_dif_ref': thresh_h_dif}, thresh_h_can=thresh_h_can, month_min=month_min, month_max=month_max)
+
+    return(filter_atl08_spec(input_fn, filter_spec, subset_cols_list=subset_cols_list, filt_cols=filt_cols, SUBSET_COLS=SUBSET_COLS, DO_PREP=DO_PREP))
     
 def filter_atl08_qual_v2(input_fn=None, subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh85','rh90','rh95','h_can','h_max_can'], filt_cols =['h_can','h_dif_ref','m','msw_flg','beam_type','seg_snow', 'sig_topo'], thresh_sig_topo=None, thresh_h_can=None, thresh_h_dif=None, month_min=None, month_max=None, SUBSET_COLS=True, DO_PREP=True):
     '''
@@ -346,97 +653,14 @@ def filter_atl08_qual_v2(input_fn=None, subset_cols_list=['rh25','rh50','rh60','
     Returns a data frame
     Note: beams 1 & 5 strong (better radiometric perf, sensitive), then beam 3 [NOT IMPLEMENTED]
     '''
-    # TODO: filt col names: make sure you have these in the EPT db
-    print("\nFiltering by quality")
-    
-    if not subset_cols_list:
-        print("filter_atl08: Must supply a list of strings matching ATL08 column names returned from the input EPT")
-        os._exit(1) 
-    elif thresh_h_can is None:
-        print("filter_atl08: Must supply a threshold for h_can")
-        os._exit(1)    
-    elif thresh_h_dif is None:
-        print("filter_atl08: Must supply a threshold for h_dif_ref")
-        os._exit(1)
-    elif month_min is None or month_max is None:
-        print("filter_atl08: Must supply a month_min and month_max")
-        os._exit(1)  
-        
-    if input_fn is not None:
-        if not isinstance(input_fn, pd.DataFrame):
-            if input_fn.endswith('geojson'):
-                atl08_df = gpd.read(input_fn)
-            elif input_fn.endswith('csv'):
-                atl08_df = pd.read_csv(input_fn)
-            else:
-                print("Input filename must be a CSV, GEOJSON, or pd.DataFrame")
-                os._exit(1)
-        else:
-            atl08_df = input_fn
-            
-    if DO_PREP:
-        # Run the prep to get fields needed (v003)
-        atl08_df_prepd = prep_filter_atl08_qual(atl08_df)
-    else:
-        atl08_df_prepd = atl08_df
-    
-    
-    # Check that you have the cols that are required for the filter
-    filt_cols_not_in_df = [col for col in filt_cols if col not in atl08_df_prepd.columns] 
-    if len(filt_cols_not_in_df) > 0:
-        print("\tThese filter columns not found in input df: {}".format(filt_cols_not_in_df))
-        print("\tNo quality filtering done. Returning original df.")
-        return(atl08_df)
-    
-    atl08_df = None
-    
-    # Filtering
-    #
-    print(f"\tBefore quality filtering: \t\t{atl08_df_prepd.shape[0]} observations in the input dataframe.")
-    
-    # Static quality filter flags for ABoVE AGB
-    filt_params_static = [
-                             ['msw_flg',0],
-                             ['beam_type', 'Strong'],
-                             ['seg_snow' , 1]#,
-                             #['night_flg', 1]
-                        ]
-    
-    #Better way to filter, but not implemented b/c wouldnt provide incremental filter reductions print outs
-    #filt_params_static = {'msw_flg':0, 'beam_type':'Strong', 'seg_snow':1, 'night_flg':1}
-    #atl08_df_filt = atl08_df_filt.loc[(atl08_df_filt[list(filt_params_static)] == pd.Series(filt_params_static)).all(axis=1)]
-    
-    atl08_df_filt = atl08_df_prepd
-    for flag, val in filt_params_static:
-        atl08_df_filt = atl08_df_filt[atl08_df_filt[flag] == val]
-        print(f"\tAfter {flag}={val}: \t\t{atl08_df_filt.shape[0]} observations in the dataframe.")
-    
-    atl08_df_filt =  atl08_df_filt[
-                                (atl08_df_filt.sig_topo < thresh_sig_topo) &
-                                (atl08_df_filt.h_can < thresh_h_can) &
-                                (atl08_df_filt.h_dif_ref < thresh_h_dif) &
-                                (atl08_df_filt.m >= month_min ) & 
-                                (atl08_df_filt.m <= month_max) 
-                    ]    
-    
-    print(f"\tAfter all quality filtering: \t\t{atl08_df_filt.shape[0]} observations in the output dataframe.")
-    
-    atl08_df_prepd = None
-    
-    print("\tReturning a pandas data frame.")
-    if SUBSET_COLS:
-        subset_cols_list = ['lon','lat'] + subset_cols_list
-        print("\tFiltered obs. for columns: {}".format(subset_cols_list))
-        print(f"\tData frame shape: {atl08_df_filt[subset_cols_list].shape} ")
-        return(atl08_df_filt[subset_cols_list])
-    else:
-        print("\tFiltered obs. for all columns")
-        return(atl08_df_filt)
+    filter_spec = get_filter_spec({'sig_topo': thresh_sig_topo, 'h_dif_ref': thresh_h_dif}, thresh_h_can=thresh_h_can, month_min=month_min, month_max=month_max)
+
+    return(filter_atl08_spec(input_fn, filter_spec, subset_cols_list=subset_cols_list, filt_cols=filt_cols, SUBSET_COLS=SUBSET_COLS, DO_PREP=DO_PREP))
     
 def filter_atl08_qual_v3(input_fn=None, 
                          subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh85','rh90','rh95','h_can','h_max_can','sol_el','seg_landcov'], 
                          filt_cols =['h_can', 'h_can_unc','h_dif_ref','m','msw_flg','beam_type','seg_snow', 'sig_topo','seg_cover','sol_el','seg_landcov'], 
-                         list_lc_class_values=[0, 111, 113, 112, 114, 115, 116, 121, 123, 122, 124, 125, 126, 20, 30, 90, 100, 60, 40, 50, 70, 80, 200],
+                         list_lc_class_values=LIST_LC_CLASS_VALUES,
                          list_lc_h_can_thresh=None,
                          thresh_sig_topo=None, thresh_h_dif=None, 
                          thresh_h_can = 100,
@@ -452,83 +676,7 @@ def filter_atl08_qual_v3(input_fn=None,
     Returns a data frame
     Note: beams 1 & 5 strong (better radiometric perf, sensitive), then beam 3 [NOT IMPLEMENTED]
     '''
-    # TODO: filt col names: make sure you have these in the EPT db
-    print("\nFiltering by quality")
-    
-    if not subset_cols_list:
-        print("filter_atl08_qual_v3: Must supply a list of strings matching ATL08 column that will be used to return a subset")
-        os._exit(1) 
-    elif thresh_h_can and list_lc_h_can_thresh is None:
-        print("filter_atl08_qual_v3: Must supply one of these: a threshold for h_can, or a land cover-specific list of h_can thresholds")
-        os._exit(1)    
-    elif thresh_h_dif is None:
-        print("filter_atl08_qual_v3: Must supply a threshold for h_dif_ref")
-        os._exit(1)
-    elif month_min is None or month_max is None:
-        print("filter_atl08_qual_v3: Must supply a month_min and month_max")
-        os._exit(1)  
-        
-    if input_fn is not None:
-        if not isinstance(input_fn, pd.DataFrame):
-            if input_fn.endswith('geojson'):
-                atl08_df = gpd.read(input_fn)
-            elif input_fn.endswith('csv'):
-                atl08_df = pd.read_csv(input_fn)
-            else:
-                print("Input filename must be a CSV, GEOJSON, or pd.DataFrame")
-                os._exit(1)
-        else:
-            atl08_df = input_fn
-            
-    if DO_PREP:
-        # Run the prep to get fields needed (v003)
-        atl08_df_prepd = prep_filter_atl08_qual(atl08_df)
-    else:
-        atl08_df_prepd = atl08_df
-    
-    
-    # Check that you have the cols that are required for the filter
-    filt_cols_not_in_df = [col for col in filt_cols if col not in atl08_df_prepd.columns] 
-    if len(filt_cols_not_in_df) > 0:
-        print("\tThese filter columns not found in input df: {}".format(filt_cols_not_in_df))
-        print("\tNo quality filtering done. Returning original df.")
-        return(atl08_df)
-    
-    atl08_df = None
-    
-    # Filtering
-    #
-    print(f"\tBefore quality filtering: \t\t{atl08_df_prepd.shape[0]} observations in the input dataframe.")
-                        
-    # Return a df prep'd for filtering
-    atl08_df_filt = atl08_df_prepd
-    
-    # [1] Filter using basic flags
-    #
-    # Static quality filter flags
-    filt_params_static = [
-                             ['msw_flg', 0],
-                             ['beam_type', 'Strong'],
-                             ['seg_snow' , 1]
-                        ]
-    # Apply filter
-    for flag, val in filt_params_static:
-        atl08_df_filt = atl08_df_filt[atl08_df_filt[flag] == val]
-        print(f"\tAfter {flag}={val}: \t\t{atl08_df_filt.shape[0]} observations in the dataframe.")
-        
-    # [2] Filter with h_can thresholds
-    if list_lc_h_can_thresh is None:
-        atl08_df_filt = atl08_df_filt[atl08_df_filt.h_can < thresh_h_can]
-        print(f"\tAfter basic h_can threshold: \t\t{atl08_df_filt.shape[0]} observations in the dataframe.")
-    else:
-        
-        dict_lc_h_can_thresh = dict(zip(list_lc_class_values, list_lc_h_can_thresh))
-        print(f"\tLand cover threshold dictionary: \n{dict_lc_h_can_thresh}")
-        atl08_df_filt = pd.concat([atl08_df_filt[(atl08_df_filt.seg_landcov == lc_val) & (atl08_df_filt.h_can < thresh_h_can)] for lc_val, thresh_h_can in dict_lc_h_can_thresh.items()])
-        print(f"\tAfter land-cover specific h_can thresholds: \t\t{atl08_df_filt.shape[0]} observations in the dataframe.")
-      
-    # [3] Filter using misc thresholds (global; eg not LC-specific)
-    #
+    # Misc thresholds (global; eg not LC-specific)
     # Obs LESS than these values will remain
     dict_misc_thresh = {#'h_te_unc': 5, 
                         'h_can_unc': thresh_h_can_unc, 
@@ -537,30 +685,10 @@ def filter_atl08_qual_v3(input_fn=None,
                         'sig_topo': thresh_sig_topo,
                         'h_dif_ref': thresh_h_dif
                         }
-    # Apply filter
-    atl08_df_filt = atl08_df_filt.loc[(atl08_df_filt[list(dict_misc_thresh)] < pd.Series(dict_misc_thresh)).all(axis=1)] 
-    print(f"\tAfter h_can_unc <{thresh_h_can_unc}, seg_cover<{thresh_seg_cov}, sol_el<{thresh_sol_el}, sig_topo<{thresh_sig_topo}, h_dif_ref<{thresh_h_dif}: \t\t{atl08_df_filt.shape[0]} observations in the dataframe.")
-    
-    # [4] Filter using min and max months
-    #
-    atl08_df_filt =  atl08_df_filt[
-                                (atl08_df_filt.m >= month_min ) & 
-                                (atl08_df_filt.m <= month_max) 
-                                    ]    
-    print(f"\tAfter month filters: {month_min}-{month_max}")
-    print(f"\tAfter all quality filtering: \t\t{atl08_df_filt.shape[0]} observations in the output dataframe.")
-    
-    atl08_df_prepd = None
-    
-    print("\tReturning a pandas data frame.")
-    if SUBSET_COLS:
-        subset_cols_list = ['lon','lat'] + subset_cols_list
-        print("\tFiltered obs. for columns: {}".format(subset_cols_list))
-        print(f"\tData frame shape: {atl08_df_filt[subset_cols_list].shape} ")
-        return(atl08_df_filt[subset_cols_list])
-    else:
-        print("\tFiltered obs. for all columns")
-        return(atl08_df_filt)
+    filter_spec = get_filter_spec(dict_misc_thresh, list_lc_h_can_thresh=list_lc_h_can_thresh, thresh_h_can=thresh_h_can, 
+                                  month_min=month_min, month_max=month_max, list_lc_class_values=list_lc_class_values)
+
+    return(filter_atl08_spec(input_fn, filter_spec, subset_cols_list=subset_cols_list, filt_cols=filt_cols, SUBSET_COLS=SUBSET_COLS, DO_PREP=DO_PREP))
     
 def filter_atl08_qual_v4(input_fn=None, 
                          subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh85','rh90','rh95','h_can','h_max_can','sol_el','seg_landcov'], 
@@ -572,7 +700,7 @@ def filter_atl08_qual_v4(input_fn=None,
                                                     'sig_topo':  2.5,
                                                     'h_dif_ref': 25
                                                     },
-                         list_lc_class_values=[0, 111, 113, 112, 114, 115, 116, 121, 123, 122, 124, 125, 126, 20, 30, 90, 100, 60, 40, 50, 70, 80, 200],
+                         list_lc_class_values=LIST_LC_CLASS_VALUES,
                          list_lc_h_can_thresh=None,
                          #thresh_sig_topo=None, thresh_h_dif=None, 
                          thresh_h_can = 100,
@@ -590,102 +718,16 @@ def filter_atl08_qual_v4(input_fn=None,
     Returns a data frame
     Note: beams 1 & 5 strong (better radiometric perf, sensitive), then beam 3 [NOT IMPLEMENTED]
     '''
-    # TODO: filt col names: make sure you have these in the EPT db
-    print("\nFiltering by quality")
-    
-    if not subset_cols_list:
-        print("filter_atl08_qual_v4: Must supply a list of strings matching ATL08 column that will be used to return a subset")
-        os._exit(1) 
-    elif thresh_h_can and list_lc_h_can_thresh is None:
-        print("filter_atl08_qual_v4: Must supply one of these: a threshold for h_can, or a land cover-specific list of h_can thresholds")
-        os._exit(1)    
-    elif month_min is None or month_max is None:
-        print("filter_atl08_qual_v4: Must supply a month_min and month_max")
-        os._exit(1)  
-        
-    if input_fn is not None:
-        if not isinstance(input_fn, pd.DataFrame):
-            if input_fn.endswith('geojson'):
-                atl08_df = gpd.read(input_fn)
-            elif input_fn.endswith('csv'):
-                atl08_df = pd.read_csv(input_fn)
-            else:
-                print("Input filename must be a CSV, GEOJSON, or pd.DataFrame")
-                os._exit(1)
-        else:
-            atl08_df = input_fn
-            
-    if DO_PREP:
-        # Run the prep to get fields needed (v003)
-        atl08_df_prepd = prep_filter_atl08_qual(atl08_df)
-    else:
-        atl08_df_prepd = atl08_df
-    
-    
-    # Check that you have the cols that are required for the filter
-    filt_cols_not_in_df = [col for col in filt_cols if col not in atl08_df_prepd.columns] 
-    if len(filt_cols_not_in_df) > 0:
-        print("\tThese filter columns not found in input df: {}".format(filt_cols_not_in_df))
-        print("\tNo quality filtering done. Returning original df.")
-        return(atl08_df)
-    
-    atl08_df = None
-    
-    # Filtering
-    #
-    print(f"\tBefore quality filtering: \t\t{atl08_df_prepd.shape[0]} observations in the input dataframe.")
-                        
-    # Return a df prep'd for filtering
-    atl08_df_filt = atl08_df_prepd
-    
-    # [1] Filter using basic flags
-    #
-    # Static quality filter flags
-    filt_params_static = [
-                             ['msw_flg', 0],
-                             ['beam_type', 'Strong'],
-                             ['seg_snow' , 1]
-                        ]
-    # Apply filter
-    for flag, val in filt_params_static:
-        atl08_df_filt = atl08_df_filt[atl08_df_filt[flag] == val]
-        print(f"\tAfter {flag}={val}: \t\t{atl08_df_filt.shape[0]} observations in the dataframe.")
-        
-    # [2] Filter with h_can thresholds
-    if list_lc_h_can_thresh is None:
-        atl08_df_filt = atl08_df_filt[atl08_df_filt.h_can < thresh_h_can]
-        print(f"\tAfter basic h_can threshold: \t\t{atl08_df_filt.shape[0]} observations in the dataframe.")
-    else:
-        
-        dict_lc_h_can_thresh = dict(zip(list_lc_class_values, list_lc_h_can_thresh))
-        print(f"\tLand cover threshold dictionary: \n{dict_lc_h_can_thresh}")
-        atl08_df_filt = pd.concat([atl08_df_filt[(atl08_df_filt.seg_landcov == lc_val) & (atl08_df_filt.h_can < thresh_h_can)] for lc_val, thresh_h_can in dict_lc_h_can_thresh.items()])
-        print(f"\tAfter land-cover specific h_can thresholds: \t\t{atl08_df_filt.shape[0]} observations in the dataframe.")
-      
-    # [3] Filter using misc thresholds (global; eg not LC-specific)
-    #
-    # Obs LESS than these values will remain
-    # Apply filter
-    atl08_df_filt = atl08_df_filt.loc[(atl08_df_filt[list(filt_dict_misc_thresh)] < pd.Series(filt_dict_misc_thresh)).all(axis=1)] 
-    print(f"\tAfter misc thresholding with {[f'{k} < {v}' for k, v in filt_dict_misc_thresh.items()]}: \t\t{atl08_df_filt.shape[0]} observations in the output dataframe.")
-    
-    # [4] Filter using min and max months
-    #
-    atl08_df_filt =  atl08_df_filt[
-                                (atl08_df_filt.m >= month_min ) & 
-                                (atl08_df_filt.m <= month_max) 
-                                    ]    
-    print(f"\tAfter month filters: {month_min}-{month_max}")
-    print(f"\tAfter all quality filtering: \t\t{atl08_df_filt.shape[0]} observations in the output dataframe.")
-    
-    atl08_df_prepd = None
-    
-    print("\tReturning a pandas data frame.")
-    if SUBSET_COLS:
-        subset_cols_list = ['lon','lat'] + subset_cols_list
-        print("\tFiltered obs. for columns: {}".format(subset_cols_list))
-        print(f"\tData frame shape: {atl08_df_filt[subset_cols_list].shape} ")
-        return(atl08_df_filt[subset_cols_list])
-    else:
-        print("\tFiltered obs. for all columns")
-        return(atl08_df_filt)
\ No newline at end of file
+    filter_spec = get_filter_spec(filt_dict_misc_thresh, list_lc_h_can_thresh=list_lc_h_can_thresh, thresh_h_can=thresh_h_can, 
+                                  month_min=month_min, month_max=month_max, list_lc_class_values=list_lc_class_values)
+
+    return(filter_atl08_spec(input_fn, filter_spec, subset_cols_list=subset_cols_list, filt_cols=filt_cols, SUBSET_COLS=SUBSET_COLS, DO_PREP=DO_PREP))
+
+def get_lc_h_can_thresh(seg_landcov, list_lc_class_values, list_lc_h_can_thresh):
+    '''
+    Return the h_can threshold of each obs from its land cover class, with a lookup of the class values
+    Obs of a class not in list_lc_class_values (or with no land cover) get -inf, so they fail any h_can threshold
+    '''
+    dict_lc_h_can_thresh = dict(zip(list_lc_class_values, list_lc_h_can_thresh))
+    idx = pd.Index(list(dict_lc_h_can_thresh)).get_indexer(np.asarray(seg_landcov))
+    return(np.append(np.array(list(dict_lc_h_can_thresh.values()), dtype='float64'), -np.inf)[idx])
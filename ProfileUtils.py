@@ -0,0 +1,91 @@
+'''
+Phase timers for profiling the extraction of an ATL08 granule (see --profile of extract_filter_atl08_v005.py).
+A profile is a plain dict of one granule: its phases (wall time, CPU time and peak RSS of each) and its totals.
+It is written as one JSON line per granule, and summarize_profile_atl08.py gives the percentiles of each phase over a batch.
+Every function takes profile=None as a no-op, so the phases cost nothing when profiling is off.
+'''
+import os, sys
+import time
+import json
+import resource
+from contextlib import contextmanager
+
+def get_peak_rss_mb():
+    '''
+    Return the peak resident set size of this process so far, in MB (ru_maxrss is in KB on Linux, in bytes on macOS)
+    '''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return(round(maxrss / (1024**2 if sys.platform == 'darwin' else 1024), 1))
+
+def get_phase_start():
+    '''
+    Return the wall clock, CPU clock and peak RSS a phase starts from
+    '''
+    return((time.perf_counter(), time.process_time(), get_peak_rss_mb()))
+
+def get_phase(name, output, phase_start):
+    '''
+    Return the record of a phase that began at phase_start (see get_phase_start) and ends now
+    '''
+    wall, cpu, peak_rss = phase_start
+    peak_rss_end = get_peak_rss_mb()
+    return({'phase': name, 'output': output,
+            'wall_s': round(time.perf_counter() - wall, 4), 'cpu_s': round(time.process_time() - cpu, 4),
+            'peak_rss_mb': peak_rss_end, 'peak_rss_growth_mb': round(peak_rss_end - peak_rss, 1)})
+
+def start_profile(granule_name):
+    '''
+    Return a new profile of a granule; its totals and its first lap run from now
+    '''
+    return({'granule_name': granule_name, 'begin': time.strftime('%Y-%m-%dT%H:%M:%S'), 'pid': os.getpid(), 'phases': [],
+            '_start': get_phase_start(), '_lap': get_phase_start()})
+
+def lap(profile, name, output=None):
+    '''
+    End the current phase of a profile, named name, and start the next one (like the lap button of a stopwatch)
+    The phases of a script are then marked without re-indenting it: each lap is the time since the last one
+        output: the output (eg, '100m' or 'howland/20m') of a phase run for each output
+    '''
+    if profile is None:
+        return
+    profile['phases'].append(get_phase(name, output, profile['_lap']))
+    profile['_lap'] = get_phase_start()
+
+@contextmanager
+def phase(profile, name, output=None):
+    '''
+    Time a block as a phase of a profile: with ProfileUtils.phase(profile, 'read/join_beams'): ...
+    Records the wall and CPU seconds of the phase, the peak RSS at its end, and how much it raised the peak (peak_rss_growth_mb)
+    A phase inside of a lap is named <lap>/<phase>; its time is also in that of the lap
+    '''
+    if profile is None:
+        yield
+        return
+    phase_start = get_phase_start()
+    try:
+        yield
+    finally:
+        profile['phases'].append(get_phase(name, output, phase_start))
+
+def end_profile(profile, status):
+    '''
+    Add the outcome (status) and totals of a granule to its profile
+    The peak RSS of a batch worker is that of all of its granules so far; peak_rss_growth_mb is the granule's own
+    '''
+    if profile is None or '_start' not in profile:
+        return profile
+    dict_total = get_phase(None, None, profile.pop('_start'))
+    profile.pop('_lap')
+    profile['status'] = status if isinstance(status, str) else 'dataframe'
+    profile.update({key: val for key, val in dict_total.items() if key not in ['phase', 'output']})
+    return profile
+
+def write_profiles(list_profiles, profile_fn, mode='a'):
+    '''
+    Write (append, by default) profiles to a JSON lines file, one line per granule
+    '''
+    if os.path.dirname(profile_fn) != '':
+        os.makedirs(os.path.dirname(profile_fn), exist_ok=True)
+    with open(profile_fn, mode) as f:
+        for profile in list_profiles:
+            f.write(json.dumps(profile) + '\n')
@@ -0,0 +1,778 @@
+'''
+The merged ATL08 store: a hive partitioned Parquet dataset of the extractor outputs of many granules (see merge_atl08.py).
+Reading and schema checks of the extractor outputs (CSV, Parquet, Feather) are shared by the full merge and the appends.
+An appendable store (merge_atl08.py --append) keeps the rows of each granule in their own files:
+    <store>/<partition col>=<value>/.../<granule name>-<write id>-<i>.parquet
+    <store>/_common_metadata: the schema of the store (all columns, incl. the partition columns)
+    <store>/_manifest.json:   the granules in the store: name, version, filter config hash, source output and files
+so that new granules are added as new files, and a granule that is merged again replaces only its own files.
+The small files of the appends are compacted (compact_atl08.py) into files of a target size in each partition:
+    <store>/<partition col>=<value>/.../compact-<write id>-<i>.parquet
+with the lineage of their rows ([granule name, first row, rows] of each granule) in the manifest and in the file footer.
+Readers should read the files listed by the manifest (open_store), as an append or compaction may be under way.
+A store can be laid out on a fixed lat/lon grid: a tile column (see get_tile_ids) as its first partition column, eg
+    <store>/tile=<tile>/y=<year>/...
+and the manifest keeps a zone map of each file (min/max of lat, lon, seg_landcov and the dates), so that a bbox and date
+query (query_store) opens only the partitions and files that may have its rows.
+'''
+import os
+import json
+import time
+import hashlib
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+import numpy as np
+import pyarrow as pa
+
+import ExtractUtils
+import FilterUtils
+
+INPUT_FORMATS = ['csv', 'parquet', 'feather']
+
+def get_col_type(col):
+    '''
+    Return the arrow type of an extracted column from the schema, or None for a column that isn't in it
+    '''
+    if col in ExtractUtils.CATEGORICAL_COLS:
+        return pa.string()
+    for dict_dtypes in [{c: d['dtype'] for c, d in ExtractUtils.ATL08_SCHEMA.items()}, ExtractUtils.COL_DTYPES, FilterUtils.DT_PART_DTYPES]:
+        if col in dict_dtypes:
+            return pa.from_numpy_dtype(np.dtype(dict_dtypes[col]))
+    return None
+
+def get_input_version(fn):
+    '''
+    Return the product version of an output from its name (eg, ATL08_20181226222354_13640102_005_01_100m.csv -> 5), or None
+    '''
+    try:
+        return(ExtractUtils.parse_granule_name(fn)['version'])
+    except (ValueError, IndexError):
+        return None
+
+def list_merge_inputs(indir, search_str):
+    '''
+    Return the outputs of indir (not its subdirs) whose names end with <search_str>.<csv|parquet|feather>, sorted
+    '''
+    return(sorted([os.path.join(indir, fn) for fn in os.listdir(indir)
+                   if any([fn.endswith(f'{search_str}.{ext}') for ext in INPUT_FORMATS])]))
+
+# Derived columns (see FilterUtils.get_prep_cols) added to the inputs that don't have them (eg, outputs of --no-filter-qual)
+# but have the columns they are derived from, so that the merge can be partitioned, queried and filtered (filter specs) by them
+MERGE_PREP_COLS = ['beam_type', 'y', 'm', 'd', 'doy']
+
+def get_input_prep_cols(names):
+    '''
+    Return the derived columns (MERGE_PREP_COLS) that an input with columns names doesn't have but can be given
+    '''
+    list_cols = []
+    for col in MERGE_PREP_COLS:
+        if col in names:
+            continue
+        if (col == 'beam_type' and 'gt' in names and 'orb_orient' in names) or (col in FilterUtils.DT_PART_DTYPES and 'dt' in names):
+            list_cols.append(col)
+    return list_cols
+
+def read_input_schema(fn):
+    '''
+    Return the arrow schema of an input: read from the footer of a Parquet/Feather file, inferred from the first block of a CSV
+    Dictionary (categorical) columns are given their value type; the derived columns it can be given (see get_input_prep_cols) are added
+    '''
+    ext = os.path.splitext(fn)[1][1:]
+    if ext == 'parquet':
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(fn)
+    elif ext == 'feather':
+        import pyarrow.ipc as ipc
+        with pa.memory_map(fn) as source:
+            schema = ipc.open_file(source).schema
+    else:
+        import pyarrow.csv as pcsv
+        with pcsv.open_csv(fn) as reader:
+            schema = reader.schema
+    schema = schema.remove_metadata()
+    list_fields = [pa.field(f.name, f.type.value_type if pa.types.is_dictionary(f.type) else f.type) for f in schema]
+    list_fields += [pa.field(col, get_col_type(col)) for col in get_input_prep_cols(schema.names)]
+    return(pa.schema(list_fields))
+
+def get_merge_schema(list_fn, list_schemas):
+    '''
+    Check the schemas of the inputs against each other and the extraction schema, and return the schema of the merge
+    Returns (schema, dict_missing, dict_conflicts)
+        dict_missing:   {col: {version: number of inputs without it}} of the columns some inputs don't have
+        dict_conflicts: {col: {type: [inputs]}} of the columns whose types can't be cast to one type
+    '''
+    # Columns in the order they first appear
+    cols = list(dict.fromkeys([name for schema in list_schemas for name in schema.names]))
+
+    dict_missing = {}
+    for col in cols:
+        for fn, schema in zip(list_fn, list_schemas):
+            if col not in schema.names:
+                version = get_input_version(fn)
+                dict_missing.setdefault(col, {})
+                dict_missing[col][version] = dict_missing[col].get(version, 0) + 1
+
+    list_fields = []
+    dict_conflicts = {}
+    for col in cols:
+        dict_types = {}
+        for fn, schema in zip(list_fn, list_schemas):
+            if col in schema.names:
+                dict_types.setdefault(schema.field(col).type, []).append(fn)
+        # Numbers (and nulls of an all empty CSV column) cast to the column type; strings and numbers don't mix
+        is_string = lambda t: pa.types.is_string(t) or pa.types.is_large_string(t)
+        list_kinds = set(['string' if is_string(t) else 'null' if pa.types.is_null(t) else 'number' for t in dict_types])
+        col_type = get_col_type(col)
+        if 'string' in list_kinds and 'number' in list_kinds:
+            dict_conflicts[col] = {str(t): fns for t, fns in dict_types.items()}
+        elif list_kinds == set(['string']) and col_type is not None and not is_string(col_type):
+            # eg, flag names (--set_flag_names) in all inputs: keep them as strings
+            col_type = pa.string()
+        if col_type is None:
+            col_type = pa.unify_schemas([pa.schema([(col, t)]) for t in dict_types], promote_options='permissive').field(col).type
+            if pa.types.is_null(col_type):
+                col_type = pa.string()
+        list_fields.append(pa.field(col, col_type))
+
+    return(pa.schema(list_fields), dict_missing, dict_conflicts)
+
+# The fixed lat/lon grid of a spatially partitioned store: tile = row * cols + col of the grid_deg cells from (-90, -180)
+TILE_COL = 'tile'
+GRID_KEY = b'atl08_grid_deg'
+
+def add_tile_col(schema, grid_deg):
+    '''
+    Return a schema with the tile column of a grid (see get_tile_ids); the grid size is kept in the schema metadata
+    '''
+    if TILE_COL not in schema.names:
+        schema = schema.append(pa.field(TILE_COL, pa.int32()))
+    return(schema.with_metadata({**(schema.metadata or {}), GRID_KEY: str(grid_deg).encode('utf-8')}))
+
+def get_grid_deg(schema):
+    '''
+    Return the grid size (degrees) of the tile column of a schema, or None if it has none
+    '''
+    if TILE_COL not in schema.names or schema.metadata is None or GRID_KEY not in schema.metadata:
+        return None
+    return(float(schema.metadata[GRID_KEY]))
+
+def get_tile_ids(lat, lon, grid_deg):
+    '''
+    Return the tiles (int32) of lat/lon arrays on a grid of grid_deg cells
+    '''
+    n_rows, n_cols = int(np.ceil(180 / grid_deg)), int(np.ceil(360 / grid_deg))
+    row = np.clip(np.floor((np.asarray(lat, dtype='float64') + 90) / grid_deg), 0, n_rows - 1).astype('int32')
+    col = np.clip(np.floor((np.asarray(lon, dtype='float64') + 180) / grid_deg), 0, n_cols - 1).astype('int32')
+    return(row * n_cols + col)
+
+def get_bbox_tiles(bbox, grid_deg):
+    '''
+    Return the tiles of a grid that intersect a bbox [minlon, maxlon, minlat, maxlat]
+    '''
+    minlon, maxlon, minlat, maxlat = bbox
+    n_cols = int(np.ceil(360 / grid_deg))
+    row_min, col_min = divmod(int(get_tile_ids(minlat, minlon, grid_deg)), n_cols)
+    row_max, col_max = divmod(int(get_tile_ids(maxlat, maxlon, grid_deg)), n_cols)
+    return([int(row * n_cols + col) for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)])
+
+def get_tile_bbox(tile, grid_deg):
+    '''
+    Return the bbox [minlon, maxlon, minlat, maxlat] of a tile of a grid (see get_tile_ids)
+    '''
+    row, col = divmod(int(tile), int(np.ceil(360 / grid_deg)))
+    return([-180 + col * grid_deg, -180 + (col + 1) * grid_deg, -90 + row * grid_deg, -90 + (row + 1) * grid_deg])
+
+def read_merge_input(fn_schema):
+    '''
+    Worker: read an input and cast it to the schema of the merge; the columns it doesn't have are null
+    The derived columns it doesn't have are derived (see get_input_prep_cols), and the tile column of a spatially
+    partitioned merge (see add_tile_col) is computed from lat/lon
+    '''
+    fn, schema = fn_schema
+    ext = os.path.splitext(fn)[1][1:]
+    if ext == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(fn)
+    elif ext == 'feather':
+        import pyarrow.feather as pf
+        table = pf.read_table(fn)
+    else:
+        import pyarrow.csv as pcsv
+        header = read_input_schema(fn).names
+        table = pcsv.read_csv(fn, convert_options=pcsv.ConvertOptions(column_types={col: schema.field(col).type for col in header}))
+
+    list_prep_cols = [col for col in get_input_prep_cols(table.column_names) if col in schema.names]
+    dict_prep = {}
+    if len(list_prep_cols) > 0:
+        df_src = table.select([col for col in ['gt', 'orb_orient', 'dt'] if col in table.column_names]).to_pandas()
+        dict_prep = FilterUtils.get_prep_cols(df_src, list_prep_cols)
+
+    list_arrays = []
+    for field in schema:
+        if field.name in dict_prep:
+            # NaN (eg, of an obs with no dt) is null
+            arr = pa.array(dict_prep[field.name], from_pandas=True)
+            if pa.types.is_dictionary(arr.type):
+                arr = arr.cast(arr.type.value_type)
+            list_arrays.append(arr.cast(field.type))
+        elif field.name == TILE_COL and field.name not in table.column_names and get_grid_deg(schema) is not None:
+            list_arrays.append(pa.array(get_tile_ids(table.column('lat').to_numpy(), table.column('lon').to_numpy(), get_grid_deg(schema)), type=field.type))
+        elif field.name in table.column_names:
+            arr = table.column(field.name)
+            if pa.types.is_dictionary(arr.type):
+                arr = arr.cast(arr.type.value_type)
+            list_arrays.append(arr.cast(field.type))
+        else:
+            list_arrays.append(pa.nulls(table.num_rows, field.type))
+    return(pa.Table.from_arrays(list_arrays, schema=schema))
+
+MANIFEST_FN = '_manifest.json'
+SCHEMA_FN = '_common_metadata'
+
+def get_output_granule_name(fn):
+    '''
+    Return the granule name of an extractor output, eg ATL08_20181226222354_13640102_005_01_100m.csv -> ATL08_20181226222354_13640102_005_01
+    Raises a ValueError for a file not named after a granule
+    '''
+    ExtractUtils.parse_granule_name(fn)
+    return('_'.join(os.path.basename(fn).split('.')[0].split('_')[:5]))
+
+def get_filter_config(fn):
+    '''
+    Return the filter config of an extractor output, from the filter funnel written next to it (<output name>_funnel.json):
+    the quality filter spec, bbox, segment length and domain; or None if it has no funnel (eg, --no-funnel)
+    '''
+    funnel_fn = os.path.splitext(fn)[0] + '_funnel.json'
+    if not os.path.isfile(funnel_fn):
+        return None
+    with open(funnel_fn) as f:
+        funnel = json.load(f)
+    dict_config = {key: funnel.get(key) for key in ['segment_length', 'domain']}
+    if 'filter_spec' in funnel:
+        dict_config.update({key: funnel.get(key) for key in ['filter_spec', 'bbox']})
+    else:
+        # Funnels written before the spec was recorded: the stage labels have the thresholds and bbox
+        dict_config['stages'] = [stage['stage'] for stage in funnel.get('stages', [])]
+    return dict_config
+
+def get_filter_hash(dict_config):
+    '''
+    Return a short hash of a filter config (see get_filter_config), or None
+    '''
+    if dict_config is None:
+        return None
+    return(hashlib.md5(json.dumps(dict_config, sort_keys=True).encode('utf-8')).hexdigest()[:12])
+
+def read_manifest(store_dir):
+    '''
+    Return the manifest of an appendable store, or None if it has none
+    '''
+    manifest_fn = os.path.join(store_dir, MANIFEST_FN)
+    if not os.path.isfile(manifest_fn):
+        return None
+    with open(manifest_fn) as f:
+        return json.load(f)
+
+def write_manifest(store_dir, manifest):
+    '''
+    Write the manifest of a store under a temp name and rename it, so a reader never sees a partial manifest
+    '''
+    manifest['updated'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    manifest_fn = os.path.join(store_dir, MANIFEST_FN)
+    tmp_fn = f"{manifest_fn}.{os.getpid()}.tmp"
+    with open(tmp_fn, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_fn, manifest_fn)
+
+def read_store_schema(store_dir):
+    '''
+    Return the schema of a store (see SCHEMA_FN)
+    '''
+    import pyarrow.parquet as pq
+    return(pq.read_schema(os.path.join(store_dir, SCHEMA_FN)))
+
+def write_store_schema(store_dir, schema):
+    '''
+    Write the schema of a store as a Parquet metadata file (_common_metadata, as read by most Parquet dataset readers)
+    '''
+    import pyarrow.parquet as pq
+    pq.write_metadata(schema, os.path.join(store_dir, SCHEMA_FN))
+
+def get_store_partitioning(schema, partition_cols):
+    '''
+    Return the hive partitioning of a store (with the types of the partition columns), or None if it isn't partitioned
+    '''
+    import pyarrow.dataset as pds
+    if len(partition_cols) == 0:
+        return None
+    return(pds.partitioning(pa.schema([schema.field(col) for col in partition_cols]), flavor='hive'))
+
+def get_append_schema(store_dir, list_fn, list_schemas, grid_deg=None):
+    '''
+    Return the schema of an append to a store (see get_merge_schema): that of the store, or for a new store that of the inputs
+    (with the tile column of a grid of grid_deg cells, if given; see add_tile_col)
+    Returns (schema, dict_missing, dict_conflicts, list_dropped)
+        list_dropped: the columns of the inputs that an existing store doesn't have (its schema is fixed when it is made)
+    '''
+    if read_manifest(store_dir) is None:
+        schema, dict_missing, dict_conflicts = get_merge_schema(list_fn, list_schemas)
+        if grid_deg is not None:
+            schema = add_tile_col(schema, grid_deg)
+        return(schema, dict_missing, dict_conflicts, [])
+    store_schema = read_store_schema(store_dir)
+    schema, dict_missing, dict_conflicts = get_merge_schema([store_dir] + list_fn, [pa.schema([f for f in store_schema if f.name != TILE_COL])] + list_schemas)
+    return(store_schema, dict_missing, dict_conflicts, [col for col in schema.names if col not in store_schema.names])
+
+def append_granule(dict_task):
+    '''
+    Worker: write the rows of an extractor output to its own files of a store
+    The new files have a new write id, so the files of the granule's previous version (if any) are left as they are:
+    append_store removes them once the manifest lists the new ones
+    Returns the files written (relative to the store), the rows and the old files to remove
+    '''
+    import pyarrow.dataset as pds
+
+    schema, store_dir = dict_task['schema'], dict_task['store_dir']
+    table = read_merge_input((dict_task['fn'], schema))
+
+    list_files = []
+    pds.write_dataset(table, store_dir, schema=schema, format='parquet',
+                      partitioning=get_store_partitioning(schema, dict_task['partition_cols']),
+                      basename_template=dict_task['granule_name'] + '-' + dict_task['write_id'] + '-{i}.parquet',
+                      existing_data_behavior='overwrite_or_ignore',
+                      file_options=pds.ParquetFileFormat().make_write_options(compression='zstd'),
+                      file_visitor=lambda written_file: list_files.append(os.path.relpath(written_file.path, store_dir)))
+
+    return({'granule_name': dict_task['granule_name'], 'files': sorted(list_files), 'n_rows': table.num_rows,
+            'old_files': [fn for fn in dict_task['old_files'] if fn not in list_files]})
+
+def append_store(store_dir, list_fn, schema, partition_cols=['y'], processes=4):
+    '''
+    Append extractor outputs to a store (made if it doesn't exist), one granule at a time, in parallel
+        A granule already in the store from the same source output (same path, mtime and size) and filter config is skipped;
+        one whose output changed (eg, it was extracted again) replaces its own files, and no others
+        (its rows in compacted files, see compact_store, are removed from those files first)
+        schema: of the store (the outputs are cast to it; see get_merge_schema)
+        partition_cols: of a new store (an existing store keeps its own)
+    The manifest is written after each window of granules (or when one fails), so an interrupted append loses no more than that window;
+    the files of a failed granule are orphans that the next compaction removes (see remove_orphan_files)
+    Returns a dict of the number of granules added, replaced and skipped (unchanged)
+    '''
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        os.makedirs(store_dir, exist_ok=True)
+        write_store_schema(store_dir, schema)
+        manifest = {'partition_cols': partition_cols, 'grid_deg': get_grid_deg(schema), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'granules': {}}
+    partition_cols = manifest['partition_cols']
+
+    write_id = time.strftime('%Y%m%d%H%M%S')
+    dict_counts = {'added': 0, 'replaced': 0, 'unchanged': 0}
+    list_tasks = []
+    dict_sources = {}
+    for fn in list_fn:
+        granule_name = get_output_granule_name(fn)
+        if granule_name in dict_sources:
+            print(f"\tMore than one output of {granule_name}; skipping {os.path.basename(fn)} (using {os.path.basename(dict_sources[granule_name]['source'])})")
+            continue
+        st = os.stat(fn)
+        dict_sources[granule_name] = {'version': ExtractUtils.parse_granule_name(fn)['version'],
+                                      'filter_hash': get_filter_hash(get_filter_config(fn)),
+                                      'source': os.path.abspath(fn), 'source_mtime': st.st_mtime, 'source_size': st.st_size}
+        dict_entry = manifest['granules'].get(granule_name)
+        if dict_entry is not None and all([dict_entry.get(key) == val for key, val in dict_sources[granule_name].items()]):
+            dict_counts['unchanged'] += 1
+            continue
+        dict_counts['replaced' if dict_entry is not None else 'added'] += 1
+        list_old_files = [] if dict_entry is None else [fn for fn in dict_entry['files'] if fn not in manifest.get('compacted', {})]
+        if dict_entry is not None and len(list_old_files) < len(dict_entry['files']):
+            # Its rows in compacted files are shared with other granules: those files are rewritten without them
+            remove_compacted_granule(store_dir, manifest, granule_name)
+        list_tasks.append({'fn': fn, 'granule_name': granule_name, 'schema': schema, 'store_dir': store_dir, 'partition_cols': partition_cols,
+                           'write_id': write_id, 'old_files': list_old_files})
+
+    window = processes * 2
+    with Pool(processes=processes) as pool:
+        for i in range(0, len(list_tasks), window):
+            list_results = []
+            try:
+                for dict_result in pool.imap_unordered(append_granule, list_tasks[i:i + window]):
+                    list_results.append(dict_result)
+                    granule_name = dict_result['granule_name']
+                    manifest['granules'][granule_name] = {**dict_sources[granule_name], 'n_rows': dict_result['n_rows'],
+                                                          'files': dict_result['files'], 'added': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            finally:
+                # Also when a granule of the window fails: the manifest keeps the granules written so far,
+                # and the old files of a granule are only removed once the manifest lists its new ones
+                write_manifest(store_dir, manifest)
+                for dict_result in list_results:
+                    for fn in dict_result['old_files']:
+                        if os.path.isfile(os.path.join(store_dir, fn)):
+                            os.remove(os.path.join(store_dir, fn))
+            print(f"\tAppended {min(i + window, len(list_tasks))} of {len(list_tasks)} granules")
+    update_zone_maps(store_dir, manifest)
+    write_manifest(store_dir, manifest)
+
+    list_hashes = set([dict_entry['filter_hash'] for dict_entry in manifest['granules'].values()])
+    if len(list_hashes) > 1:
+        print(f"\tThe store has outputs of {len(list_hashes)} filter configs (filter hashes: {sorted([str(h) for h in list_hashes])})")
+
+    return dict_counts
+
+COMPACT_PREFIX = 'compact'
+LINEAGE_KEY = b'atl08_lineage'
+
+def get_file_granule_name(fn):
+    '''
+    Return the granule of a (not compacted) file of a store: <granule name>-<write id>-<i>.parquet
+    '''
+    return(os.path.basename(fn).split('-')[0])
+
+def get_file_lineage(manifest, fn, n_rows):
+    '''
+    Return the lineage of a file of a store: [[granule name, first row, rows], ...]
+    '''
+    if fn in manifest.get('compacted', {}):
+        return manifest['compacted'][fn]
+    return([[get_file_granule_name(fn), 0, n_rows]])
+
+def get_store_files(store_dir, manifest=None):
+    '''
+    Return the files of a store (relative to it) from its manifest
+    Reading these rather than all files of the store dir skips those of an append or compaction that is still running (or was interrupted)
+    '''
+    if manifest is None:
+        manifest = read_manifest(store_dir)
+    return(sorted(set([fn for dict_entry in manifest['granules'].values() for fn in dict_entry['files']])))
+
+def open_store(store_dir):
+    '''
+    Return a pyarrow dataset of the files of an appendable store (see get_store_files)
+    '''
+    import pyarrow.dataset as pds
+    manifest = read_manifest(store_dir)
+    schema = read_store_schema(store_dir)
+    return(pds.dataset([os.path.join(store_dir, fn) for fn in get_store_files(store_dir, manifest)], schema=schema, format='parquet',
+                       partitioning=get_store_partitioning(schema, manifest['partition_cols']), partition_base_dir=store_dir))
+
+def remove_compacted_granule(store_dir, manifest, granule_name):
+    '''
+    Remove the rows of a granule from the compacted files that hold them (eg, before it is appended again)
+    Each file is rewritten without the granule's rows, under its own name (a temp file is renamed over it), and its lineage is updated
+    The granule is dropped from the manifest, so that if an append stops before its new rows are written, the next one adds it
+    '''
+    import pyarrow.parquet as pq
+    dict_entry = manifest['granules'].pop(granule_name)
+    for fn in [fn for fn in dict_entry['files'] if fn in manifest.get('compacted', {})]:
+        path = os.path.join(store_dir, fn)
+        list_lineage = manifest['compacted'][fn]
+        list_keep = [lineage for lineage in list_lineage if lineage[0] != granule_name]
+        if len(list_keep) == 0:
+            os.remove(path)
+            del manifest['compacted'][fn]
+            manifest.get('zone_maps', {}).pop(fn, None)
+            continue
+        pf = pq.ParquetFile(path)
+        table = pf.read()
+        list_new_lineage, first_row = [], 0
+        for name, row, n_rows in list_keep:
+            list_new_lineage.append([name, first_row, n_rows])
+            first_row += n_rows
+        table = pa.concat_tables([table.slice(row, n_rows) for name, row, n_rows in list_keep])
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), LINEAGE_KEY: json.dumps(list_new_lineage)})
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_path, compression='zstd', write_statistics=True,
+                       row_group_size=max([pf.metadata.row_group(i).num_rows for i in range(pf.metadata.num_row_groups)]))
+        os.replace(tmp_path, path)
+        manifest['compacted'][fn] = list_new_lineage
+        manifest.get('zone_maps', {}).pop(fn, None)
+    write_manifest(store_dir, manifest)
+
+def compact_files(dict_task):
+    '''
+    Worker: write the files of a bin (of one partition of a store) to one compacted file, a row group at a time
+    The rows are ordered by granule name (ie, acq time), each granule one run of rows, also when a granule of a compacted input
+    was appended again and is in a later file; the lineage (granule, first row, rows) is in the footer of the file
+    (key atl08_lineage) and in the manifest
+    Returns the compacted file (relative to the store), its lineage and size
+    '''
+    import pyarrow.parquet as pq
+
+    store_dir, rows_per_group = dict_task['store_dir'], dict_task['rows_per_group']
+    # The runs of rows of each granule, in granule order: (granule, file, first row in the file, rows)
+    list_runs = sorted([(name, fn, row, n_rows) for fn, list_file_lineage in zip(dict_task['files'], dict_task['lineages'])
+                        for name, row, n_rows in list_file_lineage])
+    list_lineage, first_row = [], 0
+    for name, fn, row, n_rows in list_runs:
+        list_lineage.append([name, first_row, n_rows])
+        first_row += n_rows
+
+    out_path = os.path.join(store_dir, dict_task['out_fn'])
+    file_schema = pq.read_schema(os.path.join(store_dir, dict_task['files'][0]))
+    file_schema = file_schema.with_metadata({**(file_schema.metadata or {}), LINEAGE_KEY: json.dumps(list_lineage)})
+    # A file is read when its first run is written, and dropped after its last one
+    dict_last_run = {fn: i for i, (name, fn, row, n_rows) in enumerate(list_runs)}
+    dict_tables = {}
+    list_pending, n_pending = [], 0
+    with pq.ParquetWriter(out_path, file_schema, compression='zstd', write_statistics=True) as writer:
+        for i, (name, fn, row, n_rows) in enumerate(list_runs):
+            if fn not in dict_tables:
+                dict_tables[fn] = pq.read_table(os.path.join(store_dir, fn), schema=file_schema)
+            list_pending.append(dict_tables[fn].slice(row, n_rows))
+            n_pending += n_rows
+            if dict_last_run[fn] == i:
+                del dict_tables[fn]
+            # Full row groups as they fill, rather than one per input
+            if n_pending >= rows_per_group:
+                table = pa.concat_tables(list_pending)
+                n_full = (table.num_rows // rows_per_group) * rows_per_group
+                writer.write_table(table.slice(0, n_full), row_group_size=rows_per_group)
+                list_pending, n_pending = [table.slice(n_full)], table.num_rows - n_full
+        if n_pending > 0:
+            writer.write_table(pa.concat_tables(list_pending), row_group_size=rows_per_group)
+
+    return({'out_fn': dict_task['out_fn'], 'files': dict_task['files'], 'lineage': list_lineage, 'size': os.path.getsize(out_path)})
+
+def get_compact_bins(store_dir, manifest, target_mb=256, small_share=0.5):
+    '''
+    Return the bins of files to compact: in each partition, the files smaller than small_share of the target, in order
+    (granule name, ie, time), are put in bins of up to target_mb; a bin of one file is left as it is
+    '''
+    target_size = target_mb * 1024**2
+    dict_partitions = {}
+    for fn in get_store_files(store_dir, manifest):
+        size = os.path.getsize(os.path.join(store_dir, fn))
+        if size < target_size * small_share:
+            dict_partitions.setdefault(os.path.dirname(fn), []).append((fn, size))
+    list_bins = []
+    for partition, list_files in sorted(dict_partitions.items()):
+        list_bin, bin_size = [], 0
+        for fn, size in sorted(list_files, key=lambda x: get_file_lineage(manifest, x[0], 0)[0][0]):
+            if len(list_bin) > 0 and bin_size + size > target_size:
+                list_bins.append(list_bin)
+                list_bin, bin_size = [], 0
+            list_bin.append(fn)
+            bin_size += size
+        list_bins.append(list_bin)
+    return [list_bin for list_bin in list_bins if len(list_bin) > 1]
+
+def remove_orphan_files(store_dir, manifest):
+    '''
+    Remove the data files of a store that its manifest doesn't list (those of an interrupted append or compaction)
+    Returns the files removed
+    '''
+    set_files = set(get_store_files(store_dir, manifest))
+    list_orphans = []
+    for root, dirs, files in os.walk(store_dir):
+        for fn in files:
+            rel_fn = os.path.relpath(os.path.join(root, fn), store_dir)
+            if (fn.endswith('.parquet') or fn.endswith('.tmp')) and rel_fn not in set_files:
+                os.remove(os.path.join(root, fn))
+                list_orphans.append(rel_fn)
+    return list_orphans
+
+def compact_store(store_dir, target_mb=256, rows_per_group=1000000, processes=4, remove_orphans=True):
+    '''
+    Compact the small files of an appendable store (eg, one per granule and partition) into files of about target_mb
+    in each partition, with row group statistics (min/max of each column) and the lineage of their rows to the granules
+    The manifest is written after each window of bins, before the files that were compacted are removed,
+    so that an interrupted compaction leaves the store as it was, or with orphan files the next compaction removes
+    Returns a dict of the files before and after and the files compacted
+    '''
+    manifest = read_manifest(store_dir)
+    manifest.setdefault('compacted', {})
+    dict_counts = {'files_before': len(get_store_files(store_dir, manifest))}
+    if remove_orphans:
+        list_orphans = remove_orphan_files(store_dir, manifest)
+        if len(list_orphans) > 0:
+            print(f"\tRemoved {len(list_orphans)} files not in the manifest (of an interrupted append or compaction): eg {list_orphans[0]}")
+
+    import pyarrow.parquet as pq
+    write_id = time.strftime('%Y%m%d%H%M%S')
+    list_tasks = []
+    for i, list_bin in enumerate(get_compact_bins(store_dir, manifest, target_mb=target_mb)):
+        list_tasks.append({'store_dir': store_dir, 'files': list_bin, 'rows_per_group': rows_per_group,
+                           'lineages': [get_file_lineage(manifest, fn, pq.read_metadata(os.path.join(store_dir, fn)).num_rows) for fn in list_bin],
+                           'out_fn': os.path.join(os.path.dirname(list_bin[0]), f"{COMPACT_PREFIX}-{write_id}-{i}.parquet")})
+
+    dict_counts['files_compacted'] = sum([len(dict_task['files']) for dict_task in list_tasks])
+    window = processes * 2
+    with Pool(processes=processes) as pool:
+        for i in range(0, len(list_tasks), window):
+            list_results = list(pool.imap_unordered(compact_files, list_tasks[i:i + window]))
+            for dict_result in list_results:
+                for fn in dict_result['files']:
+                    manifest['compacted'].pop(fn, None)
+                manifest['compacted'][dict_result['out_fn']] = dict_result['lineage']
+                for name in set([lineage[0] for lineage in dict_result['lineage']]):
+                    list_files = [fn for fn in manifest['granules'][name]['files'] if fn not in dict_result['files']]
+                    manifest['granules'][name]['files'] = sorted(list_files + [dict_result['out_fn']])
+            write_manifest(store_dir, manifest)
+            for dict_result in list_results:
+                for fn in dict_result['files']:
+                    os.remove(os.path.join(store_dir, fn))
+            print(f"\tCompacted {min(i + window, len(list_tasks))} of {len(list_tasks)} bins")
+
+    update_zone_maps(store_dir, manifest)
+    write_manifest(store_dir, manifest)
+    dict_counts['files_after'] = len(get_store_files(store_dir, manifest))
+    return dict_counts
+
+# Columns of the zone maps (min/max of each file of a store, from the row group statistics); the dates are from the granule names
+ZONE_MAP_COLS = ['lat', 'lon', 'seg_landcov']
+GRANULE_MAX_MINUTES = 30
+
+def get_file_zone_map(store_dir, fn, list_lineage):
+    '''
+    Return the zone map of a file of a store: the min/max of the ZONE_MAP_COLS (from its row group statistics, so without
+    reading its rows) and of its dates (the acq dates of its granules), and its rows
+    A column without statistics has no zone map (None), and is never used to skip the file
+    '''
+    import pyarrow.parquet as pq
+    md = pq.read_metadata(os.path.join(store_dir, fn))
+    dict_zone_map = {'n_rows': md.num_rows}
+    names = md.schema.names
+    for col in ZONE_MAP_COLS:
+        dict_zone_map[col] = None
+        if col not in names or md.num_row_groups == 0:
+            continue
+        list_stats = [md.row_group(i).column(names.index(col)).statistics for i in range(md.num_row_groups)]
+        if all([stats is not None and stats.has_min_max for stats in list_stats]):
+            dict_zone_map[col] = [min([stats.min for stats in list_stats]), max([stats.max for stats in list_stats])]
+    # A granule can run past midnight
+    list_dt = [ExtractUtils.parse_granule_name(lineage[0])['dt'] for lineage in list_lineage]
+    dict_zone_map['date'] = [min(list_dt).strftime('%Y-%m-%d'), (max(list_dt) + timedelta(minutes=GRANULE_MAX_MINUTES)).strftime('%Y-%m-%d')]
+    return dict_zone_map
+
+def update_zone_maps(store_dir, manifest):
+    '''
+    Add the zone maps of the files of a store that have none (eg, newly written) to its manifest, and drop those of removed files
+    '''
+    import pyarrow.parquet as pq
+    dict_zone_maps = manifest.setdefault('zone_maps', {})
+    list_files = get_store_files(store_dir, manifest)
+    for fn in list_files:
+        if fn not in dict_zone_maps:
+            n_rows = pq.read_metadata(os.path.join(store_dir, fn)).num_rows if fn not in manifest.get('compacted', {}) else None
+            dict_zone_maps[fn] = get_file_zone_map(store_dir, fn, get_file_lineage(manifest, fn, n_rows))
+    for fn in set(dict_zone_maps) - set(list_files):
+        del dict_zone_maps[fn]
+
+def get_partition_zone_maps(manifest):
+    '''
+    Return the zone maps of the partitions of a store (of all of the files of each partition dir): {partition: zone map}
+    '''
+    dict_partitions = {}
+    for fn, dict_zone_map in manifest.get('zone_maps', {}).items():
+        dict_partition = dict_partitions.setdefault(os.path.dirname(fn), {'n_files': 0, 'n_rows': 0})
+        dict_partition['n_files'] += 1
+        dict_partition['n_rows'] += dict_zone_map['n_rows']
+        for col in ZONE_MAP_COLS + ['date']:
+            if dict_partition['n_files'] == 1:
+                dict_partition[col] = dict_zone_map[col]
+            elif dict_partition[col] is not None and dict_zone_map[col] is not None:
+                dict_partition[col] = [min(dict_partition[col][0], dict_zone_map[col][0]), max(dict_partition[col][1], dict_zone_map[col][1])]
+            else:
+                dict_partition[col] = None
+    return dict_partitions
+
+def is_zone_map_overlap(dict_zone_map, bbox=None, date_range=None, landcov=None):
+    '''
+    Return whether the rows of a zone map may be in a query: a bbox [minlon, maxlon, minlat, maxlat], a date range
+    ['YYYY-MM-DD', 'YYYY-MM-DD'] (inclusive) and land cover classes (seg_landcov)
+    '''
+    overlaps = lambda zone, lo, hi: zone is None or (zone[0] <= hi and zone[1] >= lo)
+    if bbox is not None:
+        if not overlaps(dict_zone_map.get('lon'), bbox[0], bbox[1]) or not overlaps(dict_zone_map.get('lat'), bbox[2], bbox[3]):
+            return False
+    if date_range is not None and not overlaps(dict_zone_map.get('date'), date_range[0], date_range[1]):
+        return False
+    if landcov is not None and not any([overlaps(dict_zone_map.get('seg_landcov'), lc, lc) for lc in landcov]):
+        return False
+    return True
+
+def get_date_range(date_range):
+    '''
+    Return a date range as the zero padded 'YYYY-MM-DD' strings of the zone maps (eg, 2019-7-16 -> 2019-07-16), or None
+    Raises a ValueError for a date that isn't YYYY-MM-DD
+    '''
+    if date_range is None:
+        return None
+    return([datetime.strptime(date, '%Y-%m-%d').strftime('%Y-%m-%d') for date in date_range])
+
+def select_store_files(store_dir, manifest=None, bbox=None, date_range=None, landcov=None):
+    '''
+    Return the files of a store (relative to it) whose partitions, then whose own zone maps, may have rows of a query
+    (see is_zone_map_overlap); the other files are not opened
+    '''
+    # The zone map dates are compared as strings
+    date_range = get_date_range(date_range)
+    if manifest is None:
+        manifest = read_manifest(store_dir)
+    dict_zone_maps = manifest.get('zone_maps', {})
+    dict_partitions = get_partition_zone_maps(manifest)
+    list_partitions = [partition for partition, dict_zone_map in dict_partitions.items() if is_zone_map_overlap(dict_zone_map, bbox, date_range, landcov)]
+    return([fn for fn in get_store_files(store_dir, manifest)
+            if (fn not in dict_zone_maps or (os.path.dirname(fn) in list_partitions and is_zone_map_overlap(dict_zone_maps[fn], bbox, date_range, landcov)))])
+
+def get_query_expression(schema, bbox=None, date_range=None, landcov=None, tiles=None):
+    '''
+    Return the pyarrow dataset expression of the rows of a query (see is_zone_map_overlap), or None for all rows
+        tiles: tiles of the grid of the store (see get_tile_ids)
+    The dates are those of the y and doy columns
+    '''
+    import pyarrow.dataset as pds
+    list_expr = []
+    if bbox is not None:
+        minlon, maxlon, minlat, maxlat = bbox
+        list_expr += [pds.field('lon') >= minlon, pds.field('lon') <= maxlon, pds.field('lat') >= minlat, pds.field('lat') <= maxlat]
+        grid_deg = get_grid_deg(schema)
+        if grid_deg is not None and tiles is None:
+            tiles = get_bbox_tiles(bbox, grid_deg)
+    if tiles is not None:
+        list_expr.append(pds.field(TILE_COL).isin(tiles))
+    if date_range is not None:
+        yyyyddd = pds.field('y').cast('int32') * 1000 + pds.field('doy').cast('int32')
+        dt_start, dt_end = [datetime.strptime(date, '%Y-%m-%d') for date in date_range]
+        list_expr += [yyyyddd >= dt_start.year * 1000 + dt_start.timetuple().tm_yday, yyyyddd <= dt_end.year * 1000 + dt_end.timetuple().tm_yday]
+    if landcov is not None:
+        list_expr.append(pds.field('seg_landcov').isin(landcov))
+    if len(list_expr) == 0:
+        return None
+    expr = list_expr[0]
+    for e in list_expr[1:]:
+        expr = expr & e
+    return expr
+
+def open_query_dataset(path, bbox=None, date_range=None, landcov=None, tiles=None):
+    '''
+    Return (dataset, list_files) of the files of a store that may have rows of a query (see select_store_files)
+    A merged dataset that isn't an appendable store (eg, of merge_atl08.py without --append) has no zone maps: all of its files are in it
+        tiles: tiles of the grid of the store; their bboxes are used to select the files
+    '''
+    import pyarrow.dataset as pds
+    manifest = read_manifest(path) if os.path.isdir(path) else None
+    if manifest is None:
+        dataset = pds.dataset(path, format='parquet', partitioning='hive' if os.path.isdir(path) else None)
+        return(dataset, dataset.files)
+    schema = read_store_schema(path)
+    if tiles is not None and bbox is None:
+        list_bbox = [get_tile_bbox(tile, get_grid_deg(schema)) for tile in tiles]
+        bbox = [min([b[0] for b in list_bbox]), max([b[1] for b in list_bbox]), min([b[2] for b in list_bbox]), max([b[3] for b in list_bbox])]
+    list_files = [os.path.join(path, fn) for fn in select_store_files(path, manifest, bbox=bbox, date_range=date_range, landcov=landcov)]
+    dataset = pds.dataset(list_files, schema=schema, format='parquet',
+                          partitioning=get_store_partitioning(schema, manifest['partition_cols']), partition_base_dir=path)
+    return(dataset, list_files)
+
+def query_store(store_dir, bbox=None, date_range=None, landcov=None, tiles=None, columns=None, expression=None):
+    '''
+    Return a table of the rows of a store in a bbox [minlon, maxlon, minlat, maxlat], date range, land cover classes and tiles
+    (and an expression, eg FilterUtils.get_filter_spec_expression of a filter spec)
+    Only the files whose zone maps overlap the query are opened (see select_store_files), and, of those,
+    the row groups whose statistics do; the rows are then filtered exactly
+    '''
+    dataset, list_files = open_query_dataset(store_dir, bbox=bbox, date_range=date_range, landcov=landcov, tiles=tiles)
+    filter_expr = get_query_expression(dataset.schema, bbox=bbox, date_range=date_range, landcov=landcov, tiles=tiles)
+    if expression is not None:
+        filter_expr = expression if filter_expr is None else filter_expr & expression
+    return(dataset.to_table(columns=columns, filter=filter_expr))
@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+
+'''
+    Run extract_filter_atl08_v005.py over a list of ATL08 granules in a pool of worker processes.
+    Each worker imports numpy/pandas/h5py (and FilterUtils) once and reuses them for all of its granules,
+    instead of paying the interpreter start up and imports for every granule as with one GNU parallel job per granule.
+    The outcome of each granule (written, empty after filtering, no good points, exists, error) is collected into a summary CSV,
+    and the filter funnels of the granules (obs left after each filter stage) are summed into a batch funnel JSON.
+    With --profile, the phase timings of each granule are written to a batch profile (JSON lines; see summarize_profile_atl08.py).
+
+    Takes all of the extract_filter_atl08_v005.py arguments (except -i), eg:
+        batch_extract_atl08.py --granule_list list_atl08.005_2021_forest201 --processes 16 -o /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/atl08.005/howland/2021 --minlon -69 --maxlon -68 --minlat 44 --maxlat 46 --do_20m --log
+'''
+
+import os, sys
+import copy
+import time
+import traceback
+from multiprocessing import Pool
+
+import json
+
+import pandas as pd
+
+import extract_filter_atl08_v005 as extract
+import FilterUtils
+import ProfileUtils
+
+def read_granule_list(list_fn):
+    '''
+    Return the granules of a list file (one path per line)
+    '''
+    with open(list_fn) as f:
+        return [line.strip() for line in f if line.strip() != '']
+
+def extract_granule(args):
+    '''
+    Worker: extract one granule and return its outcome as a dict
+    An exception in a granule is caught and recorded, so the rest of the batch goes on
+    '''
+    start = time.time()
+    try:
+        status = extract.extract_atl08(args)
+        message = ''
+    except Exception as e:
+        status = extract.STATUS_ERROR
+        message = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        print(f"\nError extracting {args.input}:\n{traceback.format_exc()}")
+
+    # A granule that stopped early may have left stdout pointed at its log file
+    if sys.stdout is not sys.__stdout__:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+    return {'granule': args.input, 'status': status, 'seconds': round(time.time() - start, 3), 'message': message,
+            'funnels': getattr(args, 'list_funnels', []), 'profile': ProfileUtils.end_profile(getattr(args, 'profile_record', None), status)}
+
+def getparser():
+    parser = extract.getparser()
+    parser.description = 'Extract and filter a list of ATL08 granules with a pool of worker processes'
+    parser.add_argument("--granule_list", type=str, default=None, help="A list of ATL08 granules (one path per line) to extract")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--summary_fn", type=str, default=None, help="Output CSV of the outcome of each granule (default: <output dir>/batch_summary_<granule list name>.csv)")
+    return parser
+
+def main():
+    parser = getparser()
+    args = parser.parse_args()
+
+    if args.granule_list is None:
+        print("Needs a granule list (--granule_list). Exiting")
+        os._exit(1)
+    if args.output_dataframe:
+        print("--output_dataframe doesn't apply to a batch. Exiting")
+        os._exit(1)
+
+    list_granules = read_granule_list(args.granule_list)
+
+    # One set of extract args per granule
+    list_args = []
+    for granule in list_granules:
+        granule_args = copy.copy(args)
+        granule_args.input = granule
+        list_args.append(granule_args)
+
+    print(f"\nBatch of {len(list_granules)} granules from: \t{args.granule_list}")
+    print(f"Worker processes: \t\t{args.processes}")
+    start = time.time()
+
+    # Granules vary a lot in size, so hand them out one at a time; outcomes come back in the order of the list
+    with Pool(processes=args.processes) as pool:
+        list_outcomes = list(pool.imap(extract_granule, list_args, chunksize=1))
+
+    summary = pd.DataFrame(list_outcomes, columns=['granule', 'status', 'seconds', 'message'])
+
+    if args.summary_fn is None:
+        summary_dir = args.output if args.output is not None else os.path.dirname(args.granule_list)
+        args.summary_fn = os.path.join(summary_dir, 'batch_summary_' + os.path.basename(args.granule_list) + '.csv')
+    summary.to_csv(args.summary_fn, index=False)
+
+    # Sum the filter funnels of the granules, for each domain and segment length
+    if args.write_funnel:
+        list_funnels = FilterUtils.sum_filter_funnels([funnel for outcome in list_outcomes for funnel in outcome['funnels']])
+        funnel_fn = os.path.splitext(args.summary_fn)[0] + '_funnel.json'
+        with open(funnel_fn, 'w') as f:
+            json.dump(list_funnels, f, indent=1)
+
+    # The phase timings of each granule, one JSON line each (a new batch file, or appended to the --profile file)
+    if args.profile is not None:
+        profile_fn = args.profile if args.profile != '' else os.path.splitext(args.summary_fn)[0] + '_profile.jsonl'
+        ProfileUtils.write_profiles([outcome['profile'] for outcome in list_outcomes if outcome['profile'] is not None], profile_fn,
+                                    mode='a' if args.profile != '' else 'w')
+
+    print("\nBatch summary:")
+    for status, n in summary.status.value_counts().items():
+        print(f"\t{status}: \t\t{n}")
+    print(f"Summary CSV: \t\t{args.summary_fn}")
+    if args.write_funnel:
+        for funnel in list_funnels:
+            print(f"\nFilter funnel{'' if funnel['domain'] is None else ' of domain ' + funnel['domain']} ({funnel['segment_length']}m; {funnel['n_granules']} granules):")
+            print(f"\tIn: \t\t{funnel['n_input']}")
+            for stage in funnel['stages']:
+                print(f"\tAfter {stage['stage']}: \t\t{stage['n']}")
+            print(f"\tRows out: \t\t{funnel['n_rows']}")
+        print(f"Funnel JSON: \t\t{funnel_fn}")
+    if args.profile is not None:
+        print(f"Profile: \t\t{profile_fn}")
+    extract.calculateElapsedTime(start, time.time())
+
+
+if __name__ == "__main__":
+    main()
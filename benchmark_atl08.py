@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+
+'''
+    Benchmark the extraction of ATL08 granules (extract_filter_atl08_v005.py) on synthetic granules (make_synthetic_atl08.py),
+    or on a list of real ones, and compare it to a stored baseline so that a slow down (or a change of the outputs) is caught.
+    Each case (100m or 20m, with or without the filters, with filter pushdown) is run on each granule in its own process,
+    with --profile, a few times. Reports, from the median run of each case:
+        segments/s: 100m segments in the granules / extraction wall time (without the interpreter start up and imports)
+        MB/s:       MB of h5 / extraction wall time
+        peak RSS:   of the extraction process (MB)
+        rows:       rows written (the filter funnels); a change from the baseline means the outputs changed
+
+    Make a baseline, then check against it after a change:
+        benchmark_atl08.py --work_dir /tmp/atl08_bench --save_baseline atl08_bench_baseline.json
+        benchmark_atl08.py --work_dir /tmp/atl08_bench --baseline atl08_bench_baseline.json
+'''
+
+import os, sys
+import glob
+import json
+import shutil
+import platform
+import argparse
+import subprocess
+
+import h5py
+import numpy as np
+import pandas as pd
+
+import ExtractUtils
+import make_synthetic_atl08
+
+EXTRACT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extract_filter_atl08_v005.py')
+
+# Extract args of each case (on top of the --extract_args)
+BENCHMARK_CASES = {
+    '100m'                 : ['--no-filter-qual', '--no-filter-geo'],
+    '100m_filter'          : [],
+    '100m_filter_pushdown' : ['--filter_pushdown'],
+    '20m'                  : ['--do_20m', '--no-filter-qual', '--no-filter-geo'],
+    '20m_filter'           : ['--do_20m'],
+}
+
+def get_n_segments(h5_fn):
+    '''
+    Return the number of 100m segments of a granule (all beams)
+    '''
+    with h5py.File(h5_fn, 'r') as f:
+        return(sum([len(f[f'/{line}/land_segments/latitude']) for line in ExtractUtils.LINES if f'/{line}/land_segments/latitude' in f]))
+
+def run_case(case, list_h5, case_dir, extract_args=[], repeats=3):
+    '''
+    Extract each granule with the args of a case, repeats times, each in its own process
+    Returns the metrics of the case, from the run whose summed wall time is the median
+    '''
+    list_runs = []
+    for i in range(repeats):
+        if os.path.isdir(case_dir):
+            shutil.rmtree(case_dir)
+        os.makedirs(case_dir)
+        profile_fn = os.path.join(case_dir, 'atl08_profile.jsonl')
+        for h5_fn in list_h5:
+            cmd = [sys.executable, EXTRACT_SCRIPT, '-i', h5_fn, '-o', case_dir, '--profile', profile_fn] + BENCHMARK_CASES[case] + extract_args
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            if proc.returncode != 0:
+                print(proc.stdout)
+                raise RuntimeError(f"Extraction of {h5_fn} failed in case {case}: {' '.join(cmd)}")
+        with open(profile_fn) as f:
+            list_profiles = [json.loads(line) for line in f]
+        list_funnels = []
+        for funnel_fn in glob.glob(os.path.join(case_dir, '*_funnel.json')):
+            with open(funnel_fn) as f:
+                list_funnels.append(json.load(f))
+        list_runs.append({'wall_s': sum([profile['wall_s'] for profile in list_profiles]),
+                          'cpu_s': sum([profile['cpu_s'] for profile in list_profiles]),
+                          'peak_rss_mb': max([profile['peak_rss_mb'] for profile in list_profiles]),
+                          'n_rows': sum([funnel['n_rows'] for funnel in list_funnels])})
+
+    runs = pd.DataFrame(list_runs)
+    run = runs.iloc[(runs.wall_s - runs.wall_s.median()).abs().argmin()]
+    return({'wall_s': round(run.wall_s, 4), 'wall_min_s': round(runs.wall_s.min(), 4), 'cpu_s': round(run.cpu_s, 4),
+            'peak_rss_mb': runs.peak_rss_mb.max(), 'n_rows': int(run.n_rows)})
+
+def compare_baseline(dict_results, dict_baseline, tolerance=0.2):
+    '''
+    Compare the cases of a benchmark to those of a baseline
+    A case regresses when its segments/s is down, or its peak RSS up, by more than tolerance, or when its rows changed
+    Returns a df of the comparison, with a 'regression' column of what regressed
+    '''
+    list_rows = []
+    for case, dict_case in dict_results['cases'].items():
+        if case not in dict_baseline['cases']:
+            continue
+        dict_base = dict_baseline['cases'][case]
+        row = {'case': case, 'segments_per_s': dict_case['segments_per_s'], 'baseline_segments_per_s': dict_base['segments_per_s'],
+               'speed_change': round(dict_case['segments_per_s'] / dict_base['segments_per_s'] - 1, 3),
+               'peak_rss_mb': dict_case['peak_rss_mb'], 'baseline_peak_rss_mb': dict_base['peak_rss_mb'],
+               'n_rows': dict_case['n_rows'], 'baseline_n_rows': dict_base['n_rows']}
+        list_regression = []
+        if row['speed_change'] < -tolerance:
+            list_regression.append('speed')
+        if dict_case['peak_rss_mb'] > dict_base['peak_rss_mb'] * (1 + tolerance):
+            list_regression.append('memory')
+        if dict_case['n_rows'] != dict_base['n_rows']:
+            list_regression.append('rows')
+        row['regression'] = ','.join(list_regression)
+        list_rows.append(row)
+    return pd.DataFrame(list_rows)
+
+def getparser():
+    parser = argparse.ArgumentParser(description='Benchmark the ATL08 extraction on synthetic (or listed) granules against a baseline')
+    parser.add_argument("--work_dir", type=str, default=None, help="Dir of the synthetic granules and the outputs of each case")
+    parser.add_argument("--granule_list", type=str, default=None, help="Benchmark the granules of this list (one path per line) instead of synthetic granules")
+    parser.add_argument("--n_granules", type=int, default=2, help="Number of synthetic granules")
+    parser.add_argument("--n_segments", type=int, default=20000, help="Number of 100m segments of each beam of a synthetic granule")
+    parser.add_argument("--version", type=int, choices=ExtractUtils.ATL08_VERSIONS, default=5, help="ATL08 product version of the synthetic granules")
+    parser.add_argument("--fill_rate", type=float, default=0.05, help="Share of the float values of the synthetic granules set to their fill value")
+    parser.add_argument("--cases", nargs="+", type=str, choices=list(BENCHMARK_CASES), default=list(BENCHMARK_CASES), help="Cases to run")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of each case; the median is reported")
+    parser.add_argument("--extract_args", type=str, default='', help='More extract_filter_atl08_v005.py args for all of the cases, eg "--minlat 40 --maxlat 70"')
+    parser.add_argument("--baseline", type=str, default=None, help="Baseline JSON to compare to; exits with an error on a regression")
+    parser.add_argument("--save_baseline", type=str, default=None, help="Write the results as a baseline JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slow down (or peak RSS growth) from the baseline that is a regression")
+    return parser
+
+def main():
+    parser = getparser()
+    args = parser.parse_args()
+
+    if args.work_dir is None:
+        print("Needs a work dir (--work_dir). Exiting")
+        os._exit(1)
+
+    # The same synthetic granules for each run of the benchmark (they are only written if missing)
+    dict_synthetic = None
+    if args.granule_list is not None:
+        with open(args.granule_list) as f:
+            list_h5 = [line.strip() for line in f if line.strip() != '']
+    else:
+        dict_synthetic = {'n_granules': args.n_granules, 'n_segments': args.n_segments, 'version': args.version, 'fill_rate': args.fill_rate}
+        granule_dir = os.path.join(args.work_dir, 'granules_' + '_'.join([f'{key}{val}' for key, val in dict_synthetic.items()]))
+        list_h5 = sorted(glob.glob(os.path.join(granule_dir, '*.h5')))
+        if len(list_h5) != args.n_granules:
+            print(f"Writing {args.n_granules} synthetic granules: \t{granule_dir}")
+            list_h5 = make_synthetic_atl08.make_synthetic_granules(granule_dir, n_granules=args.n_granules, versions=[args.version],
+                                                                   n_segments=args.n_segments, fill_rate=args.fill_rate)
+
+    n_segments = sum([get_n_segments(h5_fn) for h5_fn in list_h5])
+    mb = sum([os.path.getsize(h5_fn) for h5_fn in list_h5]) / 1024**2
+    print(f"\nGranules: \t\t{len(list_h5)} ({n_segments} segments; {round(mb, 1)} MB)")
+
+    dict_results = {'host': platform.node(), 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                    'h5py': h5py.__version__, 'synthetic': dict_synthetic, 'n_granules': len(list_h5), 'n_segments': n_segments,
+                    'mb': round(mb, 2), 'cases': {}}
+    for case in args.cases:
+        print(f"Running case {case} ({args.repeats} times)...")
+        dict_case = run_case(case, list_h5, os.path.join(args.work_dir, 'out_' + case), extract_args=args.extract_args.split(), repeats=args.repeats)
+        dict_case.update({'segments_per_s': round(n_segments / dict_case['wall_s'], 1), 'mb_per_s': round(mb / dict_case['wall_s'], 2)})
+        dict_results['cases'][case] = dict_case
+
+    results = pd.DataFrame.from_dict(dict_results['cases'], orient='index')[['segments_per_s', 'mb_per_s', 'wall_s', 'wall_min_s', 'cpu_s', 'peak_rss_mb', 'n_rows']]
+    print("\nResults (median run):")
+    print(results.to_string())
+    print(f"Profiles of the phases of each case: \t{os.path.join(args.work_dir, 'out_<case>', 'atl08_profile.jsonl')} (see summarize_profile_atl08.py)")
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(dict_results, f, indent=1)
+        print(f"\nBaseline: \t\t{args.save_baseline}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            dict_baseline = json.load(f)
+        if dict_baseline.get('synthetic') != dict_synthetic or dict_baseline.get('n_segments') != n_segments:
+            print("\nThe granules are not those of the baseline; its rows and speeds don't compare")
+        comparison = compare_baseline(dict_results, dict_baseline, tolerance=args.tolerance)
+        print(f"\nCompared to the baseline ({args.baseline}; host {dict_baseline.get('host')}):")
+        print(comparison.to_string(index=False))
+        if (comparison.regression != '').any():
+            print(f"\nREGRESSION in: {', '.join(comparison.case[comparison.regression != ''])}")
+            os._exit(1)
+        print("\nNo regression")
+
+if __name__ == "__main__":
+    main()
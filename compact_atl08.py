@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+
+'''
+    Compact the per-granule outputs of the ATL08 extraction into a store of few, large Parquet files (see StoreUtils).
+    The extraction leaves one small output per granule (tens of thousands a year in atl08.005/<domain>/<year>), and listing
+    and opening them is most of the time of every read of them. Compaction writes, in each partition of the store
+    (eg, tile=48711/y=2021/), files of about --target_mb with zstd row groups and their statistics (min/max of each column, so
+    readers skip the row groups outside of a query), and records the lineage of their rows back to the granules.
+        1. the outputs of --indir (if given) are appended to the store (made if it does not exist, partitioned by --partition_cols;
+           by default, by tile of a 1 degree lat/lon grid, then year, so that a bbox query reads only the tiles it intersects)
+        2. the small files of each partition are compacted, in time order, into files of about --target_mb
+    Run it again as new outputs arrive: the new granules are appended, then compacted with the last small files of their partitions.
+    A granule that is extracted again replaces its rows (in the compacted files, too).
+
+        compact_atl08.py --indir /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/atl08.005/howland/2021 --search_str 005_01_100m
+                         --store /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/atl08.005/howland/ATL08_store_005_01_100m
+'''
+
+import os
+import argparse
+
+import StoreUtils
+
+def getparser():
+    parser = argparse.ArgumentParser(description='Compact the per-granule ATL08 outputs into a store of Parquet files of a target size')
+    parser.add_argument("--store", type=str, default=None, help="Store dir (made if it does not exist)")
+    parser.add_argument("--indir", type=str, default=None, help="Input dir of the ATL08 outputs to append to the store before compacting it (optional)")
+    parser.add_argument("--search_str", type=str, default=None, help="Search string of the inputs: those whose names end with <search_str>.<csv|parquet|feather>")
+    parser.add_argument("--partition_cols", nargs="*", type=str, default=['tile', 'y'], help="Hive partition columns of a new store (those not in the inputs are skipped)")
+    parser.add_argument("--grid_deg", type=float, default=1.0, help="Size (degrees) of the cells of the lat/lon grid of the tile column of a new store")
+    parser.add_argument("--target_mb", type=float, default=256, help="Target size of a compacted file (MB)")
+    parser.add_argument("--rows_per_group", type=int, default=1000000, help="Max rows of a Parquet row group")
+    parser.add_argument('--no-remove-orphans', dest='remove_orphans', action='store_false', help='Keep the files not in the manifest of the store (eg, of an interrupted append)')
+    parser.set_defaults(remove_orphans=True)
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Number of worker processes")
+    return parser
+
+def main():
+    parser = getparser()
+    args = parser.parse_args()
+
+    if args.store is None:
+        print("Must provide a store dir (--store). Exiting")
+        os._exit(1)
+
+    if args.indir is not None:
+        if args.search_str is None:
+            print("Must provide a search string (--search_str) of the inputs. Exiting")
+            os._exit(1)
+        if StoreUtils.read_manifest(args.store) is None and os.path.isdir(args.store) and len(os.listdir(args.store)) > 0:
+            print(f"Not an appendable store (it has no {StoreUtils.MANIFEST_FN}): {args.store}. Exiting")
+            os._exit(1)
+        list_fn = [fn for fn in StoreUtils.list_merge_inputs(args.indir, args.search_str) if StoreUtils.get_input_version(fn) is not None]
+        print(f"\nInputs to append: \t{len(list_fn)}")
+        if len(list_fn) > 0:
+            list_schemas = [StoreUtils.read_input_schema(fn) for fn in list_fn]
+            schema, dict_missing, dict_conflicts, list_dropped = StoreUtils.get_append_schema(args.store, list_fn, list_schemas, grid_deg=args.grid_deg)
+            if len(dict_conflicts) > 0:
+                print(f"Columns of conflicting types: {list(dict_conflicts)} (see merge_atl08.py). Exiting")
+                os._exit(1)
+            if len(list_dropped) > 0:
+                print(f"\tColumns not in the store, dropped: {list_dropped}")
+            partition_cols = [col for col in args.partition_cols if col in schema.names]
+            dict_counts = StoreUtils.append_store(args.store, list_fn, schema, partition_cols=partition_cols, processes=args.processes)
+            print(f"Granules added: {dict_counts['added']}; replaced: {dict_counts['replaced']}; unchanged (skipped): {dict_counts['unchanged']}")
+
+    manifest = StoreUtils.read_manifest(args.store)
+    if manifest is None:
+        print(f"No store to compact (no {StoreUtils.MANIFEST_FN}): {args.store}. Exiting")
+        os._exit(1)
+    print(f"Compacting store: \t{args.store} (partitions: {manifest['partition_cols']}; target {args.target_mb} MB)")
+    dict_counts = StoreUtils.compact_store(args.store, target_mb=args.target_mb, rows_per_group=args.rows_per_group,
+                                           processes=args.processes, remove_orphans=args.remove_orphans)
+    print(f"Files compacted: \t{dict_counts['files_compacted']}")
+    print(f"Files in the store: \t{dict_counts['files_before']} -> {dict_counts['files_after']}")
+    print(f"Partitions: \t\t{len(StoreUtils.get_partition_zone_maps(StoreUtils.read_manifest(args.store)))} (zone maps in {StoreUtils.MANIFEST_FN})")
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,19 @@
 # EXTRACT AND FILTER ATL08 v005 data on ADAPT
 # ---QUALITY FILTERING APPLIED BY DEFAULT FROM FILTERUTILS.py
 # ------ need to re-run this script if you change the default filtering in FilterUtils.py
+# ------ (with --cache_dir on the extract_filter_atl08_v005.py calls, a re-run reads the unfiltered segments of each granule from the cache, not the h5)
 # ------ to turn off filter, add '--no-filter-qual' to extract_filter_atl08.py call
+# ------ or give the quality filter as a spec: '--filter_spec v2' (presets v1-v4; or a JSON file, see FilterUtils.read_filter_spec)
 #
 # pdsh -g forest do_extract_filter_atl08.sh \"2018 2019 2020 2021 2022\" /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_atl08.005_tanana tanana
 # pdsh -g forest do_extract_filter_atl08.sh \"2018 2019 2020 2021 2022\" /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_atl08.005_senegal senegal_20m 
 #
 # This used for Howland,SERC which took a custom misc quality filter dict
+# (to get both the 100m and 20m outputs of these domains from one read of each granule, use --do_100m_20m instead of --do_20m)
+#
+# Several v005 domains can be done with one read of each granule from a domain config (see atl08_domains.json);
+# each domain is written to ${OUTDIR}/domains/${YEAR}/<domain name>
+# pdsh -g forest,ilab do_extract_filter_atl08.sh \"2018 2019 2020 2021 2022\" /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_atl08.005 domains /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/atl08.005 atl08_domains.json
 # pdsh -g forest,ilab do_extract_filter_atl08.sh \"2018 2019 2020 2021 2022\" /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_atl08.005 serc
 # pdsh -g forest,ilab do_extract_filter_atl08.sh \"2018 2019 2020 2021 2022\" /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_atl08.005 howland
 
@@ -20,7 +27,12 @@
 # parallel 'ls /att/pubrepo/IceSAT-2/ATLAS/ATL08.004/{}.0[6-9].*/*h5 >> /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_atl08.004_jjas_{}' ::: 2018 2019 2020 2021
 # parallel 'ls /att/pubrepo/IceSAT-2/ATLAS/ATL08.005/{}*/*h5 >> /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_atl08.005_{}' ::: 2018 2019 2020 2021 2022
 
+# Optionally, cull a list by acq date and RGT footprint before any granule is opened (see plan_atl08.py for the footprint index)
+# plan_atl08.py -i /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_atl08.005_2021 -o /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_atl08.005_howland_2021 --footprint_index /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/atl08_footprints.csv --minlon -69 --maxlon -68 --minlat 44 --maxlat 46 --minmonth 6 --maxmonth 9
+
 # Second, chunk up by nodes
+# (instead of one extract_filter_atl08_v005.py job per granule with GNU parallel, a node's list can also be run in one
+#  worker pool with batch_extract_atl08.py --granule_list <list> --processes <n> <extract_filter_atl08_v005.py args>)
 # source activate py2
 # gen_chunks.py list_atl08.004_jjas_2021 nodes_all
 
@@ -40,6 +52,7 @@ FILE_LIST_STEM=${2:-'/adapt/nobackup/people/pmontesa/userfs02/data/icesat2/list_
 
 GEO_DOMAIN=${3:-'boreal'}
 OUTDIR=${4:-'/adapt/nobackup/people/pmontesa/userfs02/data/icesat2/atl08.005'}
+DOMAINS_CONFIG=${5:-'atl08_domains.json'}
 
 hostN=`/bin/hostname -s`
 
@@ -89,6 +102,10 @@ for YEAR in ${YEARS_LIST} ; do
         # This LC h_can thresh list is same as boreal.- -76.5627, 38.8903, -76.5555, 38.8957
         parallel --progress 'extract_filter_atl08_v005.py --list_lc_h_can_thresh 0 60 60 60 60 60 60 50 50 50 50 50 50 15 10 10 5 5 5 0 0 0 0 --i {1} -o {2}/{3} --minlon -156 --maxlon -143.5 --minlat 62.5 --maxlat 66.0 --minmonth 6 --maxmonth 9 --do_20m' ::: ${FILE_LIST} ::: ${OUTDIR} ::: ${YEAR}
     fi
+    if [[ "$GEO_DOMAIN" == "domains" ]] ; then
+        # The bbox, months and filter thresholds of each domain are in the domain config
+        parallel --progress 'extract_filter_atl08_v005.py --domains {4} -i {1} -o {2}/{3}' ::: ${FILE_LIST} ::: ${OUTDIR} ::: ${YEAR} ::: ${DOMAINS_CONFIG}
+    fi
     if [[ "$GEO_DOMAIN" == "senegal_no_filt" ]] ; then
         # This LC h_can thresh list is good for Senegal: it gives Shrubland and Cropland a threshold of 15; otherwise same as boreal.
         parallel --progress 'extract_filter_atl08.py --no-filter-qual --i {1} -o {2}/{3} --minlon -18 --maxlon -11 --minlat 12 --maxlat 17 --minmonth 1 --maxmonth 12' ::: ${FILE_LIST} ::: ${OUTDIR} ::: ${YEAR}
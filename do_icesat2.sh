@@ -75,6 +75,6 @@ if [[ "$DO_MERGE" == "true" ]] ; then
     # Merge all filtered CSVs for Eurasia
     #Rscript /home/pmontesa/code/icesat2/merge_atl08.R --indir="/att/nobackup/pmontesa/userfs02/data/icesat2/atl08/v3/csv_eu" --csv_search_str="003_01_filt_45_90_-13_180"
 
-    Rscript /home/pmontesa/code/icesat2/merge_atl08.R --indir=${outdir} --csv_search_str="003_01_filt_45_90_"${MINLON}"_"${MAXLON}
+    python /home/pmontesa/code/icesat2/merge_atl08.py --indir=${outdir} --csv_search_str="003_01_filt_45_90_"${MINLON}"_"${MAXLON} --output_format csv
 
 fi
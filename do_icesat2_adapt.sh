@@ -24,9 +24,8 @@ listname=${1:-'NULL'}
 CONTINENT=${2:-'na'}
 DO_MERGE=${3:-'false'}
 outdir=${4:-'/att/nobackup/pmontesa/userfs02/data/icesat2/atl08.003'}  #/att/nobackup/pmontesa/userfs02/data/icesat2/atl08/v3/csv
-
-VM_DO_MERGE='crane111'
-
+# The one VM that runs the merge (this script is launched on all VMs at once, and they'd all write the same merged file)
+VM_DO_MERGE=${5:-'crane111'}
 
 if [[ "$CONTINENT" == "na" ]] || [[ "$CONTINENT" == "eu" ]] ; then 
     if [[ "$CONTINENT" == "na" ]] ; then
@@ -96,12 +95,14 @@ else
     # Merge all filtered CSVs for Eurasia
     #Rscript /home/pmontesa/code/icesat2/merge_atl08.R --indir="/att/nobackup/pmontesa/userfs02/data/icesat2/atl08/v3/csv_eu" --csv_search_str="003_01_filt_45_90_-13_180"
 
+    # merge_atl08.py streams the CSVs with bounded memory, so the merge VM needn't be a large one (merge_atl08.R needed crane111),
+    # but only one VM may run it: set it with VM_DO_MERGE (arg 5)
     if [[ "$hostN" == "$VM_DO_MERGE" ]] ; then
 
-        Rscript /home/pmontesa/code/icesat2/merge_atl08.R --indir=${outdir} --csv_search_str="003_01_filt_45_90_"${MINLON}"_"${MAXLON}
+        python /home/pmontesa/code/icesat2/merge_atl08.py --indir=${outdir} --csv_search_str="003_01_filt_45_90_"${MINLON}"_"${MAXLON} --output_format csv
 
     else
-        echo "merge_atl08.R not running...need to lauch from ${VM_DO_MERGE}"
+        echo "merge_atl08.py not running...need to lauch from ${VM_DO_MERGE}"
     fi
 
 fi
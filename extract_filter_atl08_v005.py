@@ -64,22 +64,26 @@ import pandas as pd
 import os, sys
 import math
 import json
+import copy
 
 import argparse
 
+import ExtractUtils
+import FilterUtils
+import ProfileUtils
+
 import time
-from datetime import datetime
 
 def calculateElapsedTime(start, end, unit = 'minutes'):
     
     # start and end = time.time()
     
     if unit == 'minutes':
-        elapsedTime = round((time.time()-start)/60, 4)
+        elapsedTime = round((end-start)/60, 4)
     elif unit == 'hours':
-        elapsedTime = round((time.time()-start)/60/60, 4)
+        elapsedTime = round((end-start)/60/60, 4)
     else:
-        elapsedTime = round((time.time()-start), 4)  
+        elapsedTime = round((end-start), 4)  
         unit = 'seconds'
         
     #print("\nEnd: {}\n".format(time.strftime("%m-%d-%y %I:%M:%S %p")))
@@ -87,6 +91,33 @@ def calculateElapsedTime(start, end, unit = 'minutes'):
     
     return None
 
+# Columns returned by the quality filter, unless --columns is given
+SUBSET_COLS_LIST = ['rh25','rh50','rh60','rh70','rh75','rh80','rh90','h_can','h_max_can',
+                    'h_te_best','granule_name',
+                    'seg_landcov','seg_cover','sol_el','y','m','doy']
+SUBSET_COLS_LIST_20M = ['lon_20m','lat_20m','h_can_20m']
+
+COLS_20M = ['lon_20m', 'lat_20m', 'id_20m', 'h_can_20m', 'h_te_best_20m']
+
+# All of the columns extracted when there is no projection, in output order
+def getAllColumns(do_20m):
+
+    cols_orb_gt_seg = ['lon', 'lat', 'dt', 'orb_orient', 'orb_num', 'rgt', 'gt', 'segid_beg', 'segid_end']
+    cols_rh_metrics = ['h_max_can', 'h_can', 'h_can_quad', 'h_can_unc'] + ['rh' + str(rh) for rh in ExtractUtils.RH_V005]
+    cols_other_fields = ['n_ca_ph', 'n_toc_ph', 'can_open', 'can_rh_conf', 'seg_cover',
+                         'cloud_flg', 'msw_flg', 'n_seg_ph', 'night_flg', 'seg_landcov', 'seg_snow', 'seg_water',
+                         'sig_vert', 'sig_acr', 'sig_along', 'sig_h', 'sig_topo',
+                         'n_te_ph', 'h_te_best', 'h_te_unc', 'ter_slp', 'snr', 'sol_az', 'sol_el',
+                         'asr', 'h_dif_ref', 'ter_flg', 'ph_rem_flg', 'dem_rem_flg', 'seg_wmask', 'lyr_flg']
+
+    #*do_20m - add 20m segment columns
+    if do_20m:
+        cols_orb_gt_seg += ['lon_20m', 'lat_20m', 'id_20m']
+        cols_rh_metrics += ['h_can_20m']
+        cols_other_fields += ['h_te_best_20m']
+
+    return cols_orb_gt_seg + cols_rh_metrics + cols_other_fields
+
 # From a dataframe's columns, reorder them based on hardcoded list
 # Hardcoded list will not have all the columns*, and it may have items that 
 #  aren't in df's columns [eg if not running 20m segments]
@@ -171,26 +202,26 @@ def logOutput(logdir, bname, mode):
 
     return sys.stdout
 
-def reFormatArrays(inDict):
-    
-    outDict = {}
+def expand20mRows(out, dict_20m, val_nodata=None):
+    '''
+    *do_20m - Expand the 100m segment rows left after filtering to one row per 20m segment
+    The 100m columns are repeated for each of the 5 20m segments; the (n, 5) 20m arrays are subset to the
+    remaining 100m segments and flattened. val_nodata (if given) replaces NaN in the float 20m arrays.
+    The index is that of the fully expanded frame (100m row * 5 + 20m segment)
+    '''
     repeat = 5 # 5 20m segments in 100m segment
-    
-    for key, inArr in inDict.items():
-        outArr = np.array([])
-        
-        # 100m segment arrays need to have values multiplied
-        if inArr.ndim == 1: 
-            outArr = np.repeat(inArr, repeat)
-        
-        # 20m segment arrays need to have their 2nd dimension flattened
-        elif inArr.ndim == 2: 
-            outArr = inArr.flatten()
-            
-        # Build up the new dict
-        outDict[key] = outArr
-        
-    return outDict
+    idx = out.index.to_numpy()
+
+    out = out.iloc[np.repeat(np.arange(len(out)), repeat)]
+    out.index = (np.repeat(idx * repeat, repeat) + np.tile(np.arange(repeat), len(idx)))
+
+    for col, arr in dict_20m.items():
+        arr = arr[idx]
+        if val_nodata is not None and arr.dtype.kind == 'f':
+            arr[np.isnan(arr)] = val_nodata
+        out[col] = arr.ravel()
+
+    return out
 
 def rec_merge1(d1, d2):
     '''return new merged dict of dicts'''
@@ -201,26 +232,296 @@ def rec_merge1(d1, d2):
     d3.update(d2)
     return d3
 
+# Args a domain of a --domains config can set (see readDomains)
+DOMAIN_ARGS = ['minlon', 'maxlon', 'minlat', 'maxlat', 'minmonth', 'maxmonth', 'list_lc_h_can_thresh', 'dict_misc_thresh', 'filter_spec',
+               'columns', 'filter_qual', 'filter_geo', 'do_20m', 'do_100m_20m',
+               'columns_20m', 'list_lc_h_can_thresh_20m', 'dict_misc_thresh_20m', 'filter_spec_20m', 'output']
+
+def readDomains(domains_fn):
+    '''
+    Read a domain config (JSON, or YAML if it ends .yaml/.yml) of domain names and the args of each domain, eg:
+        {"howland": {"minlon": -69, "maxlon": -68, "minlat": 44, "maxlat": 46, "minmonth": 6, "maxmonth": 9, "do_20m": true},
+         "tanana":  {"minlon": -156, "maxlon": -143.5, "minlat": 62.5, "maxlat": 66.0, "minmonth": 6, "maxmonth": 9}}
+    Args a domain doesn't set are taken from the command line; each domain is written to <output dir>/<domain name> unless it sets an output dir
+    Used as an argparse type, so a bad config stops the run before any granule is read
+    '''
+    with open(domains_fn) as f:
+        if domains_fn.endswith(('.yaml', '.yml')):
+            import yaml
+            dict_domains = yaml.safe_load(f)
+        else:
+            dict_domains = json.load(f)
+
+    if not isinstance(dict_domains, dict) or len(dict_domains) == 0:
+        raise argparse.ArgumentTypeError(f"{domains_fn} needs a mapping of domain names to the args of each domain")
+    for domain, dict_domain in dict_domains.items():
+        if not isinstance(dict_domain, dict):
+            raise argparse.ArgumentTypeError(f"Domain {domain}: needs a mapping of args")
+        bad_args = [arg for arg in dict_domain if arg not in DOMAIN_ARGS]
+        if len(bad_args) > 0:
+            raise argparse.ArgumentTypeError(f"Domain {domain}: can't set {bad_args} (can set: {DOMAIN_ARGS})")
+        for arg in ['filter_spec', 'filter_spec_20m']:
+            if dict_domain.get(arg) is not None:
+                try:
+                    dict_domain[arg] = FilterUtils.read_filter_spec(dict_domain[arg])
+                except ValueError as e:
+                    raise argparse.ArgumentTypeError(f"Domain {domain}: {arg}: {e}")
+
+    return dict_domains
+
+def readFilterSpec(filter_spec):
+    '''
+    Read a filter spec: a preset name (v1-v4), a JSON file or a JSON string (see FilterUtils.read_filter_spec)
+    Used as an argparse type, so a bad spec stops the run before any granule is read
+    '''
+    try:
+        return FilterUtils.read_filter_spec(filter_spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def getOutputArgs(args):
+    '''
+    Return a copy of args for each output: the 100m or 20m output, or (with --do_100m_20m) one of each
+    With --domains, these outputs are made for each domain, with the args of the domain set
+    The 20m output of --do_100m_20m takes its own columns and quality filter thresholds from the *_20m args, if given
+    Each copy also gets its domain, segment_length, the filter_spec and subset_cols_list of the quality filter and its output columns (cols_out)
+    The quality filter is --filter_spec, or else the v4 filter of the --list_lc_h_can_thresh, --dict_misc_thresh and month args
+    '''
+    list_domain_args = []
+    if args.domains is None:
+        domain_args = copy.copy(args)
+        domain_args.domain = None
+        list_domain_args.append(domain_args)
+    else:
+        for domain, dict_domain in args.domains.items():
+            domain_args = copy.copy(args)
+            domain_args.domain = domain
+            domain_args.output = os.path.join(args.output, domain)
+            for arg, val in dict_domain.items():
+                setattr(domain_args, arg, val)
+            list_domain_args.append(domain_args)
+
+    list_out_args = []
+    for domain_args, do_20m in [(domain_args, do_20m) for domain_args in list_domain_args
+                                for do_20m in ([False, True] if domain_args.do_100m_20m else [domain_args.do_20m])]:
+        out_args = copy.copy(domain_args)
+        out_args.do_20m = do_20m
+        out_args.segment_length = 20 if do_20m else 100
+
+        if do_20m and domain_args.do_100m_20m:
+            for arg in ['columns', 'dict_misc_thresh', 'list_lc_h_can_thresh', 'filter_spec']:
+                if getattr(domain_args, arg + '_20m') is not None:
+                    setattr(out_args, arg, getattr(domain_args, arg + '_20m'))
+
+        if out_args.filter_spec is None:
+            out_args.filter_spec = FilterUtils.get_filter_spec(out_args.dict_misc_thresh, list_lc_h_can_thresh=out_args.list_lc_h_can_thresh,
+                                                               month_min=out_args.minmonth, month_max=out_args.maxmonth)
+
+        # Output columns: the --columns projection if given; otherwise what the quality filter returns, or everything
+        out_args.subset_cols_list = None
+        if out_args.filter_qual:
+            out_args.subset_cols_list = SUBSET_COLS_LIST + (SUBSET_COLS_LIST_20M if do_20m else [])
+            if out_args.columns is not None:
+                out_args.subset_cols_list = [c for c in out_args.columns if c not in ['lon', 'lat']]
+            out_args.cols_out = ['lon', 'lat'] + out_args.subset_cols_list
+        else:
+            out_args.cols_out = getAllColumns(do_20m) if out_args.columns is None else out_args.columns
+
+        list_out_args.append(out_args)
+
+    return list_out_args
+
+def writeFunnel(funnel, args):
+    '''
+    Write the filter funnel of an output as JSON next to it: <output name>_funnel.json
+    '''
+    funnel_fn = os.path.splitext(args.out_fn)[0] + '_funnel.json'
+    if args.domain is not None:
+        os.makedirs(args.output, exist_ok=True)
+    print(f'Filter funnel: \t\t{funnel_fn}')
+    with open(funnel_fn, 'w') as f:
+        json.dump(funnel, f, indent=1)
+
+def filterWriteOutput(out, dict_20m, args, val_invalid, funnel, profile=None):
+    '''
+    Filter the 100m segment dataframe of a granule for one output, with the args of that output (see getOutputArgs).
+    A 20m output is then expanded to 20m rows. The output is written out (the input dataframe is left for the other outputs)
+    funnel: a dict filled with the filter config (spec and bbox), the obs left after each filter stage (see FilterUtils.filter_atl08_spec)
+            and the rows out (n_rows); written next to the output (unless --no-funnel)
+    profile: with --profile, the filter, expand and write phases of the output are lapped (see ProfileUtils)
+    Returns the output dataframe, or None if it was empty after filtering
+    '''
+    output = str(args.segment_length) + 'm' if args.domain is None else args.domain + '/' + str(args.segment_length) + 'm'
+    # The quality filter prep adds columns to its input; keep those out of the dataframe the other outputs share
+    out = out.copy(deep=False)
+    funnel.update({'domain': args.domain, 'segment_length': args.segment_length,
+                   'filter_spec': args.filter_spec if args.filter_qual else None,
+                   'bbox': [args.minlon, args.maxlon, args.minlat, args.maxlat] if args.filter_geo else None,
+                   'n_input': len(out), 'stages': [], 'n_output': len(out)})
+
+    if args.filter_qual:
+
+        print('Quality Filtering: \t\t[ON]')
+
+        # These filters are customized for boreal
+        '''out = FilterUtils.prep_filter_atl08_qual(out)
+        out = FilterUtils.filter_atl08_qual_v2(out, SUBSET_COLS=True, DO_PREP=False,
+                                                   subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh90','h_can','h_max_can','h_can_quad','h_can_unc',
+                                                                     'h_te_best','h_te_unc', 'granule_name','can_rh_conf', 'h_dif_ref',
+                                                                     'seg_landcov','seg_cover','night_flg','seg_water','sol_el','asr','ter_slp', 'ter_flg','y','m','d'], 
+                                                   filt_cols=['h_can','h_dif_ref','m','msw_flg','beam_type','seg_snow','sig_topo'], 
+                                                   thresh_h_can=100, thresh_h_dif=25, thresh_sig_topo=2.5, month_min=args.minmonth, month_max=args.maxmonth)
+                                                   '''
+        # print('Apply the aggressive land-cover based (v3) filters updated in Jan/Feb 2022')
+        # out = FilterUtils.filter_atl08_qual_v3(out, SUBSET_COLS=True, DO_PREP=True,
+        #                                       subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh90','h_can','h_max_can',
+        #                                                              'h_te_best','granule_name',
+        #                                                              'seg_landcov','seg_cover','sol_el','y','m','doy'], 
+        #                                            filt_cols=['h_can','h_dif_ref','m','msw_flg','beam_type','seg_snow','sig_topo'], 
+        #                                            list_lc_h_can_thresh=args.list_lc_h_can_thresh,
+        #                                            thresh_h_can=100, thresh_h_dif=25, thresh_sig_topo=2.5, month_min=args.minmonth, month_max=args.maxmonth)
+        # 20m columns are added after filtering (if only 20m columns were asked for, h_can stands in; --columns drops it again)
+        subset_cols_list_100m = [c for c in args.subset_cols_list if c not in COLS_20M]
+        if len(subset_cols_list_100m) == 0:
+            subset_cols_list_100m = ['h_can']
+        print(f'Apply the filter spec (default: the aggressive land-cover based (v4) filters updated in Jan/Feb 2022): {json.dumps(args.filter_spec)}')
+        out = FilterUtils.filter_atl08_spec(out, args.filter_spec, SUBSET_COLS=True, DO_PREP=True,
+                                            subset_cols_list=subset_cols_list_100m, funnel=funnel)
+        ProfileUtils.lap(profile, 'filter_qual', output)
+    else:
+        print('Quality Filtering: \t[OFF] (do downstream)')
+
+    if args.filter_geo:
+        print('Geographic Filtering: \t[ON] xmin = {}, xmax = {}, ymin = {}, ymax = {}'.format(args.minlon, args.maxlon, args.minlat, args.maxlat))        
+        # These filters are customized for boreal 
+        mask_func, mask_cols = FilterUtils.compile_filter_spec({'bbox': [[args.minlon, args.maxlon, args.minlat, args.maxlat]]})
+        out = out[mask_func(out, funnel=funnel['stages'])]
+        funnel['n_output'] = len(out)
+        ProfileUtils.lap(profile, 'filter_geo', output)
+    else:
+        print('Geographic Filtering: \t[OFF] (do downstream)')
+
+    # After filtering, output dataframe may be empty. If so, exit program
+    if out.empty:
+        print('\nFile is empty after filtering. Exiting')
+        funnel['n_rows'] = 0
+        if args.write_funnel and not args.output_dataframe:
+            writeFunnel(funnel, args)
+        ProfileUtils.lap(profile, 'write', output)
+        return None
+    else:
+        # PMM edit: BUT, why do we need unique ID cols?
+        # This will fail if you do quality filtering above, b/c that function doesnt return fields needed for the uniqueID field ('id_20m')
+        if False:
+            #*do_20m - GET UNIQUE ID FIELDS
+            # If not doing 20m segments, unique_id = 100m segment ID
+            # If doing 20m segments, unique_id = 100m segment ID + 20m segment ID
+            # So 100m.csv will have just unique ID and 100m segment ID 
+              # (which = unique ID)
+            # 20m.csv will have unique ID, 100m seg ID, 20m seg ID
+              # (id_20m already exists as column if do_20m)
+
+            print("\nStart by getting 100m segment ID\n")
+            print(out.head())
+            out['id_100m'] = list(map(lambda ln, lt, dt: get100mSegId(ln, lt, dt), \
+                                                    out['lon'], out['lat'], out['dt']))
+
+            # If doing 20m segments, then unique ID is combo of id_100m and id_20m
+            if args.do_20m: 
+                out['id_unique'] = list(map(lambda i1, i2: \
+                                '{}-{}'.format(i1, i2), out['id_100m'], out['id_20m']))
+
+            # Otherwise, unique ID is just 100m id (yes this will add a duplicate
+            # column but it will enable a consisent unique ID column name. 
+            # un-likely to process 100m with this code anyways so w/e)
+            else:
+                out['id_unique'] = out['id_100m']
+
+        #*do_20m - Expand the remaining 100m segments to 20m rows
+        if args.do_20m:
+            st = time.time()
+            print(f'\nExpanding {len(out)} 100m segments to 20m rows...')
+            out = expand20mRows(out, {col: arr for col, arr in dict_20m.items() if col in args.cols_out}, 
+                                val_nodata=None if args.set_nodata_nan else val_invalid)
+            calculateElapsedTime(st, time.time())
+            ProfileUtils.lap(profile, 'expand_20m', output)
+
+        # Keep only the requested columns (derived columns are in the shared dataframe if any output wanted them)
+        if args.columns is not None:
+            out = out[[c for c in out.columns if c in args.columns]]
+        else:
+            out = out[[c for c in out.columns if c not in FilterUtils.PREP_COLS or c in args.cols_out]]
+
+        # Lastly, try and reorder the columns before writing out. 
+        # This part is partially hardcoded according to expected column names
+        colsOrdered = getOrderedColumns(out)
+        out = out[colsOrdered]
+
+        # At this point we know out DF is not empty - Write out
+        print(f'\nWriting output with shape {out.shape}')
+        
+        if args.output_dataframe:
+            print(f'Returning output dataframe of shape: {out.shape}')
+        else:
+            # Write out to a csv (or parquet/feather)
+            if args.domain is not None:
+                os.makedirs(args.output, exist_ok=True)
+            print(f'Creating {args.output_format.upper()}: \t\t{args.out_fn}')
+            ExtractUtils.write_atl08_df(out, args.out_fn, args.output_format)
+
+    funnel['n_rows'] = len(out)
+    if args.write_funnel and not args.output_dataframe:
+        writeFunnel(funnel, args)
+    ProfileUtils.lap(profile, 'write', output)
+
+    return out
+
+# Outcomes of extract_atl08 for a granule (batch_extract_atl08.py collects these into a summary)
+STATUS_WRITTEN   = 'written'
+STATUS_EMPTY     = 'empty'          # no obs left after filtering
+STATUS_NO_POINTS = 'no_good_points' # no beam with data, or the pre-filter (or filter pushdown) found no good points
+STATUS_EXISTS    = 'exists'         # output exists and overwrite is off
+STATUS_NO_20M    = 'no_20m'         # 20m output asked for from a product version without 20m segments (before v005)
+STATUS_ERROR     = 'error'
+
 def extract_atl08(args):
+    '''
+    Extract (and filter) the land segments of an ATL08 granule to a CSV
+    Returns one of the STATUS_* outcomes (or the output dataframe with --output_dataframe)
+    '''
    
     # Input sanitization
     if str(args.input).endswith('.h5'):
         pass
     else:
         print("INPUT ICESAT2 FILE MUST END '.H5'")
-        os._exit(1)
+        return STATUS_ERROR
     if args.output == None:
         print("\n OUTPUT DIR IS NOT SPECIFIED (OPTIONAL). OUTPUT WILL BE PLACED IN THE SAME LOCATION AS INPUT H5 \n\n")
     else:
         pass
     if args.resolution == None:
         print("SPECIFY OUTPUT RASTER RESOLUTION IN METERS'")
-        os._exit(1)
+        return STATUS_ERROR
     else:
         pass 
+    if args.domains is not None and args.output is None:
+        print("A DOMAIN CONFIG NEEDS AN OUTPUT DIR (-o) FOR THE DOMAIN SUBDIRS")
+        return STATUS_ERROR
 
     TEST = args.TEST
-    do_20m = args.do_20m
+
+    # With --profile, the phases of the granule are lapped into its profile (see ProfileUtils); main() or the batch writes it out
+    profile = ProfileUtils.start_profile(os.path.basename(args.input).split('.')[0]) if args.profile is not None else None
+    args.profile_record = profile
+
+    # The filter funnel of each output (see filterWriteOutput), for a batch to sum up
+    args.list_funnels = []
+
+    # One set of args for each output (100m and/or 20m, of each domain); the granule is read once for all of them
+    list_out_args = getOutputArgs(args)
+    do_20m = any([out_args.do_20m for out_args in list_out_args])
+    cols_all = getAllColumns(do_20m)
 
     # File path to ICESat-2h5 file
     H5 = args.input
@@ -229,6 +530,18 @@ def extract_atl08(args):
     inDir = '/'.join(H5.split('/')[:-1])
     granule_fname = H5.split('/')[-1]
     Name = granule_fname.split('.')[0]
+
+    # Get version
+    atl08_version = ExtractUtils.get_atl08_version(granule_fname)
+
+    #*do_20m - the 20m segments are new in v005; skip the 20m outputs of an older granule
+    if do_20m and ExtractUtils.get_schema_version(atl08_version) not in ExtractUtils.ATL08_SCHEMA['lat_20m']['versions']:
+        print(f"\nATL08 v{atl08_version:03d} has no 20m segments, skipping the 20m output")
+        list_out_args = [out_args for out_args in list_out_args if not out_args.do_20m]
+        if len(list_out_args) == 0:
+            return STATUS_NO_20M
+        do_20m = False
+        cols_all = getAllColumns(do_20m)
     
     # Set up output and logging directories
     if args.output == None:
@@ -238,27 +551,31 @@ def extract_atl08(args):
         outbase = os.path.join(args.output, Name)
         logdir  = os.path.join(args.output, '_logs')
         
-    # Need this block now so we can get output .csv name and check for existence
+    # Need this block now so we can get output file names and check for existence
     land_seg_path = '/land_segments/' # Now, everything point-specific (for 100m or 20m segments) is within this tag
-    if do_20m:
-        segment_length = 20
-    else:
-        segment_length = 100
-    fn_tail = '_' + str(segment_length) + 'm.csv'
-    out_csv_fn = os.path.join(outbase + fn_tail)
+    for out_args in list_out_args:
+        fn_tail = '_' + str(out_args.segment_length) + 'm' + ExtractUtils.OUTPUT_FORMATS[args.output_format]
+        out_args.out_fn = outbase + fn_tail if out_args.domain is None else os.path.join(out_args.output, Name + fn_tail)
 
     # Check file existence before logging:
-    if args.overwrite:
-        # Overwite is True (on)
-        pass
-    else:
-        if os.path.isfile(out_csv_fn):
-            # Overwite is False (off) and file exists
-            print(" FILE EXISTS AND WE'RE NOT OVERWRITING\n")
-            os._exit(1)
-        else:
-            # Overwite is False (off) but file DOES NOT exist
-            pass
+    if not args.overwrite:
+        # Overwite is False (off): only make the outputs that don't exist
+        for out_args in [out_args for out_args in list_out_args if os.path.isfile(out_args.out_fn)]:
+            print(f" FILE EXISTS AND WE'RE NOT OVERWRITING: {out_args.out_fn}\n")
+            list_out_args.remove(out_args)
+        if len(list_out_args) == 0:
+            return STATUS_EXISTS
+        do_20m = any([out_args.do_20m for out_args in list_out_args])
+        cols_all = getAllColumns(do_20m)
+
+    # Filter pushdown: the geographic stage reads the segments inside any output's bbox,
+    # the quality stage needs every output to use the same quality filter
+    filter_pushdown_geo  = args.filter_pushdown and all([out_args.filter_geo for out_args in list_out_args])
+    filter_pushdown_qual = args.filter_pushdown and all([out_args.filter_qual for out_args in list_out_args]) and \
+                           len(set([json.dumps(out_args.filter_spec, sort_keys=True) for out_args in list_out_args])) == 1
+    filter_pushdown = filter_pushdown_geo or filter_pushdown_qual
+    if args.filter_pushdown and not filter_pushdown:
+        print("\nFilter pushdown needs geographic filtering, or the same quality filtering for each output; turning it off.")
         
     # Log output if arg supplied    
     if args.logging:
@@ -270,7 +587,9 @@ def extract_atl08(args):
     print("\nBegin: {}".format(time.strftime("%m-%d-%y %I:%M:%S %p")))
     print("\nATL08 granule name: \t{}".format(Name))
     print("Input dir: \t\t{}".format(inDir))
-    print("\nSegment length: {}m".format(segment_length)) 
+    print("\nSegment length: {}".format(', '.join(sorted(set([str(out_args.segment_length) + 'm' for out_args in list_out_args]), reverse=True))))
+    if args.domains is not None:
+        print("Domains: \t{}".format(', '.join(args.domains)))
     
     if args.filter_geo:
         print("\nMin lat: {}".format(args.minlat))
@@ -278,290 +597,118 @@ def extract_atl08(args):
         print("Min lon: {}".format(args.minlon))
         print("Max lon: {}\n\n".format(args.maxlon))
     
-    # open file
-    f = h5py.File(H5,'r')
-
-    # Set up acq date
-    dt, yr, m, d = ([] for i in range(4))
-
-    # Set up orbit info fields
-    gt, orb_num, rgt, orb_orient = ([] for i in range(4))
-
-    # Set the names of the 6 lasers
-    lines = ['gt1r', 'gt1l', 'gt2r', 'gt2l', 'gt3r', 'gt3l']
-
-    # set up blank lists
-    latitude, longitude, segid_beg, segid_end = ([] for i in range(4))
-
-    # Canopy fields - 100m
-    # no RH % specific fields, for 100m or otherwise
-    #can_h_met_0, can_h_met_1, can_h_met_2, can_h_met_3, can_h_met_4, can_h_met_5, can_h_met_6, can_h_met_7, can_h_met_8 = ([] for i in range(9))
-    can_h_met = []   # Relative	(RH--)	canopy height	metrics calculated	at	the	following	percentiles: 25,50,	60,	70,	75,	80,	85,	90,	95
-    h_max_can = []
-    h_can = []      # 98% height of all the individual canopy relative heights for the segment above the estimated terrain surface. Relative canopy heights have been computed by differencing the canopy photon height from the estimated terrain surface.
-    h_can_quad = []
-    h_can_unc = []
-    
-    n_ca_ph = []
-    n_toc_ph = []
-    can_open = []    # stdv of all photons classified as canopy within segment
-    can_rh_conf = [] # Canopy relative height confidence flag based on percentage of ground and canopy photons within a segment: 0 (<5% canopy), 1 (>5% canopy, <5% ground), 2 (>5% canopy, >5% ground)
-   
-    #*v005 - remove tcc_flg and tcc_prc ref - use seg_cover
-    #tcc_flg = [] # Flag indicating that more than 50% of the Landsat Continuous Cover product have values > 100 for the L-Km segment.  Canopy is assumed present along the L-km segment if landsat_flag is 1.
-    seg_cover = [] # Average percentage value of the valid (value <= 100) Copernicus fractional cover product for each 100 m segment
-
-    #*do_20m - additional fields for 20m segments:
-    if do_20m:
-        latitude_20m  = []
-        longitude_20m = []
-        h_can_20m = []
-        h_te_best_20m = []
-        seg20_id = []
-
-    # Uncertainty fields
-    n_seg_ph = []   # Number of photons within each land segment.
-    cloud_flg = []     # Valid range is 0 - 10. Cloud confidence flag from ATL09 that indicates the number of cloud or aerosol layers identified in each 25Hz atmospheric profile. If the flag is greater than 0, aerosols or clouds could be present.
-    msw_flg = []    # Multiple Scattering warning flag. The multiple scattering warning flag (ATL09 parameter msw_flag) has values from -1 to 5 where zero means no multiple scattering and 5 the greatest. If no layers were detected, then msw_flag = 0. If blowing snow is detected and its estimated optical depth is greater than or equal to 0.5, then msw_flag = 5. If the blowing snow optical depth is less than 0.5, then msw_flag = 4. If no blowing snow is detected but there are cloud or aerosol layers detected, the msw_flag assumes values of 1 to 3 based on the height of the bottom of the lowest layer: < 1 km, msw_flag = 3; 1-3 km, msw_flag = 2; > 3km, msw_flag = 1. A value of -1 indicates that the signal to noise of the data was too low to reliably ascertain the presence of cloud or blowing snow. We expect values of -1 to occur only during daylight.
-    night_flg = []
-    seg_landcov = [] # IGBP Land Cover Surface type classification as reference from MODIS Land Cover(ANC18) at the 0.5 arcsecond res. flag_values: 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16 flag_meanings : Water Evergreen_Needleleaf_Forest Evergreen_Broadleaf_Forest Deciduous_Needleleaf_Forest Deciduous_Broadleaf_Forest Mixed_Forest Closed_Shrublands Open_Shrubla
-
-    seg_snow = []  # 0=ice free water; 1=snow free land;  2=snow; 3=ice. Daily snow/ice cover from ATL09 at the 25 Hz rate(275m) indicating likely presence of snow and ice within each segment.
-    seg_water = []  # no_water=0, water=1. Water mask(i.e. flag) indicating inland water as referenced from the Global Raster Water Mask(ANC33) at 250 m spatial resolution.
-    sig_vert = []    # Total vertical geolocation error due to ranging and local surface slope.  The parameter is computed for ATL08 as described in equation 1.2.
-    sig_acr = []       # Total cross-track uncertainty due to PPD and POD knowledge.  Read from ATL03 product gtx/geolocation/sigma_across. Sigma_atlas_y is reported on ATL08 as the uncertainty of the center-most reference photon of the 100m ATL08 segment.
-    sig_along = []        # Total along-track uncertainty due to PPD and POD knowledge.  Read from ATL03 product gtx/geolocation/sigma_along. Sigma_atlas_x is reported on ATL08 as the uncertainty of the center-most reference photon of the 100m ATL08 segment.
-    sig_h = []            # Estimated uncertainty for the reference photon bounce point ellipsoid height: 1- sigma (m) provided at the geolocation segment rate on ATL03.  Sigma_h is reported on ATL08 as the uncertainty of the center-most reference photon of the 100m ATL08 segment.
-    sig_topo = []         # Total uncertainty that include sigma_h plus geolocation uncertainty due to local slope (equation 1.3).  The local slope is multiplied by the geolocation uncertainty factor. This will be used to determine the total vertical geolocation error due to ranging and local slope.
-
-    # Terrain fields
-    n_te_ph = []
-    h_te_best = []  # The best fit terrain elevation at the the mid-point location of each 100m segment. The mid-segment terrain elevation is determined by selecting the best of three fits- linear, 3rd order and 4th order polynomials - to the terrain photons and interpolating the elevation at the mid-point location of the 100 m segment. For the linear fit, a slope correction and weighting is applied to each ground photon based on the distance to the slope height at the center of the segment.
-    h_te_unc = []    # Uncertainty of the mean terrain height for the segment. This uncertainty incorporates all systematic uncertainties(e.g. timing orbits, geolocation,etc.) as well as uncertainty from errors of identified photons.  This parameter is described in section 1, equation 1.4
-    ter_slp = []        # The along-track slope of terrain, within each segment;computed by a linear fit of terrain classified photons. Slope is in units of delta height over delta along track distance.
-    snr = []        # The signal to noise ratio of geolocated photons as determined by the ratio of the superset of ATL03 signal and DRAGANN found signal photons used for processing the ATL08 segments to the background photons (i.e. noise) within the same ATL08 segments.
-    sol_az = []     # The direction, eastwards from north, of the sun vector as seen by an observer at the laser ground spot.
-    sol_el = []     # Solar Angle above or below the plane tangent to the ellipsoid surface at the laser spot. Positive values mean the sun is above the horizon, while  negative values mean it is below the horizon. The effect of atmospheric refraction is not included. This is a low precision value, with approximately TBD degree accuracy.
-
-    asr = []		# Apparent surface reflectance
-    h_dif_ref = []	# height difference from reference DEM
-    ter_flg = []
-    ph_rem_flg = []
-    dem_rem_flg = []
-    seg_wmask = []
-    lyr_flg = []
-
-    # NEED TO ADD THESE
-    #h_canopy_uncertainty = []
-    #h_canopy_quad = []
-
-    if False:
-        # Granule level info
-        granule_dt = datetime.strptime(Name.split('_')[1], '%Y%m%d%H%M%S')
-
-        YEAR = granule_dt.year
-        MONTH = granule_dt.month
-        DOY = granule_dt.timetuple().tm_yday
-
-        Arrtemp = f['/orbit_info/orbit_number/'][...,]
-
-        temp = np.empty_like(Arrtemp, dtype='a255')
-        temp[...] = YEAR
-        yr.append(temp)
-
-        temp = np.empty_like(Arrtemp, dtype='a255')
-        temp[...] = YEAR
-        yr.append(temp)
-
-        temp = np.empty_like(Arrtemp, dtype='a255')
-        temp[...] = MONTH
-        m.append(temp)
-
-        temp = np.empty_like(Arrtemp, dtype='a255')
-        temp[...] = DOY
-        d.append(temp)
-
-    dt.append(f['/ancillary_data/granule_end_utc/'][...,].tolist())
-    orb_orient.append(f['/orbit_info/sc_orient/'][...,].tolist())
-    orb_num.append(f['/orbit_info/orbit_number/'][...,].tolist())
-    rgt.append(f['/orbit_info/rgt/'][...,].tolist())
-
-    dt          =np.array([dt[l][k] for l in range(1) for k in range(len(dt[l]))] )    
-    orb_orient  =np.array([orb_orient[l][k] for l in range(1) for k in range(len(orb_orient[l]))] )
-    orb_num     =np.array([orb_num[l][k] for l in range(1) for k in range(len(orb_num[l]))] )
-    rgt         =np.array([rgt[l][k] for l in range(1) for k in range(len(rgt[l]))] )
-
     # Beam level info
-    # For each laser read the data and append to its list
-    for line in lines:
-
-        # It might be the case that a specific line/laser has no members in the h5 file.
-        # If so, catch the error and skip - MW 3/31
-        try:
-            latitude.append(f['/' + line    + land_seg_path + 'latitude/'][...,].tolist())
-        except KeyError:
-            continue # No info for laser/line, skip it and move on to next line
-
-        longitude.append(f['/' + line   + land_seg_path + 'longitude/'][...,].tolist())
-
-        # Get ground track
-        Arrtemp = f['/' + line  + land_seg_path + 'latitude/'][...,]
-        temp = np.empty_like(Arrtemp, dtype='a255')
-        temp[...] = line
-        gt.append(temp)
-
-        segid_beg.append(f['/' + line   + land_seg_path + 'segment_id_beg/'][...,].tolist())
-        segid_end.append(f['/' + line   + land_seg_path + 'segment_id_end/'][...,].tolist())
-        
-        # Canopy fields
-
-        #*do_20m - build 20m lists from .h5 data
-          # None of these fields exist for 20m segments as of now, except
-          # RH98 (h_canopy_20m), lat/lon (_20m), h_te_best_fit_20m
-          
-        if do_20m:
-            latitude_20m.append(f['/' + line    + land_seg_path + 'latitude_20m/'][...,].tolist())
-            longitude_20m.append(f['/' + line   + land_seg_path + 'longitude_20m/'][...,].tolist())
-            h_can_20m.append(f['/' + line       + '/land_segments/canopy/h_canopy_20m'][...,].tolist())
-
-            # Build the segment ID column using latitude array:            
-            n_20m = len(f['/' + line    + land_seg_path + 'latitude_20m/'][...,].tolist()) # number of 20m segment shots in line
-            segList = [1, 2, 3, 4, 5]
-            seg20_id.append([segList for i in range(n_20m)]) # list created in append will be same size/shape as other 20m lists 
-            
-            
-        #*do_20m - Instead of if/else, we want 20m-specific info to be 
-          # extracted in addition to 100m, not instead of 
-        can_h_met.append(f['/' + line   + '/land_segments/canopy/canopy_h_metrics/'][...,].tolist())
-        
-        h_max_can.append(f['/' + line   + '/land_segments/canopy/h_max_canopy/'][...,].tolist())
-        h_can.append(f['/' + line       + '/land_segments/canopy/h_canopy/'][...,].tolist())
-        h_can_quad.append(f['/' + line  + '/land_segments/canopy/h_canopy_quad'][...,].tolist())
-        h_can_unc.append(f['/' + line   + '/land_segments/canopy/h_canopy_uncertainty'][...,].tolist())
-            
-        n_ca_ph.append(f['/' + line     + '/land_segments/canopy/n_ca_photons/'][...,].tolist())
-        n_toc_ph.append(f['/' + line    + '/land_segments/canopy/n_toc_photons/'][...,].tolist())
-        can_open.append(f['/' + line    + '/land_segments/canopy/canopy_openness/'][...,].tolist())
-        can_rh_conf.append(f['/' + line + '/land_segments/canopy/canopy_rh_conf/'][...,].tolist())
-        
-        #*v005 - seg_cover replaces tcc
-        seg_cover.append(f['/' + line     + '/land_segments/canopy/segment_cover/'][...,].tolist())
-    
-        # Uncertainty fields
-        cloud_flg.append(f['/' + line   + land_seg_path + 'cloud_flag_atm/'][...,].tolist())
-        msw_flg.append(f['/' + line     + land_seg_path + 'msw_flag/'][...,].tolist())
-        n_seg_ph.append(f['/' + line    + land_seg_path + 'n_seg_ph/'][...,].tolist())
-        night_flg.append(f['/' + line   + land_seg_path + 'night_flag/'][...,].tolist())
-        seg_landcov.append(f['/' + line + land_seg_path + 'segment_landcover/'][...,].tolist())
-        seg_snow.append(f['/' + line    + land_seg_path + 'segment_snowcover/'][...,].tolist())
-        seg_water.append(f['/' + line   + land_seg_path + 'segment_watermask/'][...,].tolist())
-        sig_vert.append(f['/' + line    + land_seg_path + 'sigma_atlas_land/'][...,].tolist())
-        sig_acr.append(f['/' + line     + land_seg_path + 'sigma_across/'][...,].tolist())
-        sig_along.append(f['/' + line   + land_seg_path + 'sigma_along/'][...,].tolist())
-        sig_h.append(f['/' + line       + land_seg_path + 'sigma_h/'][...,].tolist())
-        sig_topo.append(f['/' + line    + land_seg_path + 'sigma_topo/'][...,].tolist())
-
-        # Terrain fields
-        #*do_20m - Grab the only terrain field for 20m segment
-        if do_20m:
-            h_te_best_20m.append(f['/' + line   + '/land_segments/terrain/h_te_best_fit_20m'][...,].tolist())
-
-        n_te_ph.append(f['/' + line     + '/land_segments/terrain/n_te_photons/'][...,].tolist())
-        h_te_best.append(f['/' + line   + '/land_segments/terrain/h_te_best_fit/'][...,].tolist())
-        h_te_unc.append(f['/' + line    + '/land_segments/terrain/h_te_uncertainty/'][...,].tolist())
-        ter_slp.append(f['/' + line     + '/land_segments/terrain/terrain_slope/'][...,].tolist())
-            
-        snr.append(f['/' + line         + land_seg_path + 'snr/'][...,].tolist())
-        sol_az.append(f['/' + line      + land_seg_path + 'solar_azimuth/'][...,].tolist())
-        sol_el.append(f['/' + line      + land_seg_path + 'solar_elevation/'][...,].tolist())
-
-        asr.append(f['/' + line         + land_seg_path + 'asr/'][...,].tolist())
-        h_dif_ref.append(f['/' + line   + land_seg_path + 'h_dif_ref/'][...,].tolist())
-        ter_flg.append(f['/' + line     + land_seg_path + 'terrain_flg/'][...,].tolist())
-        ph_rem_flg.append(f['/' + line  + land_seg_path + 'ph_removal_flag/'][...,].tolist())
-        dem_rem_flg.append(f['/' + line + land_seg_path + 'dem_removal_flag/'][...,].tolist())
-        seg_wmask.append(f['/' + line   + land_seg_path + 'segment_watermask/'][...,].tolist())
-        lyr_flg.append(f['/' + line     + land_seg_path + 'layer_flag/'][...,].tolist())
-    
-    # MW 3/31/20: Originally a length of 6 was hardcoded into the below calculations because the
-    #          assumption was made that 6 lines/lasers worth of data was stored in the arrays. With
-    #	       the above changes made to the beginning of the 'for line in lines' loop on 3/31, this
-    #          assumption is no longer always true. Adding nLines var to replace range(6) below
-    nLines = len(latitude)
+    # Figure out which columns are needed: the output projection plus whatever the active filters use.
+    # Only these datasets are read from the h5 (see ExtractUtils.ATL08_SCHEMA for the path, dtype, fill and versions of each)
+    cols_wanted = ['lon', 'lat', 'h_can']
+    for out_args in list_out_args:
+        cols_wanted += out_args.cols_out
+        if out_args.filter_qual:
+            cols_wanted += FilterUtils.get_filter_spec_cols(out_args.filter_spec)
+    if TEST:
+        cols_wanted += ['n_ca_ph', 'n_toc_ph']
+    # Derived columns (beam type, acq date parts) are added after reading, from the columns they need
+    cols_derived = [c for c in FilterUtils.PREP_COLS if c in cols_wanted]
+    cols_wanted = ExtractUtils.expand_cols(cols_wanted)
+
+    if not do_20m and any([c in COLS_20M for c in cols_wanted]):
+        print(f"\n20m columns need --do_20m, skipping: {[c for c in cols_wanted if c in COLS_20M]}")
+        cols_wanted = [c for c in cols_wanted if c not in COLS_20M]
+
+    # Keep the usual column order; requested columns outside of it go at the end
+    cols_extract = [c for c in cols_all if c in cols_wanted] + [c for c in cols_wanted if c not in cols_all]
+    read_cols = ExtractUtils.get_read_cols(cols_extract, atl08_version)
+    print(f"\nReading {len(read_cols)} of {len(ExtractUtils.ATL08_SCHEMA)} ATL08 columns")
+    ProfileUtils.lap(profile, 'setup')
+
+    # Extract once, filter many: with a cache dir, all of the unfiltered segments of a granule are cached,
+    # and later runs (eg, with new filter thresholds or bounds) read them from the cache instead of the h5
+    dict_cached = None
+    if args.cache_dir is not None:
+        import CacheUtils
+        if filter_pushdown:
+            print("Filter pushdown is not used with the cache (the cache holds all of the segments)")
+            filter_pushdown = False
+        cache_fn = CacheUtils.get_cache_fn(args.cache_dir, granule_fname)
+        dict_cached = CacheUtils.read_cache(cache_fn, H5, read_cols)
+        ProfileUtils.lap(profile, 'read_cache')
+
+    if dict_cached is None:
+        # open file
+        f = h5py.File(H5,'r')
+
+        # Granule level info: acq date and orbit info fields
+        dict_granule = ExtractUtils.read_granule_info(f)
+        ProfileUtils.lap(profile, 'open')
+
+    if dict_cached is not None:
+        print(f"Read from cache: \t{cache_fn}")
+        dict_granule, dict_cols = dict_cached
+    elif args.cache_dir is not None:
+        cache_cols = CacheUtils.get_cache_cols(atl08_version)
+        print(f"Caching all {len(cache_cols)} ATL08 v{atl08_version:03d} columns: \t{cache_fn}")
+        dict_cols = ExtractUtils.read_atl08_columns(f, cache_cols, atl08_version, profile=profile)
+        ProfileUtils.lap(profile, 'read')
+        if dict_cols is not None:
+            CacheUtils.write_cache(cache_fn, H5, dict_granule, dict_cols)
+            CacheUtils.evict_cache(args.cache_dir, args.cache_max_gb)
+            dict_cols = {col: dict_cols[col] for col in read_cols + ['gt']}
+            ProfileUtils.lap(profile, 'write_cache')
+    elif filter_pushdown:
+        # Apply the filters while reading. The month and beam type filters are granule and beam level,
+        # so whole granules and weak beams are skipped before any segment data is read.
+        # Then, for each beam: lat/lon are read to find the index runs inside the bbox, the quality flag and threshold
+        # datasets are read over those runs, and the other datasets are read only for the rows that pass both.
+        # (the geographic and quality filters below still run on what was read)
+        print('Filter pushdown: \t\t[ON]')
+        lines = ExtractUtils.LINES
+        list_masks = []
+
+        if filter_pushdown_geo:
+            # Inside the bbox of any of the outputs
+            list_bbox = list(dict.fromkeys([(out_args.minlon, out_args.maxlon, out_args.minlat, out_args.maxlat) for out_args in list_out_args]))
+            mask_func, mask_cols = FilterUtils.compile_filter_spec({'bbox': list_bbox})
+            list_masks.append((mask_cols, mask_func))
+        if filter_pushdown_qual:
+            filter_spec = list_out_args[0].filter_spec
+
+            if 'm' in filter_spec.get('range', {}):
+                month_min, month_max = filter_spec['range']['m']
+                granule_month = pd.to_datetime(dict_granule['dt'].decode('utf-8')).month
+                if granule_month < month_min or granule_month > month_max:
+                    print(f"\nGranule month ({granule_month}) is outside of {month_min}-{month_max}. Exiting")
+                    f.close()
+                    return STATUS_NO_POINTS
+
+            if filter_spec.get('eq', {}).get('beam_type') == 'Strong':
+                lines = ExtractUtils.get_strong_beams(dict_granule['orb_orient'])
+                print(f"Strong beams (sc_orient={dict_granule['orb_orient']}): \t{lines}")
+
+            # The predicates of the spec on the (100m) segment datasets of this product version
+            schema_version = ExtractUtils.get_schema_version(atl08_version)
+            seg_cols = [c for c, dict_col in ExtractUtils.ATL08_SCHEMA.items() if schema_version in dict_col['versions'] and c not in COLS_20M]
+            mask_func, mask_cols = FilterUtils.compile_filter_spec(filter_spec, cols=seg_cols)
+            if len(mask_cols) > 0:
+                list_masks.append((mask_cols, mask_func))
+
+        dict_cols = ExtractUtils.read_atl08_columns(f, read_cols, atl08_version, lines=lines, list_masks=list_masks, profile=profile)
+        ProfileUtils.lap(profile, 'read')
+    else:
+        dict_cols = ExtractUtils.read_atl08_columns(f, read_cols, atl08_version, profile=profile)
+        ProfileUtils.lap(profile, 'read')
+    if dict_cached is None:
+        f.close()
 
     # Be sure at least one of the lasers/lines for the h5 file had data points - MW added block 3/31
-    if nLines == 0:
-        return None # No usable points in h5 file, can't process
-        
-    latitude    =np.array([latitude[l][k] for l in range(nLines) for k in range(len(latitude[l]))] )
-    longitude   =np.array([longitude[l][k] for l in range(nLines) for k in range(len(longitude[l]))] )
+    if dict_cols is None:
+        return STATUS_NO_POINTS # No usable points in h5 file, can't process
 
-    gt          =np.array([gt[l][k] for l in range(nLines) for k in range(len(gt[l]))] )
-
-    segid_beg   =np.array([segid_beg[l][k] for l in range(nLines) for k in range(len(segid_beg[l]))] )
-    segid_end   =np.array([segid_end[l][k] for l in range(nLines) for k in range(len(segid_end[l]))] )
-
-    
-    h_max_can   =np.array([h_max_can[l][k] for l in range(nLines) for k in range(len(h_max_can[l]))] )
-    h_can       =np.array([h_can[l][k] for l in range(nLines) for k in range(len(h_can[l]))] )
-    h_can_unc   =np.array([h_can_unc[l][k] for l in range(nLines) for k in range(len(h_can_unc[l]))] ) # new as of 2022
-    h_can_quad  =np.array([h_can_quad[l][k] for l in range(nLines) for k in range(len(h_can_quad[l]))] )
-    
-    #*do_20m: No more can_h_met_0 etc for 20m segments - 
-      # will make separate RH % arrays later on 
-      # erased can_met array stuff, changed if-else block to only if
-    if do_20m:
-        latitude_20m  = np.array([latitude_20m[l][k] for l in range(nLines) for k in range(len(latitude_20m[l]))])
-        longitude_20m = np.array([longitude_20m[l][k] for l in range(nLines) for k in range(len(longitude_20m[l]))])
-        h_can_20m     = np.array([h_can_20m[l][k] for l in range(nLines) for k in range(len(h_can_20m[l]))])
-        h_te_best_20m = np.array([h_te_best_20m[l][k] for l in range(nLines) for k in range(len(h_te_best_20m[l]))])
-        seg20_id      = np.array([seg20_id[l][k] for l in range(nLines) for k in range(len(seg20_id[l]))])        
-
-    can_h_met = np.array([can_h_met[l][k] for l in range(nLines) for k in range(len(can_h_met[l]))])
-        
-    n_ca_ph     =np.array([n_ca_ph[l][k] for l in range(nLines) for k in range(len(n_ca_ph[l]))] )
-    n_toc_ph    =np.array([n_toc_ph[l][k] for l in range(nLines) for k in range(len(n_toc_ph[l]))] )
-    can_open    =np.array([can_open[l][k] for l in range(nLines) for k in range(len(can_open[l]))] )
-    can_rh_conf =np.array([can_rh_conf[l][k] for l in range(nLines) for k in range(len(can_rh_conf[l]))] )
-    seg_cover   =np.array([seg_cover[l][k] for l in range(nLines) for k in range(len(seg_cover[l]))] )
-    
-    #tcc_flg     =np.array([tcc_flg[l][k] for l in range(nLines) for k in range(len(tcc_flg[l]))] )
-    #tcc_prc     =np.array([tcc_prc[l][k] for l in range(nLines) for k in range(len(tcc_prc[l]))] )
-
-    cloud_flg   =np.array([cloud_flg[l][k] for l in range(nLines) for k in range(len(cloud_flg[l]))] )
-    msw_flg     =np.array([msw_flg[l][k] for l in range(nLines) for k in range(len(msw_flg[l]))] )
-    n_seg_ph    =np.array([n_seg_ph[l][k] for l in range(nLines) for k in range(len(n_seg_ph[l]))] )
-    night_flg    =np.array([night_flg[l][k] for l in range(nLines) for k in range(len(night_flg[l]))] )
-    seg_landcov =np.array([seg_landcov[l][k] for l in range(nLines) for k in range(len(seg_landcov[l]))] )
-    seg_snow    =np.array([seg_snow[l][k] for l in range(nLines) for k in range(len(seg_snow[l]))] )
-    seg_water   =np.array([seg_water[l][k] for l in range(nLines) for k in range(len(seg_water[l]))] )
-    sig_vert    =np.array([sig_vert[l][k] for l in range(nLines) for k in range(len(sig_vert[l]))] )
-    sig_acr     =np.array([sig_acr[l][k] for l in range(nLines) for k in range(len(sig_acr[l]))] )
-    sig_along   =np.array([sig_along[l][k] for l in range(nLines) for k in range(len(sig_along[l]))] )
-    sig_h       =np.array([sig_h[l][k] for l in range(nLines) for k in range(len(sig_h[l]))] )
-    sig_topo    =np.array([sig_topo[l][k] for l in range(nLines) for k in range(len(sig_topo[l]))] )
-
-    n_te_ph     =np.array([n_te_ph[l][k] for l in range(nLines) for k in range(len(n_te_ph[l]))] )
-    h_te_best   =np.array([h_te_best[l][k] for l in range(nLines) for k in range(len(h_te_best[l]))] )
-    h_te_unc    =np.array([h_te_unc[l][k] for l in range(nLines) for k in range(len(h_te_unc[l]))] )
-    ter_slp     =np.array([ter_slp[l][k] for l in range(nLines) for k in range(len(ter_slp[l]))] )
-    snr         =np.array([snr[l][k] for l in range(nLines) for k in range(len(snr[l]))] )
-    sol_az      =np.array([sol_az[l][k] for l in range(nLines) for k in range(len(sol_az[l]))] )
-    sol_el      =np.array([sol_el[l][k] for l in range(nLines) for k in range(len(sol_el[l]))] )
-
-    asr 		=np.array([asr[l][k] for l in range(nLines) for k in range(len(asr[l]))] )
-    h_dif_ref 	=np.array([h_dif_ref[l][k] for l in range(nLines) for k in range(len(h_dif_ref[l]))] )
-    ter_flg 	=np.array([ter_flg[l][k] for l in range(nLines) for k in range(len(ter_flg[l]))] )
-    ph_rem_flg	=np.array([ph_rem_flg[l][k] for l in range(nLines) for k in range(len(ph_rem_flg[l]))] )
-    dem_rem_flg =np.array([dem_rem_flg[l][k] for l in range(nLines) for k in range(len(dem_rem_flg[l]))] )
-    seg_wmask	=np.array([seg_wmask[l][k] for l in range(nLines) for k in range(len(seg_wmask[l]))] )
-    lyr_flg		=np.array([lyr_flg[l][k] for l in range(nLines) for k in range(len(lyr_flg[l]))] )
+    latitude  = dict_cols['lat']
+    h_can     = dict_cols['h_can']
 
     # Handle nodata
     val_invalid = np.finfo('float32').max
-    val_nan = np.nan
-    val_nodata_src = np.max(h_can)
-    print("Find src nodata value using max of h_can: \t{}".format(val_nodata_src))
+    # The _FillValue of each float dataset was set to np.nan as it was read
     
     if TEST:       
         # Testing with 'h_can'
@@ -580,6 +727,8 @@ def extract_atl08(args):
         print("# of nan ATL08 obs of  h_can: \t{}".format( np.count_nonzero(np.isnan(h_can)) ))
         print('# of invalid ATL08 obs of h_can: \t{}'.format(len( h_can[h_can == val_invalid ] )))
         
+        n_ca_ph  = dict_cols['n_ca_ph']
+        n_toc_ph = dict_cols['n_toc_ph']
         print('# of ATL08 obs: \t\t{}'.format(len(latitude)))
         print('# of ATL08 obs (can pho.>0): \t{}'.format(len(n_ca_ph[n_ca_ph>0])))
         print('# of ATL08 obs (toc pho.>0): \t{}'.format(len(n_toc_ph[n_toc_ph>0])))
@@ -609,153 +758,64 @@ def extract_atl08(args):
     if TEST:
         print("\nSet up a dataframe dictionary...")
     
-    #*do_20m - Instead of having separate 100m/20m dicts, add to 
-      # dictionaries if do_20m is True    
-    dict_orb_gt_seg = {
-                    #'fid_100m'  :fid,
-                    'lon'       :longitude,
-                    'lat'       :latitude,
-                    #'yr'        :np.full(longitude.shape, yr[0]),
-                    #'m'         :np.full(longitude.shape, m[0]),
-                    #'d'         :np.full(longitude.shape, d[0]),
-                    'dt'        :np.full(longitude.shape, dt[0]),
-                    'orb_orient':np.full(longitude.shape, orb_orient[0]),
-                    'orb_num'   :np.full(longitude.shape, orb_num[0]),
-                    'rgt'       :np.full(longitude.shape, rgt[0]),
-                    'gt'        :gt,
-
-                    'segid_beg' :segid_beg,
-                    'segid_end' :segid_end
-    }
-    
-    dict_rh_metrics = {
-                    'h_max_can' :h_max_can,
-                    'h_can'     :h_can,
-                    'h_can_quad':h_can_quad,
-                    'h_can_unc' :h_can_unc,                    
-                    
-                    
-                    # RHs: 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95%
-                    'rh10'      :can_h_met[:,0],
-                    'rh15'      :can_h_met[:,1],
-                    'rh20'      :can_h_met[:,2],
-                    'rh25'      :can_h_met[:,3],
-                    'rh30'      :can_h_met[:,4],
-                    'rh35'      :can_h_met[:,5],
-                    'rh40'      :can_h_met[:,6],
-                    'rh45'      :can_h_met[:,7],
-                    'rh50'      :can_h_met[:,8],
-                    'rh55'      :can_h_met[:,9],
-                    'rh60'      :can_h_met[:,10],
-                    'rh65'      :can_h_met[:,11],
-                    'rh70'      :can_h_met[:,12],
-                    'rh75'      :can_h_met[:,13],
-                    'rh80'      :can_h_met[:,14],
-                    'rh85'      :can_h_met[:,15],
-                    'rh90'      :can_h_met[:,16],
-                    'rh95'      :can_h_met[:,17]
-    }
-    
-    dict_other_fields = {
-                    'n_ca_ph'   :n_ca_ph,
-                    'n_toc_ph'  :n_toc_ph,
-                    'can_open'  :can_open,
-                    'can_rh_conf':can_rh_conf,
-                    'seg_cover'  :seg_cover,
-                    #'tcc_flg'   :tcc_flg,
-                    #'tcc_prc'   :tcc_prc,
-
-                    'cloud_flg' :cloud_flg,
-                    'msw_flg'   :msw_flg,
-                    'n_seg_ph'  :n_seg_ph,
-                    'night_flg' :night_flg,
-                    'seg_landcov':seg_landcov,
-                    'seg_snow'  :seg_snow,
-                    'seg_water' :seg_water,
-                    'sig_vert'  :sig_vert,
-                    'sig_acr'   :sig_acr,
-                    'sig_along' :sig_along,
-                    'sig_h'     :sig_h,
-                    'sig_topo'  :sig_topo,
-
-                    'n_te_ph'   :n_te_ph,
-                    'h_te_best' :h_te_best,
-                    'h_te_unc'  :h_te_unc,
-                    'ter_slp'   :ter_slp,
-                    'snr'       :snr,
-                    'sol_az'    :sol_az,
-                    'sol_el'    :sol_el,
-
-                    'asr'       :asr,
-                    'h_dif_ref' :h_dif_ref,
-                    'ter_flg'   :ter_flg,
-                    'ph_rem_flg':ph_rem_flg,
-                    'dem_rem_flg':dem_rem_flg,
-                    'seg_wmask' :seg_wmask,
-                    'lyr_flg'   :lyr_flg
-    }
-    
-    #*do_20m - Now add 20m segment arrays to dict
-    if do_20m:
-        dict_orb_gt_seg['lon_20m'] = longitude_20m
-        dict_orb_gt_seg['lat_20m'] = latitude_20m
-        dict_orb_gt_seg['id_20m'] = seg20_id
-        
-        dict_rh_metrics['h_can_20m'] = h_can_20m
-        
-        dict_other_fields['h_te_best_20m'] = h_te_best_20m            
-    
-    # Erased large chunk of old logic for building dicts
-
-  
-
-    # First, get one big dictionary for all value types
-    outDict = rec_merge1(dict_orb_gt_seg, rec_merge1(dict_rh_metrics, dict_other_fields))
+    # One dictionary for all value types, in the column order of cols_extract
+    # Granule level fields are broadcast to every segment
+    outDict = {}
+    for col in cols_extract:
+        if col == 'dt':
+            outDict[col] = ExtractUtils.full_categorical(len(latitude), dict_granule[col])
+        elif col in ExtractUtils.GRANULE_COLS:
+            outDict[col] = np.full(latitude.shape, dict_granule[col], dtype=ExtractUtils.COL_DTYPES[col])
+        elif col == 'h_can':
+            outDict[col] = h_can
+        elif col == 'id_20m':
+            #*do_20m - Build the 20m segment ID column (1-5 within each 100m segment)
+              # same size/shape as other 20m arrays
+            outDict[col] = np.tile(np.arange(1, 6, dtype=ExtractUtils.COL_DTYPES[col]), (len(latitude), 1))
+        elif col in dict_cols:
+            outDict[col] = dict_cols[col]
   
     # This is redunant filtering, but for large datasets reconfiguring the arrays takes a while
     # There are two filters that are usually the cause of returning empty datasets
     # If there are no points that independently do not meet these criteria, there is no point in continuing
     # TBD whether or not this will speed things up - it will
-    if 0 not in outDict['msw_flg'].tolist() or 1 not in outDict['seg_snow'].tolist():
+    if ('msw_flg' in outDict and not (outDict['msw_flg'] == 0).any()) or ('seg_snow' in outDict and not (outDict['seg_snow'] == 1).any()):
         print("\nPre-filtering step determined there are no good points in dataset. Exiting")
-        return None
+        return STATUS_NO_POINTS
     
     print("\nBuilding pandas dataframe...")
 
 
     #*do_20m new
-    # Configure arrays if do_20m is True: 
-
     # If only extracting 100m segments, all arrays in outDict will be of shape
     # (X,) [aka ndims = 1], so no edits need to be made before DF creation
     
-    # But if extracting 20m segments, 1D arrays need to be reformatted to
-    # repeat the 100m info for each 20m segment. This will multiply the size of 
+    # If extracting 20m segments, the 20m arrays are (X, 5). The output repeats 
+    # the 100m info for each 20m segment. This multiplies the size of 
     # all 1D (aka 100m segment) arrays by 5 and therefore the output .csv, but 
-    # this way we can still use existing filters and avoid losing the 100m 
-    # info associated with each 20m segment
+    # this way we avoid losing the 100m info associated with each 20m segment
     # The redundant info can be cleaned up in zonal stats outputs and/or can
     # be taken care of if using an actual database, with a 100m segment 
     # db table that can be joined with 20m table using id_100m (combine with 
     # 20m seg id id_20m for unique 20m IDs)
-    
+
+    # All of the filters work on 100m segment fields, so the dataframe is built from the 100m arrays
+    # and the (X, 5) 20m arrays are kept aside. Only the 100m segments left after filtering
+    # are expanded to 20m rows, just before writing out (see expand20mRows)
+    dict_20m = {col: outDict.pop(col) for col in list(outDict) if outDict[col].ndim == 2}
     if do_20m:
-        st = time.time()
-        print('reformatArrays...')
-        outDict = reFormatArrays(outDict)
-        calculateElapsedTime(st, time.time())
+        print(f'20m columns kept as (X, 5) arrays until after filtering: {list(dict_20m)}')
     print('Create dataframe from dictionary...')
     out = pd.DataFrame(outDict)
-  
-    print("Setting pandas df nodata values to np.nan for some basic eval.")
-    out = out.replace(val_nodata_src, np.nan)
-   
-    print('# of ATL08 obs: \t\t{}'.format(len(out.lat[out.lat.notnull()])))
-    print('# of ATL08 obs (can pho.>=0): \t{}'.format(len(out.n_ca_ph[
+
+    print('# of ATL08 obs{}: \t\t{}'.format(' (100m segments)' if do_20m else '', len(out.lat[out.lat.notnull()])))
+    if 'n_ca_ph' in out.columns:
+        print('# of ATL08 obs (can pho.>=0): \t{}'.format(len(out.n_ca_ph[
                                                       (out.h_can.notnull() ) & 
                                                       (out.n_ca_ph >= 0) 
                                                                         ])))
-    print('# of ATL08 obs (toc pho.>=0): \t{}'.format(len(out.n_toc_ph[
+    if 'n_toc_ph' in out.columns:
+        print('# of ATL08 obs (toc pho.>=0): \t{}'.format(len(out.n_toc_ph[
                                                       (out.h_can.notnull() ) & 
                                                       (out.n_toc_ph >= 0) 
                                                                         ])))
@@ -767,15 +827,14 @@ def extract_atl08(args):
                                                       (out.h_can.notnull() ) & 
                                                                 (out.h_can < 0)
                                                                         ])))
+    ProfileUtils.lap(profile, 'dataframe')
             
-    # if set_nodata_nan is True (default False) set NoData to nan
-    # if False, set it to the output NoData value (val_invalid)
-    if args.set_nodata_nan:
-        val_nodata_out = val_nan
-    else:
-        val_nodata_out = val_invalid
-    print("Setting out pandas df nodata values: \t{}".format(val_nodata_out))
-    out = out.replace(np.nan, val_nodata_out)
+    # if set_nodata_nan is True (default False) leave NoData as nan
+    # if False, set it to the output NoData value (val_invalid) in the float columns
+    if not args.set_nodata_nan:
+        print("Setting out pandas df nodata values: \t{}".format(val_invalid))
+        out = ExtractUtils.replace_float_values(out, np.nan, val_invalid)
+        ProfileUtils.lap(profile, 'nodata')
     
     #*v005 - seg_landcover changed to Copernicus
     # set_flag_names is False but if we want it to be True, need to update
@@ -817,8 +876,9 @@ def extract_atl08(args):
                 'Open forest unknown', 'Shrubs','Herbaceous', 
                 'Herbaceous\nwetleand','Moss/lichen', 'Bare/sparse','Cultivated/managed',
                 'Urban/built', 'Snow/ice','Permanent\nwater', 'Open sea']
-        out['seg_landcov'] = out['seg_landcov'].map(dict(zip(class_values, 
-                                                                 class_names)))
+        if 'seg_landcov' in out.columns:
+            out['seg_landcov'] = ExtractUtils.map_flag_names(out['seg_landcov'], dict(zip(class_values, 
+                                                                                           class_names)))
         
         """
         # old method (pre v005)
@@ -829,10 +889,16 @@ def extract_atl08(args):
                                                      12: "croplands", 13: "urban-built", 14: "croplands-natural mosaic", \
                                                      15: "permanent snow-ice", 16: "barren"})
         """
-        out['seg_snow'] = out['seg_snow'].map({0: "ice free water", 1: "snow free land", 2: "snow", 3: "ice"})
-        out['cloud_flg'] = out['cloud_flg'].map({0: "High conf. clear skies", 1: "Medium conf. clear skies", 2: "Low conf. clear skies", \
-                                                 3: "Low conf. cloudy skies", 4: "Medium conf. cloudy skies", 5: "High conf. cloudy skies"})
-        out['night_flg'] = out['night_flg'].map({0: "day", 1: "night"})
+        dict_flag_names = {
+            'seg_snow' : {0: "ice free water", 1: "snow free land", 2: "snow", 3: "ice"},
+            'cloud_flg': {0: "High conf. clear skies", 1: "Medium conf. clear skies", 2: "Low conf. clear skies", \
+                          3: "Low conf. cloudy skies", 4: "Medium conf. cloudy skies", 5: "High conf. cloudy skies"},
+            'night_flg': {0: "day", 1: "night"}
+        }
+        for col, dict_names in dict_flag_names.items():
+            if col in out.columns:
+                out[col] = ExtractUtils.map_flag_names(out[col], dict_names)
+        ProfileUtils.lap(profile, 'flag_names')
         #out['tcc_flg'] = out['tcc_flg'].map({0: "=<5%", 1: ">5%"}) #*v005
                                          
     #*v005: Bin tcc values - added include_lowest = True so tcc of 0% 
@@ -842,130 +908,56 @@ def extract_atl08(args):
     #out['tcc_bin'] = pd.cut(out['tcc_prc'], bins=tcc_bins, labels=tcc_bins[1:], include_lowest=True)
     
     # Add granule name to table 2/2/22
-    out['granule_name'] = granule_fname
-
-    if args.filter_qual:
-
-        print('Quality Filtering: \t\t[ON]')
-
-        import FilterUtils
-
-        # These filters are customized for boreal
-        '''out = FilterUtils.prep_filter_atl08_qual(out)
-        out = FilterUtils.filter_atl08_qual_v2(out, SUBSET_COLS=True, DO_PREP=False,
-                                                   subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh90','h_can','h_max_can','h_can_quad','h_can_unc',
-                                                                     'h_te_best','h_te_unc', 'granule_name','can_rh_conf', 'h_dif_ref',
-                                                                     'seg_landcov','seg_cover','night_flg','seg_water','sol_el','asr','ter_slp', 'ter_flg','y','m','d'], 
-                                                   filt_cols=['h_can','h_dif_ref','m','msw_flg','beam_type','seg_snow','sig_topo'], 
-                                                   thresh_h_can=100, thresh_h_dif=25, thresh_sig_topo=2.5, month_min=args.minmonth, month_max=args.maxmonth)
-                                                   '''
-        # print('Apply the aggressive land-cover based (v3) filters updated in Jan/Feb 2022')
-        # out = FilterUtils.filter_atl08_qual_v3(out, SUBSET_COLS=True, DO_PREP=True,
-        #                                       subset_cols_list=['rh25','rh50','rh60','rh70','rh75','rh80','rh90','h_can','h_max_can',
-        #                                                              'h_te_best','granule_name',
-        #                                                              'seg_landcov','seg_cover','sol_el','y','m','doy'], 
-        #                                            filt_cols=['h_can','h_dif_ref','m','msw_flg','beam_type','seg_snow','sig_topo'], 
-        #                                            list_lc_h_can_thresh=args.list_lc_h_can_thresh,
-        #                                            thresh_h_can=100, thresh_h_dif=25, thresh_sig_topo=2.5, month_min=args.minmonth, month_max=args.maxmonth)
-        print('Apply the aggressive land-cover based (v4) filters updated in Jan/Feb 2022 and use a dict of misc thresholds for other filter cols to allow for flexibility in misc filtering')
-        SUBSET_COLS_LIST = ['rh25','rh50','rh60','rh70','rh75','rh80','rh90','h_can','h_max_can',
-                                                                     'h_te_best','granule_name',
-                                                                     'seg_landcov','seg_cover','sol_el','y','m','doy']
-        if do_20m:
-            SUBSET_COLS_LIST = SUBSET_COLS_LIST + ['lon_20m','lat_20m','h_can_20m']
-
-        out = FilterUtils.filter_atl08_qual_v4(out, SUBSET_COLS=True, DO_PREP=True,
-                                              subset_cols_list=SUBSET_COLS_LIST, 
-                                                   filt_cols=['h_can','h_dif_ref','m','msw_flg','beam_type','seg_snow','sig_topo'], 
-                                                   list_lc_h_can_thresh=args.list_lc_h_can_thresh,
-                                                   filt_dict_misc_thresh = args.dict_misc_thresh, month_min=args.minmonth, month_max=args.maxmonth)
-    else:
-        print('Quality Filtering: \t[OFF] (do downstream)')
-
-    if args.filter_geo:
-        print('Geographic Filtering: \t[ON] xmin = {}, xmax = {}, ymin = {}, ymax = {}'.format(args.minlon, args.maxlon, args.minlat, args.maxlat))        
-        # These filters are customized for boreal 
-        out = out[ (out['lon']     >= args.minlon) & 
-                   (out['lon']     <= args.maxlon) & 
-                   (out['lat']     >= args.minlat) & 
-                   (out['lat']     <= args.maxlat)]
-    else:
-        print('Geographic Filtering: \t[OFF] (do downstream)')
-
-    # After filtering, output dataframe may be empty. If so, exit program
-    if out.empty:
-        print('\nFile is empty after filtering. Exiting')
-        return None
-    else:
-        # PMM edit: BUT, why do we need unique ID cols?
-        # This will fail if you do quality filtering above, b/c that function doesnt return fields needed for the uniqueID field ('id_20m')
-        if False:
-            #*do_20m - GET UNIQUE ID FIELDS
-            # If not doing 20m segments, unique_id = 100m segment ID
-            # If doing 20m segments, unique_id = 100m segment ID + 20m segment ID
-            # So 100m.csv will have just unique ID and 100m segment ID 
-              # (which = unique ID)
-            # 20m.csv will have unique ID, 100m seg ID, 20m seg ID
-              # (id_20m already exists as column if do_20m)
-
-            print("\nStart by getting 100m segment ID\n")
-            print(out.head())
-            out['id_100m'] = list(map(lambda ln, lt, dt: get100mSegId(ln, lt, dt), \
-                                                    out['lon'], out['lat'], out['dt']))
-
-            # If doing 20m segments, then unique ID is combo of id_100m and id_20m
-            if do_20m: 
-                out['id_unique'] = list(map(lambda i1, i2: \
-                                '{}-{}'.format(i1, i2), out['id_100m'], out['id_20m']))
-
-            # Otherwise, unique ID is just 100m id (yes this will add a duplicate
-            # column but it will enable a consisent unique ID column name. 
-            # un-likely to process 100m with this code anyways so w/e)
-            else:
-                out['id_unique'] = out['id_100m']
-
-        # Lastly, try and reorder the columns before writing to .csv. 
-        # This part is partially hardcoded according to expected column names
-        colsOrdered = getOrderedColumns(out)
-        out = out[colsOrdered]
+    out['granule_name'] = ExtractUtils.full_categorical(len(out), granule_fname)
+
+    # Derived columns are added once for all of the outputs, from the granule's gt, orb_orient and dt categories,
+    # so the quality filter prep of each output has nothing left to do
+    for col, arr in FilterUtils.get_prep_cols(out, cols_derived).items():
+        out[col] = arr
+    ProfileUtils.lap(profile, 'derive')
+
+    # Filter and write each output (the 100m and/or 20m) from the one read of the granule
+    # With filter pushdown, the obs in to the filter funnel of each output (n_input) are those left after the pushdown
+    dict_out = {}
+    for out_args in list_out_args:
+        print(f"\n{out_args.segment_length}m output{'' if out_args.domain is None else ' of domain ' + out_args.domain}:")
+        key = out_args.segment_length if out_args.domain is None else (out_args.domain, out_args.segment_length)
+        funnel = {'granule_name': Name, 'filter_pushdown': filter_pushdown}
+        dict_out[key] = filterWriteOutput(out, dict_20m, out_args, val_invalid, funnel, profile)
+        args.list_funnels.append(funnel)
 
-        # At this point we know out DF is not empty - Write out to csv
-        print(f'\nWriting output with shape {out.shape}')
-        
-        if args.output_dataframe:
-            print(f'Returning output dataframe of shape: {out.shape}')
-            return out
-        else:
-            # Write out to a csv
-            out_csv_fn = os.path.join(outbase + fn_tail)
-            print(f'Creating CSV: \t\t{out_csv_fn}')
-            out.to_csv(out_csv_fn,index=False, encoding="utf-8-sig")
-        
     print("\nEnd: {}\n".format(time.strftime("%m-%d-%y %I:%M:%S %p")))        
     calculateElapsedTime(start, time.time())
     
-    sys.stdout.close() # Close logging file
+    if args.logging:
+        sys.stdout.close() # Close logging file
+        sys.stdout = sys.__stdout__
 
-def main():
-    #print("\nWritten by:\n\tNathan Thomas\t| @Nmt28\n\tPaul Montesano\t| paul.m.montesano@nasa.gov\n")
-                                         
-    class Range(object):
-        def __init__(self, start, end):
-            self.start = start
-            self.end = end
+    if all([out is None for out in dict_out.values()]):
+        return STATUS_EMPTY
+    if args.output_dataframe:
+        # The dataframe of the one output, or a dict of them by segment length (and domain)
+        return list(dict_out.values())[0] if len(dict_out) == 1 else dict_out
+    return STATUS_WRITTEN
+
+class Range(object):
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
 
-        def __eq__(self, other):
-            return self.start <= other <= self.end
+    def __eq__(self, other):
+        return self.start <= other <= self.end
 
-        def __contains__(self, item):
-            return self.__eq__(item)
+    def __contains__(self, item):
+        return self.__eq__(item)
 
-        def __iter__(self):
-            yield self
+    def __iter__(self):
+        yield self
 
-        def __str__(self):
-            return '[{0},{1}]'.format(self.start, self.end)                                           
+    def __str__(self):
+        return '[{0},{1}]'.format(self.start, self.end)                                           
 
+def getparser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", type=str, help="Specify the input ICESAT H5 file")
     parser.add_argument("-r", "--resolution", type=str, default='100', help="Specify the output raster resolution (m)")
@@ -982,6 +974,10 @@ def main():
     parser.add_argument("--maxmonth" , type=int, choices=[Range(1, 12)], default=9, help="Max month of ATL08 shots for output to include")
     parser.add_argument("--list_lc_h_can_thresh", nargs="+", type=int, default=[0, 60, 60, 60, 60, 60, 60, 50, 50, 50, 50, 50, 50, 20, 10, 10, 5, 5, 0, 0, 0, 0, 0], help="A list of land-cover specific thresholds for h_can")
     parser.add_argument('--dict_misc_thresh', type=json.loads, default={'h_can_unc': 5, 'seg_cover': 32767, 'sol_el': 5, 'sig_topo': 2.5, 'h_dif_ref': 25}, help="Dict of filt columns (keys) and thresholds (values) for which values less than will remain")
+    parser.add_argument('--filter_spec', type=readFilterSpec, default=None, help="Quality filter spec: a preset (v1, v2, v3, v4), a JSON file or a JSON string (see FilterUtils.read_filter_spec). Default: the v4 filter of --list_lc_h_can_thresh, --dict_misc_thresh and --minmonth/--maxmonth")
+    parser.add_argument("--columns", nargs="+", type=str, default=None, help="Output columns to extract (default: the quality filter subset, or all columns with --no-filter-qual). Only these and the columns the active filters need are read from the h5")
+    parser.add_argument('--filter_pushdown', dest='filter_pushdown', action='store_true', help='Apply the quality and geographic filters while reading the h5: skip weak beams and read the rest of the fields only for segments inside the bbox that pass the flag and threshold filters')
+    parser.set_defaults(filter_pushdown=False)
     parser.add_argument('--no-overwrite', dest='overwrite', action='store_false', help='Turn overwrite off (To help complete big runs that were interrupted)')
     parser.set_defaults(overwrite=True)
     parser.add_argument('--no-filter-qual', dest='filter_qual', action='store_false', help='Turn off quality filtering (To control filtering downstream)')
@@ -990,6 +986,19 @@ def main():
     parser.set_defaults(filter_geo=True)
     parser.add_argument('--do_20m', dest='do_20m', action='store_true', help='Turn on 20m ATL08 extraction')
     parser.set_defaults(do_20m=False)
+    parser.add_argument('--do_100m_20m', dest='do_100m_20m', action='store_true', help='Write both the 100m and the 20m outputs from one read of the granule')
+    parser.set_defaults(do_100m_20m=False)
+    parser.add_argument("--columns_20m", nargs="+", type=str, default=None, help="With --do_100m_20m, output columns of the 20m output (default: as for --do_20m)")
+    parser.add_argument("--list_lc_h_can_thresh_20m", nargs="+", type=int, default=None, help="With --do_100m_20m, land-cover specific h_can thresholds of the 20m output (default: --list_lc_h_can_thresh)")
+    parser.add_argument('--dict_misc_thresh_20m', type=json.loads, default=None, help="With --do_100m_20m, dict of misc filter thresholds of the 20m output (default: --dict_misc_thresh)")
+    parser.add_argument('--filter_spec_20m', type=readFilterSpec, default=None, help="With --do_100m_20m, quality filter spec of the 20m output (default: --filter_spec)")
+    parser.add_argument('--domains', type=readDomains, default=None, help="A domain config (JSON or YAML) of the bbox, months, filter thresholds and columns of each domain (see readDomains). The granule is read once and each domain is written to <output dir>/<domain name>")
+    parser.add_argument('--cache_dir', type=str, default=None, help='Dir of a cache of the unfiltered segments of each granule: a granule is read from its cache file if it has one, else it is read from the h5 and cached')
+    parser.add_argument('--cache_max_gb', type=float, default=100.0, help='Size of the cache; the least recently used cache files are removed above it')
+    parser.add_argument('--output_format', type=str, choices=list(ExtractUtils.OUTPUT_FORMATS), default='csv', help='Output file format: csv, or parquet/feather for typed, compressed columns')
+    parser.add_argument('--no-funnel', dest='write_funnel', action='store_false', help='Turn off writing the filter funnel (obs left after each filter stage) of each output to <output name>_funnel.json')
+    parser.set_defaults(write_funnel=True)
+    parser.add_argument('--profile', nargs='?', const='', default=None, help='Profile the phases of the extraction (wall time, CPU time and peak RSS of each), appended as one JSON line per granule to this file (default: <output dir>/atl08_profile.jsonl); see summarize_profile_atl08.py')
     parser.add_argument('--output_dataframe', dest='output_dataframe', action='store_true', help='Output a pandas dataframe instead of a csv')
     parser.set_defaults(output_dataframe=False)
     parser.add_argument('--set_flag_names', dest='set_flag_names', action='store_true', help='Set the flag values to meaningful flag names')
@@ -999,15 +1008,36 @@ def main():
     parser.add_argument('--TEST', dest='TEST', action='store_true', help='Turn on testing')
     parser.set_defaults(TEST=False)
     parser.add_argument('--log', dest='logging', action='store_true', help='Turn on output logging to file')
-    parser.set_defaults(logging=False)    
+    parser.set_defaults(logging=False)
 
+    return parser
+
+def main():
+    #print("\nWritten by:\n\tNathan Thomas\t| @Nmt28\n\tPaul Montesano\t| paul.m.montesano@nasa.gov\n")
+
+    parser = getparser()
     args = parser.parse_args()
 
     # Moved data validation bit to function
 
 #    print(f'Month range: {args.minmonth}-{args.maxmonth}')
 
-    extract_atl08(args)
+    try:
+        status = extract_atl08(args)
+    except ValueError as e:
+        # eg, from the filtering of FilterUtils (a batch worker records these as the granule's error)
+        print(f"Error: {e}")
+        status = STATUS_ERROR
+
+    profile = getattr(args, 'profile_record', None)
+    if profile is not None:
+        profile_fn = args.profile if args.profile != '' else os.path.join(args.output if args.output is not None else os.path.dirname(args.input), 'atl08_profile.jsonl')
+        ProfileUtils.write_profiles([ProfileUtils.end_profile(profile, status)], profile_fn)
+        print(f"Profile: \t\t{profile_fn}")
+
+    # Exit with an error when the granule was not processed
+    if status in [STATUS_ERROR, STATUS_EXISTS, STATUS_NO_20M]:
+        os._exit(1)
 
 
 if __name__ == "__main__":
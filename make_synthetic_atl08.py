@@ -0,0 +1,238 @@
+#! /usr/bin/env python
+
+'''
+    Write synthetic ATL08 granules, to test and benchmark the extraction without the ATL08 archive.
+    The land_segments datasets of each beam (incl. canopy/, terrain/ and the v005 _20m fields), /orbit_info and
+    /ancillary_data/granule_end_utc are written from ExtractUtils.ATL08_SCHEMA: the path, dtype, _FillValue and (n, x) shape
+    of each dataset are those of the product version (v003, v004 or v005), and granules are named like real ones, eg
+    ATL08_20190715122233_03210402_005_01.h5 (acq start, RGT, cycle, granule region, version, revision).
+    Values are random but plausible (eg, rh metrics increase up to h_can); the float fill rate and the distributions
+    of the flags (msw_flg, seg_snow, seg_landcov, ...) can be set, so that the filters keep a realistic share of segments.
+
+        make_synthetic_atl08.py -o /tmp/atl08_synth --n_granules 4 --n_segments 20000 --versions 5
+    writes the granules and a list of them (<output dir>/list_atl08_synth) for batch_extract_atl08.py
+'''
+
+import os
+import json
+import argparse
+from datetime import datetime, timedelta
+
+import h5py
+import numpy as np
+
+import ExtractUtils
+import FilterUtils
+
+# Distributions of the flag columns, {value: probability}
+FLAG_PROBS = {
+    'msw_flg'    : {-1: 0.1, 0: 0.5, 1: 0.2, 2: 0.1, 3: 0.05, 4: 0.025, 5: 0.025},
+    'seg_snow'   : {0: 0.1, 1: 0.75, 2: 0.1, 3: 0.05},
+    'cloud_flg'  : {0: 0.4, 1: 0.2, 2: 0.1, 3: 0.1, 4: 0.1, 5: 0.1},
+    'night_flg'  : {0: 0.5, 1: 0.5},
+    'seg_water'  : {0: 0.9, 1: 0.1},
+    'can_rh_conf': {0: 0.2, 1: 0.3, 2: 0.5},
+    'tcc_flg'    : {0: 0.7, 1: 0.3},
+    'ter_flg'    : {0: 0.8, 1: 0.2},
+    'ph_rem_flg' : {0: 0.9, 1: 0.1},
+    'dem_rem_flg': {0: 0.9, 1: 0.1},
+    'lyr_flg'    : {0: 0.8, 1: 0.2},
+    'seg_landcov': {val: 1 / len(FilterUtils.LIST_LC_CLASS_VALUES) for val in FilterUtils.LIST_LC_CLASS_VALUES}
+}
+
+# Uniform ranges of the other columns (rh metrics, h_max_can and the _20m heights follow h_can and h_te_best)
+VALUE_RANGES = {
+    'h_can'      : (0, 40),
+    'h_can_quad' : (0, 40),
+    'h_can_unc'  : (0, 8),
+    'can_open'   : (0, 5),
+    'tcc_prc'    : (0, 100),
+    'seg_cover'  : (0, 100),
+    'n_ca_ph'    : (0, 100),
+    'n_toc_ph'   : (0, 50),
+    'n_seg_ph'   : (0, 800),
+    'n_te_ph'    : (0, 200),
+    'sig_topo'   : (0, 4),
+    'h_te_best'  : (0, 2000),
+    'h_te_unc'   : (0, 5),
+    'ter_slp'    : (-1, 1),
+    'snr'        : (0, 20),
+    'sol_az'     : (-180, 180),
+    'sol_el'     : (-30, 60),
+    'asr'        : (0, 1),
+    'h_dif_ref'  : (-50, 50)
+}
+DEFAULT_RANGE = (0, 3)
+
+# Granule regions 1-14 go around the orbit; a granule is ~1/14 of an orbit
+GRANULE_MINUTES = 7
+
+def get_granule_name(dt_start, rgt, cycle, region, version, revision=1):
+    '''
+    Return the name of a granule, eg ATL08_20190715122233_03210402_005_01.h5
+    '''
+    return(f"ATL08_{dt_start.strftime('%Y%m%d%H%M%S')}_{rgt:04d}{cycle:02d}{region:02d}_{version:03d}_{revision:02d}.h5")
+
+def get_dataset_cols(version):
+    '''
+    Return the schema columns of each land_segments dataset of a product version, {path: [cols]}
+    (a 2-D dataset, eg canopy_h_metrics, holds several columns; seg_water and seg_wmask share one)
+    '''
+    schema_version = ExtractUtils.get_schema_version(version)
+    dict_paths = {}
+    for col, dict_col in ExtractUtils.ATL08_SCHEMA.items():
+        if schema_version in dict_col['versions']:
+            dict_paths.setdefault(dict_col['path'], []).append(col)
+    return dict_paths
+
+def get_flag_values(rng, col, n, flag_probs):
+    dict_probs = flag_probs[col]
+    probs = np.array(list(dict_probs.values()), dtype='float64')
+    return(rng.choice(np.array(list(dict_probs)), size=n, p=probs / probs.sum()))
+
+def make_beam(rng, n, version, lat_track, lon_track, fill_rate=0.05, flag_probs=FLAG_PROBS):
+    '''
+    Return the land_segments datasets of a beam, {path: array} in their schema dtypes (fill values included)
+        lat_track, lon_track: the lat and lon of the n 100m segments
+    '''
+    schema_version = ExtractUtils.get_schema_version(version)
+    h_can = rng.uniform(*VALUE_RANGES['h_can'], n)
+    h_te_best = rng.uniform(*VALUE_RANGES['h_te_best'], n)
+
+    dict_data = {}
+    for path, cols in get_dataset_cols(version).items():
+        col = cols[0]
+        dict_col = ExtractUtils.ATL08_SCHEMA[col]
+        if 'index' in dict_col:
+            # The rh metrics of a segment increase up to its h_can
+            n_rh = len(ExtractUtils.RH_V005 if schema_version >= 5 else ExtractUtils.RH_V003)
+            arr = h_can[:, None] * np.sort(rng.uniform(0, 1, (n, n_rh)), axis=1)
+        elif col in ['lat', 'lon']:
+            arr = lat_track if col == 'lat' else lon_track
+        elif col in ['lat_20m', 'lon_20m']:
+            # 5 20m segments along each 100m segment
+            track = lat_track if col == 'lat_20m' else lon_track
+            step = np.gradient(track) if n > 1 else np.zeros(n)
+            arr = track[:, None] + (np.arange(5) - 2) / 5 * step[:, None]
+        elif col == 'segid_beg':
+            arr = np.arange(n) * 5 + 1
+        elif col == 'segid_end':
+            arr = np.arange(n) * 5 + 5
+        elif col == 'h_can':
+            arr = h_can
+        elif col == 'h_max_can':
+            arr = h_can + rng.uniform(0, 5, n)
+        elif col == 'h_can_20m':
+            arr = np.clip(h_can[:, None] + rng.normal(0, 2, (n, 5)), 0, None)
+        elif col == 'h_te_best':
+            arr = h_te_best
+        elif col == 'h_te_best_20m':
+            arr = h_te_best[:, None] + rng.normal(0, 1, (n, 5))
+        elif any(c in flag_probs for c in cols):
+            arr = get_flag_values(rng, [c for c in cols if c in flag_probs][0], n, flag_probs)
+        elif np.dtype(dict_col['dtype']).kind in 'iu':
+            arr = rng.integers(*VALUE_RANGES.get(col, DEFAULT_RANGE), n, endpoint=True)
+        else:
+            arr = rng.uniform(*VALUE_RANGES.get(col, DEFAULT_RANGE), n)
+
+        arr = np.asarray(arr).astype(dict_col['dtype'])
+        # Some of the float values of a segment are missing (not its location)
+        if arr.dtype.kind == 'f' and col not in ['lat', 'lon', 'lat_20m', 'lon_20m'] and fill_rate > 0:
+            arr[rng.random(arr.shape) < fill_rate] = dict_col['fill']
+        dict_data[path] = arr
+
+    return dict_data
+
+def make_synthetic_granule(out_dir, n_segments=10000, version=5, dt_start=datetime(2019, 7, 15, 12, 22, 33), rgt=321, cycle=4, region=2,
+                           bbox=[-100.0, -95.0, 40.0, 70.0], sc_orient=1, fill_rate=0.05, flag_probs=FLAG_PROBS, lines=ExtractUtils.LINES,
+                           compression='gzip', seed=0):
+    '''
+    Write a synthetic ATL08 granule to out_dir and return its path
+        n_segments: 100m segments of each beam
+        bbox: [minlon, maxlon, minlat, maxlat] the ground tracks run across (the beam pairs are side by side in lon)
+        sc_orient: 0 backward (left beams strong), 1 forward (right beams strong), 2 transition
+        fill_rate: share of the float values of a dataset set to its _FillValue
+        flag_probs: distributions of the flag columns, {col: {value: probability}} (see FLAG_PROBS)
+        lines: the beams written (eg, fewer than 6, to test a granule with a beam of no data)
+        compression: of the datasets, eg 'gzip' as in the archive, or None
+    '''
+    rng = np.random.default_rng(seed)
+    minlon, maxlon, minlat, maxlat = bbox
+    dt_end = dt_start + timedelta(minutes=GRANULE_MINUTES)
+    h5_fn = os.path.join(out_dir, get_granule_name(dt_start, rgt, cycle, region, version))
+
+    dict_path_cols = get_dataset_cols(version)
+
+    os.makedirs(out_dir, exist_ok=True)
+    with h5py.File(h5_fn, 'w') as f:
+        f['/ancillary_data/granule_end_utc'] = np.array([dt_end.strftime('%Y-%m-%dT%H:%M:%S.%fZ').encode()], dtype='S27')
+        f['/orbit_info/sc_orient'] = np.array([sc_orient], dtype='int8')
+        f['/orbit_info/orbit_number'] = np.array([(rgt + 1387 * (cycle - 1)) % 65536], dtype='uint16')
+        f['/orbit_info/rgt'] = np.array([rgt], dtype='int16')
+
+        for i, line in enumerate(ExtractUtils.LINES):
+            if line not in lines:
+                continue
+            # 3 beam pairs across the bbox; the beams of a pair are 90 m apart
+            pair = i // 2
+            lon_pair = minlon + (maxlon - minlon) * (pair + 0.5) / 3 + (0.001 if line.endswith('r') else 0)
+            lat_track = np.linspace(minlat, maxlat, n_segments)
+            lon_track = np.linspace(lon_pair - (maxlon - minlon) / 6, lon_pair + (maxlon - minlon) / 6, n_segments)
+
+            dict_data = make_beam(rng, n_segments, version, lat_track, lon_track, fill_rate=fill_rate, flag_probs=flag_probs)
+            for path, arr in dict_data.items():
+                col = dict_path_cols[path][0]
+                ds = f.create_dataset(f'/{line}/land_segments/{path}', data=arr, compression=compression,
+                                      chunks=(min(n_segments, 10000),) + arr.shape[1:] if compression is not None else None)
+                ds.attrs['_FillValue'] = np.array(ExtractUtils.ATL08_SCHEMA[col]['fill'], dtype=arr.dtype)
+
+    return h5_fn
+
+def make_synthetic_granules(out_dir, n_granules=1, versions=[5], seed=0, **kwargs):
+    '''
+    Write n_granules synthetic granules of each version (a day apart, on successive RGTs) to out_dir
+    Returns the list of their paths
+    '''
+    list_h5 = []
+    for version in versions:
+        for i in range(n_granules):
+            list_h5.append(make_synthetic_granule(out_dir, version=version, dt_start=datetime(2019, 7, 15, 12, 22, 33) + timedelta(days=i),
+                                                  rgt=321 + i, seed=seed + i, **kwargs))
+    return list_h5
+
+def getparser():
+    parser = argparse.ArgumentParser(description='Write synthetic ATL08 granules (from ExtractUtils.ATL08_SCHEMA) to test and benchmark the extraction')
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output dir of the granules")
+    parser.add_argument("--n_granules", type=int, default=1, help="Number of granules of each version")
+    parser.add_argument("--n_segments", type=int, default=10000, help="Number of 100m segments of each beam")
+    parser.add_argument("--versions", nargs="+", type=int, choices=ExtractUtils.ATL08_VERSIONS, default=[5], help="ATL08 product versions")
+    parser.add_argument("--fill_rate", type=float, default=0.05, help="Share of the float values of each dataset set to its fill value")
+    parser.add_argument("--flag_probs", type=json.loads, default={}, help='Distributions of flag columns, eg \'{"msw_flg": {"0": 0.9, "1": 0.1}}\' (default: see FLAG_PROBS)')
+    parser.add_argument("--sc_orient", type=int, choices=[0, 1, 2], default=1, help="Spacecraft orientation (0 backward, 1 forward, 2 transition)")
+    parser.add_argument("--bbox", nargs=4, type=float, default=[-100.0, -95.0, 40.0, 70.0], help="minlon maxlon minlat maxlat of the ground tracks")
+    parser.add_argument('--no-compression', dest='compression', action='store_const', const=None, help='Write the datasets uncompressed (default: gzip, as in the archive)')
+    parser.set_defaults(compression='gzip')
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    return parser
+
+def main():
+    parser = getparser()
+    args = parser.parse_args()
+
+    if args.output is None:
+        print("Needs an output dir (-o). Exiting")
+        os._exit(1)
+
+    flag_probs = {**FLAG_PROBS, **{col: {int(val): prob for val, prob in dict_probs.items()} for col, dict_probs in args.flag_probs.items()}}
+    list_h5 = make_synthetic_granules(args.output, n_granules=args.n_granules, versions=args.versions, seed=args.seed,
+                                      n_segments=args.n_segments, fill_rate=args.fill_rate, flag_probs=flag_probs,
+                                      sc_orient=args.sc_orient, bbox=args.bbox, compression=args.compression)
+
+    list_fn = os.path.join(args.output, 'list_atl08_synth')
+    with open(list_fn, 'w') as f:
+        f.write('\n'.join(list_h5) + '\n')
+    print(f"Wrote {len(list_h5)} granules of {len(ExtractUtils.LINES)} x {args.n_segments} segments to: \t{args.output}")
+    print(f"Granule list: \t{list_fn}")
+
+if __name__ == "__main__":
+    main()
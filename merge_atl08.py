@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+
+'''
+    Merge the per-granule outputs of the ATL08 extraction (CSV, Parquet or Feather) into one dataset, in place of merge_atl08.R.
+    The inputs are selected like merge_atl08.R does: the files of --indir whose names end with <search_str>.<ext>.
+    They are read in parallel by a pool of worker processes and streamed into the output a few files at a time,
+    so the memory used is that of a few inputs and the row groups being written, not that of the whole merge.
+        parquet (default): a dataset dir ATL08_merged_<search_str>/, hive partitioned (eg, y=2019/) with zstd row groups
+        csv:               one ATL08_merged_<search_str>.csv, as from merge_atl08.R
+    With --append, the inputs are added to an appendable store (see StoreUtils) rather than merged anew: each granule gets
+    its own files, a manifest records the granules in the store, and an input that was already appended is skipped unless
+    it changed (eg, the granule was extracted again, or with other filters), in which case it replaces only its own files.
+    Before any rows are read, the columns and types of all of the inputs are checked:
+        - each column gets its ExtractUtils.ATL08_SCHEMA (or derived column) type, so every input is cast to one schema
+        - columns that only some inputs have (eg, tcc_prc of v003/v004 and seg_cover of v005) are null in the others
+          and are reported by product version
+        - a column with conflicting types (eg, flag names in some inputs and flag values in others) stops the merge
+
+        merge_atl08.py --indir /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/atl08.005/howland/2021 --search_str 005_01_100m --processes 16
+    Add a new week of outputs to a store:
+        merge_atl08.py --append --indir <dir of the new outputs> --search_str 005_01_100m --store <dir>/ATL08_merged_005_01_100m
+'''
+
+import os
+import argparse
+from multiprocessing import Pool
+
+import pyarrow as pa
+
+import StoreUtils
+
+def iter_merge_inputs(list_fn, schema, processes=4):
+    '''
+    Yield the record batches of the inputs, read in parallel
+    Inputs are handed to the pool a window at a time, so no more than a couple of inputs per worker wait in memory
+    '''
+    window = processes * 2
+    with Pool(processes=processes) as pool:
+        for i in range(0, len(list_fn), window):
+            for table in pool.imap(StoreUtils.read_merge_input, [(fn, schema) for fn in list_fn[i:i + window]]):
+                for batch in table.to_batches():
+                    yield batch
+            print(f"\tMerged {min(i + window, len(list_fn))} of {len(list_fn)} inputs")
+
+def write_merge(list_fn, schema, out_path, output_format='parquet', partition_cols=[], processes=4, rows_per_group=1000000):
+    '''
+    Stream the inputs into the merged output (see the module docstring)
+    '''
+    batches = iter_merge_inputs(list_fn, schema, processes=processes)
+    if output_format == 'csv':
+        import pyarrow.csv as pcsv
+        with pcsv.CSVWriter(out_path, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+    else:
+        import pyarrow.dataset as pds
+        pds.write_dataset(batches, out_path, schema=schema, format='parquet',
+                          partitioning=pds.partitioning(pa.schema([schema.field(col) for col in partition_cols]), flavor='hive') if len(partition_cols) > 0 else None,
+                          basename_template='part-{i}.parquet', existing_data_behavior='delete_matching',
+                          file_options=pds.ParquetFileFormat().make_write_options(compression='zstd'),
+                          min_rows_per_group=min(rows_per_group, 100000), max_rows_per_group=rows_per_group)
+
+def getparser():
+    parser = argparse.ArgumentParser(description='Merge the per-granule ATL08 outputs (CSV, Parquet, Feather) into one Parquet dataset (or CSV)')
+    parser.add_argument("--indir", type=str, default=None, help="Input dir of the ATL08 outputs")
+    parser.add_argument("--outdir", type=str, default=None, help="Output dir of the merge (default: 1 level up from the input dir)")
+    parser.add_argument("--search_str", "--csv_search_str", dest='search_str', type=str, default=None, help="Search string of the inputs to merge: those whose names end with <search_str>.<csv|parquet|feather>")
+    parser.add_argument("--output_format", type=str, choices=['parquet', 'csv'], default='parquet', help="parquet: a partitioned dataset dir; csv: one CSV, as from merge_atl08.R")
+    parser.add_argument("--partition_cols", nargs="*", type=str, default=['y'], help="Hive partition columns of a Parquet merge (those not in the inputs are skipped)")
+    parser.add_argument("--rows_per_group", type=int, default=1000000, help="Max rows of a Parquet row group")
+    parser.add_argument("--grid_deg", type=float, default=None, help="Add a tile column of a lat/lon grid of cells of this size (degrees), eg to partition by: --partition_cols tile y")
+    parser.add_argument('--append', dest='append', action='store_true', help='Append the inputs to an appendable store (made if it does not exist) instead of merging them anew')
+    parser.set_defaults(append=False)
+    parser.add_argument("--store", type=str, default=None, help="Store dir to append to (default: <outdir>/ATL08_merged_<search_str>)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Number of worker processes reading the inputs")
+    return parser
+
+def main():
+    parser = getparser()
+    args = parser.parse_args()
+
+    if args.indir is None:
+        print("Must provide an input dir (--indir). Exiting")
+        os._exit(1)
+    if args.search_str is None:
+        print("Must provide a search string (--search_str). Exiting")
+        os._exit(1)
+    if args.outdir is None:
+        args.outdir = os.path.dirname(os.path.abspath(args.indir))
+        print(f"Output dir will be 1 level up from input dir: {args.outdir}")
+
+    list_fn = StoreUtils.list_merge_inputs(args.indir, args.search_str)
+    if len(list_fn) == 0:
+        print(f"No inputs end with {args.search_str}.<{'|'.join(StoreUtils.INPUT_FORMATS)}> in {args.indir}. Exiting")
+        os._exit(1)
+    print(f"\nInputs to merge: \t{len(list_fn)}")
+
+    if args.append:
+        if args.output_format != 'parquet':
+            print("--append needs the parquet output format. Exiting")
+            os._exit(1)
+        store_dir = args.store if args.store is not None else os.path.join(args.outdir, f"ATL08_merged_{args.search_str}")
+        if StoreUtils.read_manifest(store_dir) is None and os.path.isdir(store_dir) and len(os.listdir(store_dir)) > 0:
+            print(f"Not an appendable store (it has no {StoreUtils.MANIFEST_FN}; merge it again with --append): {store_dir}. Exiting")
+            os._exit(1)
+        list_skipped = []
+        for fn in list_fn:
+            try:
+                StoreUtils.get_output_granule_name(fn)
+            except (ValueError, IndexError):
+                list_skipped.append(fn)
+        if len(list_skipped) > 0:
+            print(f"\tInputs not named after a granule can't be appended, skipping {len(list_skipped)}: eg {os.path.basename(list_skipped[0])}")
+            list_fn = [fn for fn in list_fn if fn not in list_skipped]
+
+    # Check the schemas of all of the inputs (and of the store appended to) before merging any rows
+    with Pool(processes=args.processes) as pool:
+        list_schemas = pool.map(StoreUtils.read_input_schema, list_fn, chunksize=16)
+    list_dropped = []
+    if args.append:
+        schema, dict_missing, dict_conflicts, list_dropped = StoreUtils.get_append_schema(store_dir, list_fn, list_schemas, grid_deg=args.grid_deg)
+    else:
+        schema, dict_missing, dict_conflicts = StoreUtils.get_merge_schema(list_fn, list_schemas)
+        if args.grid_deg is not None:
+            schema = StoreUtils.add_tile_col(schema, args.grid_deg)
+
+    # One line for the columns missing from the same inputs
+    dict_missing_cols = {}
+    for col, dict_versions in dict_missing.items():
+        dict_missing_cols.setdefault(tuple(dict_versions.items()), []).append(col)
+    for versions, cols in dict_missing_cols.items():
+        print(f"\tColumns not in all inputs (null where missing), missing from " + ', '.join([f"{n} {'v%03d' % version if version is not None else 'other'}" for version, n in versions]) + f" inputs: {cols}")
+    if len(dict_conflicts) > 0:
+        for col, dict_types in dict_conflicts.items():
+            print(f"\tColumn of conflicting types: {col}: " + '; '.join([f"{t} ({len(fns)} inputs, eg {os.path.basename(fns[0])})" for t, fns in dict_types.items()]))
+        print("Inputs of conflicting types can't be merged (eg, flag names and flag values). Exiting")
+        os._exit(1)
+    print(f"Merged schema: \t\t{len(schema)} columns")
+
+    if args.append:
+        if len(list_dropped) > 0:
+            print(f"\tColumns not in the store, dropped (merge the store again to add them): {list_dropped}")
+        partition_cols = [col for col in args.partition_cols if col in schema.names]
+        print(f"Appending to store: \t{store_dir}")
+        dict_counts = StoreUtils.append_store(store_dir, list_fn, schema, partition_cols=partition_cols, processes=args.processes)
+        print(f"Granules added: {dict_counts['added']}; replaced: {dict_counts['replaced']}; unchanged (skipped): {dict_counts['unchanged']}")
+        return
+
+    if args.output_format == 'csv':
+        out_path = os.path.join(args.outdir, f"ATL08_merged_{args.search_str}.csv")
+        partition_cols = []
+    else:
+        out_path = os.path.join(args.outdir, f"ATL08_merged_{args.search_str}")
+        partition_cols = [col for col in args.partition_cols if col in schema.names]
+        if len(partition_cols) < len(args.partition_cols):
+            print(f"\tPartition columns not in the inputs, skipped: {[col for col in args.partition_cols if col not in schema.names]}")
+        print(f"Partition columns: \t{partition_cols}")
+
+    os.makedirs(args.outdir, exist_ok=True)
+    write_merge(list_fn, schema, out_path, output_format=args.output_format, partition_cols=partition_cols,
+                processes=args.processes, rows_per_group=args.rows_per_group)
+    print(f"Merged {args.output_format.upper()}: \t{out_path}")
+
+if __name__ == "__main__":
+    main()
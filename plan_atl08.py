@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+
+'''
+    Plan an ATL08 extraction: cull a granule list before any granule is opened.
+    Uses the granule name, eg ATL08_20181226222354_13640102_005_01.h5, for:
+        the acq date: granules outside of the year and month range are dropped
+        the RGT and granule region: granules whose footprint (from a local footprint index) can't intersect the bbox are dropped
+    The footprint index is a CSV of lat/lon extents by RGT and granule region, learned from granules already processed (--update_index).
+    A reference ground track repeats every cycle, so one granule of an RGT and region gives the footprint of all of its cycles.
+    Granules with no footprint in the index are kept.
+
+    Update the index with the granules of a processed list:
+        plan_atl08.py --update_index list_atl08.005_2021 --footprint_index atl08_footprints.csv
+    Plan a list for a domain:
+        plan_atl08.py -i list_atl08.005_2021_forest201 -o list_atl08.005_2021_forest201_howland --footprint_index atl08_footprints.csv --minlon -69 --maxlon -68 --minlat 44 --maxlat 46 --minmonth 6 --maxmonth 9
+'''
+
+import os
+import argparse
+from datetime import timedelta
+
+import h5py
+import numpy as np
+import pandas as pd
+
+import ExtractUtils
+
+FOOTPRINT_INDEX_COLS = ['rgt', 'region', 'minlon', 'maxlon', 'minlat', 'maxlat', 'n_granules']
+
+# The month filter of the extractor uses the granule end time; the name has the start time.
+# A granule spans 1/14 of an orbit (~7 min), so a granule is kept if its start or start + this is in range
+GRANULE_MAX_MINUTES = 30
+
+def read_granule_list(list_fn):
+    '''
+    Return the granules of a list file (one path per line)
+    '''
+    with open(list_fn) as f:
+        return [line.strip() for line in f if line.strip() != '']
+
+def check_granule_date(dict_gran, minmonth=1, maxmonth=12, years=None):
+    '''
+    Return True if the acq date of a granule could be in the years and months wanted
+    '''
+    for dt in [dict_gran['dt'], dict_gran['dt'] + timedelta(minutes=GRANULE_MAX_MINUTES)]:
+        if (years is None or dt.year in years) and minmonth <= dt.month <= maxmonth:
+            return True
+    return False
+
+def read_granule_extent(h5_fn):
+    '''
+    Return the lon/lat extent [minlon, maxlon, minlat, maxlat] of the land segments of all beams of an ATL08 granule, or None if no beam had data
+    '''
+    with h5py.File(h5_fn, 'r') as f:
+        dict_beams = ExtractUtils.read_beams(f, {'lon': 'land_segments/longitude', 'lat': 'land_segments/latitude'})
+    if dict_beams is None:
+        return None
+    return [np.min(dict_beams['lon']), np.max(dict_beams['lon']), np.min(dict_beams['lat']), np.max(dict_beams['lat'])]
+
+def read_footprint_index(index_fn):
+    '''
+    Return the footprint index as a df (empty if the file doesn't exist yet)
+    '''
+    if index_fn is None or not os.path.isfile(index_fn):
+        return pd.DataFrame(columns=FOOTPRINT_INDEX_COLS)
+    return pd.read_csv(index_fn)
+
+def update_footprint_index(index_fn, list_h5):
+    '''
+    Add the lon/lat extents of a list of processed ATL08 granules to the footprint index
+    Extents of the same RGT and granule region (from different cycles) are merged
+    '''
+    footprints = read_footprint_index(index_fn)
+
+    list_rows = []
+    for h5_fn in list_h5:
+        if not os.path.isfile(h5_fn):
+            print(f"\tGranule not found, skipping: {h5_fn}")
+            continue
+        extent = read_granule_extent(h5_fn)
+        if extent is None:
+            print(f"\tNo land segments, skipping: {h5_fn}")
+            continue
+        dict_gran = ExtractUtils.parse_granule_name(h5_fn)
+        list_rows.append([dict_gran['rgt'], dict_gran['region']] + extent + [1])
+    print(f"Footprints read from {len(list_rows)} of {len(list_h5)} granules")
+
+    footprints = pd.concat([footprints, pd.DataFrame(list_rows, columns=FOOTPRINT_INDEX_COLS)])
+    footprints = footprints.groupby(['rgt', 'region'], as_index=False).agg({'minlon': 'min', 'maxlon': 'max', 'minlat': 'min', 'maxlat': 'max', 'n_granules': 'sum'})
+
+    footprints[FOOTPRINT_INDEX_COLS].to_csv(index_fn, index=False)
+    print(f"Footprint index of {len(footprints)} RGT regions: {index_fn}")
+
+def plan_granules(list_granules, footprints, bbox=None, buffer=0.25, minmonth=1, maxmonth=12, years=None):
+    '''
+    Cull a list of granules by acq date and footprint
+        bbox: [minlon, maxlon, minlat, maxlat]; buffer: degrees added around each footprint (for off-nadir pointing)
+    Returns the list of granules to extract
+    '''
+    dict_footprints = {(row.rgt, row.region): row for row in footprints.itertuples()}
+
+    list_plan = []
+    n_date, n_footprint, n_unknown = 0, 0, 0
+    for granule in list_granules:
+        dict_gran = ExtractUtils.parse_granule_name(granule)
+
+        if not check_granule_date(dict_gran, minmonth=minmonth, maxmonth=maxmonth, years=years):
+            n_date += 1
+            continue
+
+        if bbox is not None:
+            fp = dict_footprints.get((dict_gran['rgt'], dict_gran['region']))
+            if fp is None:
+                n_unknown += 1
+            elif fp.maxlon + buffer < bbox[0] or fp.minlon - buffer > bbox[1] or fp.maxlat + buffer < bbox[2] or fp.minlat - buffer > bbox[3]:
+                n_footprint += 1
+                continue
+
+        list_plan.append(granule)
+
+    print(f"\tGranules in list: \t\t\t{len(list_granules)}")
+    print(f"\tDropped by acq date: \t\t\t{n_date}")
+    print(f"\tDropped by footprint: \t\t\t{n_footprint}")
+    print(f"\tKept with no footprint in index: \t{n_unknown}")
+    print(f"\tGranules to extract: \t\t\t{len(list_plan)}")
+
+    return list_plan
+
+def getparser():
+    parser = argparse.ArgumentParser(description='Cull an ATL08 granule list by acq date and ground-track footprint before extraction')
+    parser.add_argument("-i", "--input", type=str, default=None, help="A list of ATL08 granules (one path per line) to plan")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output list of granules to extract (default: <input>_plan)")
+    parser.add_argument("--footprint_index", type=str, default=None, help="CSV of lon/lat extents by RGT and granule region")
+    parser.add_argument("--update_index", type=str, default=None, help="A list of processed ATL08 granules whose extents are added to the footprint index")
+    parser.add_argument("--buffer", type=float, default=0.25, help="Degrees added around each footprint before checking the bbox")
+    parser.add_argument("--minlon" , type=float, default=-180.0, help="Min longitude of the domain")
+    parser.add_argument("--maxlon" , type=float, default=180.0, help="Max longitude of the domain")
+    parser.add_argument("--minlat" , type=float, default=-90.0, help="Min latitude of the domain")
+    parser.add_argument("--maxlat" , type=float, default=90.0, help="Max latitude of the domain")
+    parser.add_argument("--minmonth" , type=int, default=1, help="Min month of granules to extract")
+    parser.add_argument("--maxmonth" , type=int, default=12, help="Max month of granules to extract")
+    parser.add_argument("--years", nargs="+", type=int, default=None, help="Years of granules to extract (default: all)")
+    return parser
+
+def main():
+    parser = getparser()
+    args = parser.parse_args()
+
+    if args.input is None and args.update_index is None:
+        print("Needs a granule list to plan (-i) or to add to the footprint index (--update_index). Exiting")
+        os._exit(1)
+
+    if args.update_index is not None:
+        if args.footprint_index is None:
+            print("Needs a footprint index file (--footprint_index) to update. Exiting")
+            os._exit(1)
+        print(f"\nUpdating footprint index with granules of: {args.update_index}")
+        update_footprint_index(args.footprint_index, read_granule_list(args.update_index))
+
+    if args.input is not None:
+        print(f"\nPlanning granule list: {args.input}")
+        footprints = read_footprint_index(args.footprint_index)
+        print(f"\tFootprint index: {len(footprints)} RGT regions")
+        print(f"\tBbox: {args.minlon} {args.maxlon} {args.minlat} {args.maxlat}")
+        print(f"\tMonths: {args.minmonth}-{args.maxmonth}; Years: {args.years}")
+
+        list_plan = plan_granules(read_granule_list(args.input), footprints,
+                                  bbox=[args.minlon, args.maxlon, args.minlat, args.maxlat], buffer=args.buffer,
+                                  minmonth=args.minmonth, maxmonth=args.maxmonth, years=args.years)
+
+        out_fn = args.input + '_plan' if args.output is None else args.output
+        with open(out_fn, 'w') as f:
+            f.writelines([granule + '\n' for granule in list_plan])
+        print(f"Granule list: {out_fn}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+
+'''
+    Query a subset of the merged ATL08 outputs: a store (compact_atl08.py, merge_atl08.py --append) or a merged Parquet dataset
+    (merge_atl08.py), by bbox or tile, date range, months (season), land cover and a quality filter spec (a FilterUtils preset,
+    JSON file or string), and write the columns asked for to Parquet, CSV or stdout (CSV) as they are read.
+    The query is pushed down, so a subset reads a fraction of the bytes of the outputs:
+        - the partitions and files of a store whose zone maps (lat, lon, seg_landcov, dates) miss the query are not opened
+        - the row groups of a file whose statistics miss the query are not read
+        - only the columns asked for (and those of the predicates) are read
+    Messages go to stderr, so the rows can be piped from stdout.
+
+        query_atl08.py --store /adapt/nobackup/people/pmontesa/userfs02/data/icesat2/atl08.005/howland/ATL08_store_005_01_100m
+                       --bbox -69 -68 45 46 --start_date 2021-06-01 --end_date 2021-09-30 --filter_spec v4 --columns lon lat h_can rh90 -o howland_2021.parquet
+        query_atl08.py --store <store> --tile 48711 --months 6 7 8 --columns lon lat h_can | head
+    Print what a query would read, without reading it:
+        query_atl08.py --store <store> --bbox -69 -68 45 46 --explain
+'''
+
+import os, sys
+import argparse
+
+import pyarrow as pa
+import pyarrow.dataset as pds
+
+import FilterUtils
+import StoreUtils
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+def get_scan_stats(dataset, filter_expr, cols):
+    '''
+    Return what a scan of a dataset reads: its files, the row groups of them its filter can't skip, and the compressed bytes of
+    the column chunks of cols (the columns out and those of the predicates) in those row groups
+    '''
+    dict_stats = {'files': 0, 'row_groups': 0, 'row_groups_in_files': 0, 'bytes_read': 0}
+    for fragment in dataset.get_fragments(filter=filter_expr):
+        md = fragment.metadata
+        names = md.schema.names
+        dict_stats['files'] += 1
+        dict_stats['row_groups_in_files'] += md.num_row_groups
+        for rg_fragment in fragment.split_by_row_group(filter_expr, schema=dataset.schema):
+            for rg in rg_fragment.row_groups:
+                dict_stats['row_groups'] += 1
+                dict_stats['bytes_read'] += sum([md.row_group(rg.id).column(names.index(col)).total_compressed_size for col in cols if col in names])
+    return dict_stats
+
+def getparser():
+    parser = argparse.ArgumentParser(description='Query a subset of the merged ATL08 outputs (a store or merged Parquet dataset) with predicate and column pushdown')
+    parser.add_argument("--store", type=str, default=None, help="Store dir (compact_atl08.py, merge_atl08.py --append), merged Parquet dataset dir or Parquet file")
+    parser.add_argument("--bbox", nargs=4, type=float, default=None, metavar=('MINLON', 'MAXLON', 'MINLAT', 'MAXLAT'), help="Bbox of the obs")
+    parser.add_argument("--tile", nargs="+", type=int, default=None, help="Tiles of the grid of the store (the tile partitions)")
+    parser.add_argument("--start_date", type=str, default=None, help="First date of the obs (YYYY-MM-DD)")
+    parser.add_argument("--end_date", type=str, default=None, help="Last date of the obs (YYYY-MM-DD)")
+    parser.add_argument("--months", nargs="+", type=int, default=None, help="Months of the obs (a season), eg 6 7 8 9")
+    parser.add_argument("--landcov", nargs="+", type=int, default=None, help="Land cover classes (seg_landcov) of the obs")
+    parser.add_argument("--filter_spec", type=str, default=None, help=f"Quality filter spec: a preset {list(FilterUtils.FILTER_SPEC_PRESETS)}, JSON file or JSON string")
+    parser.add_argument("--columns", nargs="+", type=str, default=None, help="Columns out (default: all)")
+    parser.add_argument("-o", "--output", type=str, default='-', help="Output .parquet or .csv; - for CSV to stdout")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many rows")
+    parser.add_argument('--explain', dest='explain', action='store_true', help='Print the files, row groups and bytes the query reads, without reading it')
+    parser.set_defaults(explain=False)
+    return parser
+
+def main():
+    parser = getparser()
+    args = parser.parse_args()
+
+    if args.store is None:
+        log("Must provide a store (--store). Exiting")
+        os._exit(1)
+    if (args.start_date is None) != (args.end_date is None):
+        log("Must provide both a start and an end date (--start_date, --end_date). Exiting")
+        os._exit(1)
+    try:
+        date_range = StoreUtils.get_date_range(None if args.start_date is None else [args.start_date, args.end_date])
+    except ValueError:
+        log(f"Dates must be YYYY-MM-DD (--start_date {args.start_date}, --end_date {args.end_date}). Exiting")
+        os._exit(1)
+    if date_range is not None and date_range[0] > date_range[1]:
+        log(f"The start date is after the end date ({date_range[0]} > {date_range[1]}). Exiting")
+        os._exit(1)
+
+    is_store = StoreUtils.read_manifest(args.store) is not None
+    # The tiles of a store are those of its grid; a store made without one has no tile column
+    if args.tile is not None and is_store and StoreUtils.get_grid_deg(StoreUtils.read_store_schema(args.store)) is None:
+        log(f"Columns not in the store: {[StoreUtils.TILE_COL]}. Exiting")
+        os._exit(1)
+
+    dataset, list_files = StoreUtils.open_query_dataset(args.store, bbox=args.bbox, date_range=date_range, landcov=args.landcov, tiles=args.tile)
+    schema = dataset.schema
+    if is_store:
+        log(f"\nFiles to open: \t\t{len(list_files)} of {len(StoreUtils.get_store_files(args.store))} (by the zone maps of the store)")
+    else:
+        log(f"\nFiles: \t\t\t{len(list_files)} (a merged dataset has no zone maps; its partitions and row groups are still skipped)")
+
+    # The columns of the predicates, for the bytes read (--explain) and to check that the store has them
+    list_pred_cols = []
+    if args.bbox is not None:
+        list_pred_cols += ['lon', 'lat']
+    if args.tile is not None:
+        list_pred_cols += [StoreUtils.TILE_COL]
+    if date_range is not None:
+        list_pred_cols += ['y', 'doy']
+    if args.months is not None:
+        list_pred_cols += ['m']
+    if args.landcov is not None:
+        list_pred_cols += ['seg_landcov']
+    missing_cols = [col for col in list_pred_cols + (args.columns or []) if col not in schema.names]
+    if len(missing_cols) > 0:
+        log(f"Columns not in the store: {missing_cols}. Exiting")
+        os._exit(1)
+
+    filter_expr = StoreUtils.get_query_expression(schema, bbox=args.bbox, date_range=date_range, landcov=args.landcov, tiles=args.tile)
+    list_expr = [] if filter_expr is None else [filter_expr]
+    if args.months is not None:
+        list_expr.append(pds.field('m').isin(args.months))
+    if args.filter_spec is not None:
+        try:
+            filter_spec = FilterUtils.read_filter_spec(args.filter_spec)
+        except ValueError as e:
+            log(f"{e}. Exiting")
+            os._exit(1)
+        # Its predicates on columns the store doesn't have (eg, of a merged dataset of older outputs) can't be applied
+        spec_cols = FilterUtils.get_filter_spec_cols(filter_spec)
+        missing_cols = [col for col in spec_cols if col not in schema.names]
+        if len(missing_cols) > 0:
+            log(f"Columns of the filter spec not in the store: {missing_cols}. Exiting")
+            os._exit(1)
+        spec_expr = FilterUtils.get_filter_spec_expression(filter_spec, schema)
+        if spec_expr is not None:
+            list_expr.append(spec_expr)
+        list_pred_cols += spec_cols
+    filter_expr = None
+    for expr in list_expr:
+        filter_expr = expr if filter_expr is None else filter_expr & expr
+
+    if args.explain:
+        dict_stats = get_scan_stats(dataset, filter_expr, list(dict.fromkeys((args.columns or schema.names) + list_pred_cols)))
+        log(f"Files read: \t\t{dict_stats['files']} (after the partition filter)")
+        log(f"Row groups read: \t{dict_stats['row_groups']} of {dict_stats['row_groups_in_files']} (by their statistics)")
+        log(f"MB read: \t\t{round(dict_stats['bytes_read'] / 1024**2, 3)} (columns out and of the predicates, compressed)")
+        list_all_files = [os.path.join(args.store, fn) for fn in StoreUtils.get_store_files(args.store)] if is_store else list_files
+        log(f"MB of the store: \t{round(sum([os.path.getsize(fn) for fn in list_all_files]) / 1024**2, 3)}")
+        return
+
+    scanner = dataset.scanner(columns=args.columns, filter=filter_expr)
+    out_schema = scanner.projected_schema
+    if args.output == '-' or args.output.endswith('.csv'):
+        import pyarrow.csv as pcsv
+        writer = pcsv.CSVWriter(sys.stdout.buffer if args.output == '-' else args.output, out_schema)
+    else:
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(args.output, out_schema, compression='zstd')
+
+    n_rows = 0
+    try:
+        with writer:
+            for batch in scanner.to_batches():
+                if args.limit is not None and n_rows + batch.num_rows > args.limit:
+                    batch = batch.slice(0, args.limit - n_rows)
+                if batch.num_rows > 0:
+                    writer.write_table(pa.Table.from_batches([batch], schema=out_schema))
+                n_rows += batch.num_rows
+                if args.limit is not None and n_rows >= args.limit:
+                    break
+    except BrokenPipeError:
+        # stdout was closed by the reader (eg, | head)
+        os._exit(0)
+    log(f"Rows out: \t\t{n_rows}")
+    if args.output != '-':
+        log(f"Output: \t\t{args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+
+'''
+    Summarize the phase profiles of an ATL08 extraction (--profile of extract_filter_atl08_v005.py or batch_extract_atl08.py).
+    Each line of a profile is one granule; for each phase (and output, for the filter and write phases of each output),
+    gives the percentiles of its wall time over the granules, its CPU time, how much it raised the peak RSS,
+    and its share of the total wall time of the batch, to show where the time of a batch goes.
+    Phases named <phase>/<sub phase> (eg, read/join_beams) are part of their phase and are not counted in the share twice.
+
+        summarize_profile_atl08.py -i batch_summary_list_atl08.005_2021_profile.jsonl
+'''
+
+import os
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+PERCENTILES = [50, 90, 99]
+
+def read_profiles(list_profile_fn):
+    '''
+    Return the profiles (one dict per granule) of JSON lines profile files
+    '''
+    list_profiles = []
+    for profile_fn in list_profile_fn:
+        with open(profile_fn) as f:
+            list_profiles += [json.loads(line) for line in f if line.strip() != '']
+    return list_profiles
+
+def get_phases_df(list_profiles):
+    '''
+    Return a df of the phases of the profiles, one row per phase of a granule (phases of one name and output are summed per granule)
+    '''
+    list_rows = []
+    for i, profile in enumerate(list_profiles):
+        for dict_phase in profile['phases']:
+            list_rows.append({'granule': i, 'granule_name': profile['granule_name'], 'status': profile.get('status'), **dict_phase})
+    phases = pd.DataFrame(list_rows, columns=['granule', 'granule_name', 'status', 'phase', 'output', 'wall_s', 'cpu_s', 'peak_rss_mb', 'peak_rss_growth_mb'])
+    phases['output'] = phases['output'].fillna('')
+    phases = phases.groupby(['granule', 'granule_name', 'status', 'phase', 'output'], sort=False, dropna=False).agg(
+        wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'), peak_rss_growth_mb=('peak_rss_growth_mb', 'sum')).reset_index()
+    return phases
+
+def summarize_phases(phases, total_wall_s, percentiles=PERCENTILES):
+    '''
+    Return a df of the percentiles of the wall time of each phase (and output), in the order the phases run
+        total_wall_s: the summed wall time of the granules, for the share of each phase
+    '''
+    list_rows = []
+    for (phase, output), grp in phases.groupby(['phase', 'output'], sort=False):
+        row = {'phase': phase, 'output': output, 'n': len(grp)}
+        for p in percentiles:
+            row[f'wall_p{p}'] = np.percentile(grp.wall_s, p)
+        row['wall_max'] = grp.wall_s.max()
+        row['wall_sum'] = grp.wall_s.sum()
+        row['share'] = np.nan if '/' in phase else grp.wall_s.sum() / total_wall_s
+        row['cpu_p50'] = np.percentile(grp.cpu_s, 50)
+        row['cpu/wall'] = grp.cpu_s.sum() / grp.wall_s.sum() if grp.wall_s.sum() > 0 else np.nan
+        row['rss_growth_p90_mb'] = np.percentile(grp.peak_rss_growth_mb, 90)
+        row['rss_growth_max_mb'] = grp.peak_rss_growth_mb.max()
+        list_rows.append(row)
+    return pd.DataFrame(list_rows)
+
+def getparser():
+    parser = argparse.ArgumentParser(description='Summarize the phase profiles (--profile) of an ATL08 extraction')
+    parser.add_argument("-i", "--input", nargs="+", type=str, default=None, help="Profile JSON lines files (one line per granule)")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output CSV of the phase summary (optional)")
+    parser.add_argument("--status", nargs="+", type=str, default=None, help="Only summarize granules of these outcomes (eg, written); default: all")
+    parser.add_argument("--top", type=int, default=5, help="Number of slowest granules to list")
+    return parser
+
+def main():
+    parser = getparser()
+    args = parser.parse_args()
+
+    if args.input is None:
+        print("Needs a profile (-i). Exiting")
+        os._exit(1)
+
+    list_profiles = read_profiles(args.input)
+    if args.status is not None:
+        list_profiles = [profile for profile in list_profiles if profile.get('status') in args.status]
+    if len(list_profiles) == 0:
+        print("No granules in the profile. Exiting")
+        os._exit(1)
+
+    granules = pd.DataFrame([{key: profile.get(key) for key in ['granule_name', 'status', 'wall_s', 'cpu_s', 'peak_rss_mb', 'peak_rss_growth_mb']} for profile in list_profiles])
+    summary = summarize_phases(get_phases_df(list_profiles), granules.wall_s.sum())
+
+    print(f"\nGranules: \t\t{len(granules)}")
+    for status, n in granules.status.value_counts().items():
+        print(f"\t{status}: \t\t{n}")
+    print(f"Wall time (s): \t\tsum {round(granules.wall_s.sum(), 1)}; " + '; '.join([f"p{p} {round(np.percentile(granules.wall_s, p), 3)}" for p in PERCENTILES]) + f"; max {round(granules.wall_s.max(), 3)}")
+    print(f"CPU time (s): \t\tsum {round(granules.cpu_s.sum(), 1)}")
+    print(f"Peak RSS (MB): \t\tmax {granules.peak_rss_mb.max()}")
+
+    print("\nPhases (seconds; share of the summed wall time of the granules):")
+    with pd.option_context('display.max_columns', None, 'display.width', 250, 'display.float_format', '{:.4f}'.format):
+        print(summary.to_string(index=False))
+
+    print(f"\nSlowest {args.top} granules:")
+    print(granules.sort_values('wall_s', ascending=False).head(args.top).to_string(index=False))
+
+    if args.output is not None:
+        summary.to_csv(args.output, index=False)
+        print(f"\nSummary CSV: \t\t{args.output}")
+
+if __name__ == "__main__":
+    main()